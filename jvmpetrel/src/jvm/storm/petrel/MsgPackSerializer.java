@@ -0,0 +1,331 @@
+package storm.petrel;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.math.BigInteger;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collection;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+
+import org.json.simple.JSONValue;
+
+import org.msgpack.core.MessageBufferPacker;
+import org.msgpack.core.MessagePack;
+import org.msgpack.core.MessageUnpacker;
+import org.msgpack.value.Value;
+
+import org.apache.storm.multilang.BoltMsg;
+import org.apache.storm.multilang.ISerializer;
+import org.apache.storm.multilang.NoOutputException;
+import org.apache.storm.multilang.ShellMsg;
+import org.apache.storm.multilang.SpoutMsg;
+import org.apache.storm.task.TopologyContext;
+import org.apache.storm.utils.Utils;
+
+/**
+ * Multilang serializer that exchanges MessagePack documents with Python
+ * tasks. Each message is preceded by its length as a 4-byte big-endian
+ * integer, so neither side has to scan for delimiters. Unlike JSON, byte[]
+ * tuple values are carried natively.
+ *
+ * Enable it in the topology YAML:
+ *
+ *   topology.multilang.serializer: "storm.petrel.MsgPackSerializer"
+ *
+ * The Python side is petrel.storm.MsgPackSerializer.
+ */
+public class MsgPackSerializer implements ISerializer
+{
+    // Matches petrel.storm.MAX_MESSAGE_SIZE.
+    private static final int MAX_MESSAGE_SIZE = 16777216;
+
+    private DataOutputStream processIn;
+    private DataInputStream processOut;
+
+    public void initialize(OutputStream processIn, InputStream processOut)
+    {
+        this.processIn = new DataOutputStream(new BufferedOutputStream(processIn));
+        this.processOut = new DataInputStream(new BufferedInputStream(processOut));
+    }
+
+    public Number connect(Map conf, TopologyContext context) throws IOException, NoOutputException
+    {
+        Map<String, Object> setupInfo = new HashMap<String, Object>();
+        setupInfo.put("pidDir", context.getPIDDir());
+        setupInfo.put("conf", conf);
+        // TopologyContext only knows how to render itself as JSON. Convert it
+        // so the Python side sees the same structure as with JsonSerializer.
+        setupInfo.put("context", JSONValue.parse(context.toJSONString()));
+        writeMessage(setupInfo);
+
+        Map msg = readMap();
+        return (Number) msg.get("pid");
+    }
+
+    public ShellMsg readShellMsg() throws IOException, NoOutputException
+    {
+        Map msg = readMap();
+        ShellMsg shellMsg = new ShellMsg();
+
+        String command = (String) msg.get("command");
+        shellMsg.setCommand(command);
+        shellMsg.setId(msg.get("id"));
+        shellMsg.setMsg((String) msg.get("msg"));
+
+        String stream = (String) msg.get("stream");
+        if (stream == null)
+        {
+            stream = Utils.DEFAULT_STREAM_ID;
+        }
+        shellMsg.setStream(stream);
+
+        Object taskObj = msg.get("task");
+        if (taskObj != null)
+        {
+            shellMsg.setTask(((Number) taskObj).longValue());
+        }
+        else
+        {
+            shellMsg.setTask(0);
+        }
+
+        Object needTaskIds = msg.get("need_task_ids");
+        shellMsg.setNeedTaskIds(needTaskIds == null || ((Boolean) needTaskIds).booleanValue());
+
+        shellMsg.setTuple((List) msg.get("tuple"));
+
+        Object anchorObj = msg.get("anchors");
+        if (anchorObj != null)
+        {
+            if (anchorObj instanceof String)
+            {
+                anchorObj = Arrays.asList(anchorObj);
+            }
+            for (Object o : (List) anchorObj)
+            {
+                shellMsg.addAnchor((String) o);
+            }
+        }
+
+        Object nameObj = msg.get("name");
+        if (nameObj instanceof String)
+        {
+            shellMsg.setMetricName((String) nameObj);
+        }
+        shellMsg.setMetricParams(msg.get("params"));
+
+        if ("log".equals(command))
+        {
+            Object logLevelObj = msg.get("level");
+            if (logLevelObj instanceof Number)
+            {
+                shellMsg.setLogLevel(((Number) logLevelObj).intValue());
+            }
+        }
+
+        return shellMsg;
+    }
+
+    public void writeBoltMsg(BoltMsg boltMsg) throws IOException
+    {
+        // Keep "tuple" last. The Python side can then find the encoded values
+        // without decoding them.
+        MessageBufferPacker packer = MessagePack.newDefaultBufferPacker();
+        packer.packMapHeader(5);
+        packer.packString("id");
+        pack(packer, boltMsg.getId());
+        packer.packString("comp");
+        pack(packer, boltMsg.getComp());
+        packer.packString("stream");
+        pack(packer, boltMsg.getStream());
+        packer.packString("task");
+        packer.packLong(boltMsg.getTask());
+        packer.packString("tuple");
+        pack(packer, boltMsg.getTuple());
+        writeFrame(packer);
+    }
+
+    public void writeSpoutMsg(SpoutMsg msg) throws IOException
+    {
+        Map<String, Object> obj = new HashMap<String, Object>();
+        obj.put("command", msg.getCommand());
+        obj.put("id", msg.getId());
+        writeMessage(obj);
+    }
+
+    public void writeTaskIds(List<Integer> taskIds) throws IOException
+    {
+        writeMessage(taskIds);
+    }
+
+    private void writeMessage(Object msg) throws IOException
+    {
+        MessageBufferPacker packer = MessagePack.newDefaultBufferPacker();
+        pack(packer, msg);
+        writeFrame(packer);
+    }
+
+    private void writeFrame(MessageBufferPacker packer) throws IOException
+    {
+        byte[] bytes = packer.toByteArray();
+        packer.close();
+        processIn.writeInt(bytes.length);
+        processIn.write(bytes, 0, bytes.length);
+        processIn.flush();
+    }
+
+    private Map readMap() throws IOException, NoOutputException
+    {
+        Object msg = readMessage();
+        if (!(msg instanceof Map))
+        {
+            // petrel.storm.sendFailureMsgToParent() deliberately sends a
+            // plain string to make the task fail quickly.
+            throw new IOException("Invalid message from subprocess: " + msg);
+        }
+        return (Map) msg;
+    }
+
+    private Object readMessage() throws IOException, NoOutputException
+    {
+        int length;
+        try
+        {
+            length = processOut.readInt();
+        }
+        catch (EOFException e)
+        {
+            throw new NoOutputException("Pipe to subprocess seems to be broken! No output read.");
+        }
+        if (length < 0 || length > MAX_MESSAGE_SIZE)
+        {
+            throw new IOException("Invalid message length from subprocess: " + length);
+        }
+
+        byte[] payload = new byte[length];
+        processOut.readFully(payload);
+        MessageUnpacker unpacker = MessagePack.newDefaultUnpacker(payload);
+        try
+        {
+            return toJava(unpacker.unpackValue());
+        }
+        finally
+        {
+            unpacker.close();
+        }
+    }
+
+    /**
+     * Converts a MessagePack value to the Java types JSON-Simple would have
+     * produced, plus byte[] for binary values.
+     */
+    private static Object toJava(Value value)
+    {
+        switch (value.getValueType())
+        {
+        case NIL:
+            return null;
+        case BOOLEAN:
+            return value.asBooleanValue().getBoolean();
+        case INTEGER:
+            return value.asIntegerValue().toLong();
+        case FLOAT:
+            return value.asFloatValue().toDouble();
+        case STRING:
+            return value.asStringValue().asString();
+        case BINARY:
+            return value.asBinaryValue().asByteArray();
+        case ARRAY:
+        {
+            List<Object> list = new ArrayList<Object>();
+            for (Value item : value.asArrayValue())
+            {
+                list.add(toJava(item));
+            }
+            return list;
+        }
+        case MAP:
+        {
+            Map<Object, Object> map = new HashMap<Object, Object>();
+            for (Map.Entry<Value, Value> entry : value.asMapValue().entrySet())
+            {
+                map.put(toJava(entry.getKey()), toJava(entry.getValue()));
+            }
+            return map;
+        }
+        default:
+            return value.toString();
+        }
+    }
+
+    private static void pack(MessageBufferPacker packer, Object o) throws IOException
+    {
+        if (o == null)
+        {
+            packer.packNil();
+        }
+        else if (o instanceof String)
+        {
+            packer.packString((String) o);
+        }
+        else if (o instanceof Boolean)
+        {
+            packer.packBoolean((Boolean) o);
+        }
+        else if (o instanceof Long || o instanceof Integer || o instanceof Short || o instanceof Byte)
+        {
+            packer.packLong(((Number) o).longValue());
+        }
+        else if (o instanceof Double || o instanceof Float)
+        {
+            packer.packDouble(((Number) o).doubleValue());
+        }
+        else if (o instanceof BigInteger)
+        {
+            packer.packBigInteger((BigInteger) o);
+        }
+        else if (o instanceof byte[])
+        {
+            byte[] bytes = (byte[]) o;
+            packer.packBinaryHeader(bytes.length);
+            packer.writePayload(bytes);
+        }
+        else if (o instanceof Map)
+        {
+            Map<?, ?> map = (Map<?, ?>) o;
+            packer.packMapHeader(map.size());
+            for (Map.Entry<?, ?> entry : map.entrySet())
+            {
+                pack(packer, entry.getKey());
+                pack(packer, entry.getValue());
+            }
+        }
+        else if (o instanceof Collection)
+        {
+            Collection<?> collection = (Collection<?>) o;
+            packer.packArrayHeader(collection.size());
+            for (Object item : collection)
+            {
+                pack(packer, item);
+            }
+        }
+        else if (o instanceof Object[])
+        {
+            pack(packer, Arrays.asList((Object[]) o));
+        }
+        else
+        {
+            // Same fallback as JSONValue.toJSONString().
+            packer.packString(o.toString());
+        }
+    }
+}
@@ -0,0 +1,135 @@
+"""Bolt whose process() method is a coroutine. Requires Python 3.5 or later;
+the rest of petrel does not import this module."""
+import asyncio
+import collections
+import logging
+import sys
+
+from petrel import storm
+
+storm_log = logging.getLogger('storm')
+
+
+class AsyncBolt(storm.Task):
+    """Bolt that processes several tuples concurrently on an asyncio event
+    loop. This suits bolts that spend most of their time waiting on network
+    calls. process() is a coroutine that receives the tuple and a
+    TupleCollector for it:
+
+        async def process(self, tup, collector):
+            result = await lookup(tup.values[0])
+            collector.emit([result])
+
+    Emits are anchored to the tuple being processed. The tuple is acked when
+    process() returns, or failed if it raises storm.FailedException. Any
+    other exception terminates the task, as with BasicBolt. Emits and acks
+    are written in the order the tuples complete, which need not be the
+    order they arrived in.
+
+    Up to "max_in_flight" tuples are processed at once ("petrel.async.
+    max_in_flight" in the component conf). Tuples beyond that wait in
+    memory; stdin is still read so heartbeats are answered promptly. Use
+    "topology.max.spout.pending" to bound how many tuples can wait."""
+    max_in_flight = 100
+
+    def initialize(self, stormconf, context):
+        pass
+
+    async def process(self, tup, collector):
+        pass
+
+    def run(self):
+        storm.MODE = storm.Bolt
+        self.shared_initialize()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run_async(loop, storm._binary_stream(sys.stdin)))
+        except Exception as e:
+            self.report_exception('E_BOLTFAILED', e)
+            storm_log.exception('Caught exception in AsyncBolt.run')
+        finally:
+            loop.close()
+
+    async def run_async(self, loop, stdin):
+        """Reads and processes tuples from "stdin" until it is closed or a
+        tuple raises an exception."""
+        self._loop = loop
+        self._failed = loop.create_future()
+        self._in_flight = 0
+        self._waiting = collections.deque()
+        self._flush_scheduled = False
+        self._limit = max(1, int(self.conf.get('petrel.async.max_in_flight', self.max_in_flight)))
+
+        reader = asyncio.StreamReader()
+        transport, protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), stdin)
+        # Frames read during setup but not yet consumed stay in storm._reader.
+        frames = storm._reader or storm.FrameReader(None, storm.SERIALIZER)
+        read_task = loop.create_task(self._read_loop(reader, frames))
+        try:
+            await asyncio.wait([read_task, self._failed], return_when=asyncio.FIRST_COMPLETED)
+            if self._failed.done():
+                read_task.cancel()
+                self._failed.result()
+            read_task.result()
+        finally:
+            transport.close()
+
+    async def _read_loop(self, reader, frames):
+        serializer = frames.serializer
+        while True:
+            payload = frames.next_payload()
+            if payload is None:
+                self.collector.output.flush()
+                data = await reader.read(frames.CHUNK_SIZE)
+                if not data:
+                    # Let the tuples in flight finish before giving up.
+                    while self._in_flight and not self._failed.done():
+                        await asyncio.sleep(0.01)
+                    raise storm.StormIPCException('Read EOF from stdin')
+                frames.feed(data)
+                continue
+            tup = serializer.decode_tuple(payload)
+            if not isinstance(tup, storm.Tuple):
+                # Task ids are never requested, since emits complete out of
+                # order.
+                continue
+            if tup.is_heartbeat_tuple():
+                storm.sync()
+            elif self._in_flight < self._limit:
+                self._start(tup)
+            else:
+                self._waiting.append(tup)
+
+    def _start(self, tup):
+        self._in_flight += 1
+        self._loop.create_task(self._process(tup))
+
+    async def _process(self, tup):
+        collector = self.collector.bind(tup)
+        try:
+            await self.process(tup, collector)
+        except storm.FailedException:
+            collector.fail()
+        except Exception as e:
+            storm_log.error(
+                'The error occurred while processing this tuple: %s',
+                repr(tup.values)[:2000])
+            if not self._failed.done():
+                self._failed.set_exception(e)
+            return
+        else:
+            collector.ack()
+        finally:
+            self._in_flight -= 1
+        if self._waiting:
+            self._start(self._waiting.popleft())
+        # Tuples completing in the same loop iteration share one flush.
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        self.collector.output.flush()
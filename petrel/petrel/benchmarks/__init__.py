@@ -0,0 +1,152 @@
+"""Microbenchmarks for the hot paths of petrel.storm. Each benchmark times
+an operation, e.g. reading one tuple or emitting one tuple, over
+in-memory streams, so the results reflect Petrel's own overhead rather
+than the pipe to Storm.
+
+    python -m petrel.benchmarks run -o before.json
+    (make a change)
+    python -m petrel.benchmarks run -o after.json
+    python -m petrel.benchmarks compare before.json after.json
+
+"compare" lists every benchmark that got slower by more than the
+threshold and exits with status 1 if there are any, so it can gate a
+build. Timings vary from run to run by a few percent, so compare results
+from the same machine, and use a threshold well above the noise."""
+from __future__ import print_function
+
+import json
+import platform
+import re
+import sys
+import time
+
+from petrel.storm import now_ns
+
+# Name -> (function, arguments). The function returns (run, ops): calling
+# run() performs "ops" operations.
+BENCHMARKS = {}
+
+
+def benchmark(name, *variants):
+    """Registers a benchmark. Each variant is a tuple of arguments for the
+    function, and is reported as "name[arg,arg...]"."""
+    def register(function):
+        for args in variants or [()]:
+            full_name = '%s[%s]' % (name, ','.join(str(a) for a in args)) if args else name
+            BENCHMARKS[full_name] = (function, args)
+        return function
+    return register
+
+
+def measure(function, args, repeat=5, min_time=0.05):
+    """Returns the best time per operation in nanoseconds over "repeat"
+    runs of at least "min_time" seconds each."""
+    run, ops = function(*args)
+    # Warm up, and find how many calls take at least min_time.
+    number = 1
+    while True:
+        start = now_ns()
+        for i in range(number):
+            run()
+        elapsed = now_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        number *= 2
+    best = elapsed
+    for i in range(repeat - 1):
+        start = now_ns()
+        for j in range(number):
+            run()
+        best = min(best, now_ns() - start)
+    return {
+        'ns_per_op': float(best) / (number * ops),
+        'ops_per_sec': number * ops * 1e9 / best if best else 0.0,
+        'ops': number * ops,
+    }
+
+
+def run_benchmarks(pattern=None, repeat=5, min_time=0.05, out=None):
+    """Runs the benchmarks whose names match the regular expression
+    "pattern". Returns the results as a dict ready for json.dump()."""
+    # Importing the module registers its benchmarks.
+    from petrel.benchmarks import hotpaths
+    results = {}
+    skipped = {}
+    for name in sorted(BENCHMARKS):
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        function, args = BENCHMARKS[name]
+        try:
+            results[name] = measure(function, args, repeat, min_time)
+        except ImportError as e:
+            skipped[name] = str(e)
+            continue
+        if out is not None:
+            print('%-45s %12.1f ns/op' % (name, results[name]['ns_per_op']), file=out)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(old, new, threshold=0.1):
+    """Compares two results dicts from run_benchmarks(). Returns a list of
+    (name, old ns/op, new ns/op, ratio) for the benchmarks in both, and the
+    names of those whose time per operation grew by more than "threshold"
+    (0.1 = 10%)."""
+    rows = []
+    regressions = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][name]['ns_per_op']
+        after = new['results'][name]['ns_per_op']
+        ratio = after / before if before else float('inf')
+        rows.append((name, before, after, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m petrel.benchmarks', description='Petrel microbenchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_run = subparsers.add_parser('run', help='run the benchmarks')
+    parser_run.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser_run.add_argument('-k', '--pattern', help='only run benchmarks whose names match this regular expression')
+    parser_run.add_argument('--repeat', type=int, default=5, help='runs per benchmark; the best is kept')
+    parser_run.add_argument('--min-time', type=float, default=0.05, help='minimum seconds per run')
+    parser_compare = subparsers.add_parser('compare', help='compare two result files')
+    parser_compare.add_argument('old')
+    parser_compare.add_argument('new')
+    parser_compare.add_argument('--threshold', type=float, default=10.0,
+                                help='percentage slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(args.pattern, args.repeat, args.min_time, out=sys.stdout)
+        for name, reason in sorted(results['skipped'].items()):
+            print('%-45s skipped: %s' % (name, reason))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    elif args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows, regressions = compare(old, new, args.threshold / 100.0)
+        for name, before, after, ratio in rows:
+            print('%-45s %12.1f %12.1f %+7.1f%%%s' % (
+                name, before, after, (ratio - 1) * 100, '  REGRESSION' if name in regressions else ''))
+        if regressions:
+            print('%d of %d benchmarks regressed by more than %g%%' % (
+                len(regressions), len(rows), args.threshold))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
@@ -0,0 +1,5 @@
+import sys
+
+from petrel.benchmarks import main
+
+sys.exit(main())
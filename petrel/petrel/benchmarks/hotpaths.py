@@ -0,0 +1,168 @@
+"""Benchmarks for reading tuples from Storm, writing emits and acks, and
+building topologies. See petrel.benchmarks."""
+import io
+
+from petrel import storm
+from petrel.benchmarks import benchmark
+
+# Operations per call of a benchmark's run function.
+BATCH = 1000
+
+SERIALIZERS = ('json', 'msgpack')
+
+# Representative tuple values.
+SIZES = {
+    # A word, as in the word count sample.
+    'small': [u'word'],
+    # A typical record.
+    'medium': [u'user-12345', 1412345678, 3.25, True, u'GET /index.html', None, 200, 5120, u'Mozilla/5.0', u'en-US'],
+    # A document.
+    'large': [u'x' * 1024, list(range(100))],
+}
+
+
+class NullStream(object):
+    """Stands in for Storm's end of the pipe."""
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+
+def get_serializer(name):
+    if name == 'msgpack':
+        if storm.msgpack is None:
+            raise ImportError('msgpack is not installed')
+        return storm.MsgPackSerializer()
+    return storm.JsonSerializer()
+
+
+def tuple_message(i, values):
+    return {'id': str(i), 'comp': u'spout', 'stream': u'default', 'task': 7, 'tuple': values}
+
+
+def input_tuple(values):
+    return storm.Tuple(u'12345678', u'spout', u'default', 7, values)
+
+
+def all_variants(*extra):
+    return [(s, size) + extra for s in SERIALIZERS for size in ('small', 'medium', 'large')]
+
+
+@benchmark('readMsg', *all_variants())
+def read_msg(serializer, size):
+    serializer = get_serializer(serializer)
+    data = b''.join(serializer.encode(tuple_message(i, SIZES[size])) for i in range(BATCH))
+    def run():
+        reader = storm.FrameReader(io.BytesIO(data), serializer)
+        for i in range(BATCH):
+            reader.read_message()
+    return run, BATCH
+
+
+@benchmark('readTuple', *all_variants())
+def read_tuple(serializer, size):
+    serializer = get_serializer(serializer)
+    data = b''.join(serializer.encode(tuple_message(i, SIZES[size])) for i in range(BATCH))
+    def run():
+        reader = storm.FrameReader(io.BytesIO(data), serializer)
+        decode_tuple = serializer.decode_tuple
+        for i in range(BATCH):
+            # Bolts normally read the values, which decodes a LazyTuple.
+            decode_tuple(reader.read_payload()).values
+    return run, BATCH
+
+
+@benchmark('sendMsgToParent', *all_variants())
+def send_msg(serializer, size):
+    serializer = get_serializer(serializer)
+    output = storm.OutputBuffer(NullStream())
+    msg = {'command': 'emit', 'anchors': [u'12345678'], 'tuple': SIZES[size]}
+    def run():
+        for i in range(BATCH):
+            output.write(serializer.encode(msg))
+        output.flush()
+    return run, BATCH
+
+
+@benchmark('emitBolt', *(all_variants(1) + [(s, 'small', n) for s in SERIALIZERS for n in (10, 100)]))
+def emit_bolt(serializer, size, fan_out):
+    """Emits "fan_out" tuples anchored to each input tuple."""
+    collector = storm.OutputCollector(get_serializer(serializer), storm.OutputBuffer(NullStream()))
+    values = SIZES[size]
+    inputs = [input_tuple(values) for i in range(max(1, BATCH // fan_out))]
+    def run():
+        emit = collector.emit
+        for tup in inputs:
+            for j in range(fan_out):
+                emit(values, anchors=[tup])
+        collector.output.flush()
+    return run, len(inputs) * fan_out
+
+
+@benchmark('emitMany', *[(s, 'small', n) for s in SERIALIZERS for n in (10, 100)])
+def emit_many(serializer, size, fan_out):
+    """As emitBolt, using one emitMany() call per input tuple."""
+    collector = storm.OutputCollector(get_serializer(serializer), storm.OutputBuffer(NullStream()))
+    outputs = [SIZES[size]] * fan_out
+    inputs = [input_tuple(SIZES[size]) for i in range(max(1, BATCH // fan_out))]
+    def run():
+        for tup in inputs:
+            collector.emitMany(outputs, anchors=[tup])
+        collector.output.flush()
+    return run, len(inputs) * fan_out
+
+
+@benchmark('ack', *[(s,) for s in SERIALIZERS])
+def ack(serializer):
+    collector = storm.OutputCollector(get_serializer(serializer), storm.OutputBuffer(NullStream()))
+    inputs = [input_tuple([]) for i in range(BATCH)]
+    def run():
+        for tup in inputs:
+            collector.ack(tup)
+        collector.output.flush()
+    return run, BATCH
+
+
+@benchmark('Tuple', ('small',), ('medium',))
+def make_tuple(size):
+    values = SIZES[size]
+    Tuple = storm.Tuple
+    def run():
+        for i in range(BATCH):
+            Tuple(u'12345678', u'spout', u'default', 7, values)
+    return run, BATCH
+
+
+class Component(object):
+    """The parts of a spout or bolt that TopologyBuilder uses."""
+    execution_command = 'python2.7'
+
+    def __init__(self, script):
+        self.script = script
+
+    def declareOutputFields(self):
+        return ['word', 'count']
+
+    def getComponentConfiguration(self):
+        return {'petrel.batch.size': 100}
+
+
+@benchmark('TopologyBuilder.write', (3,), (30,))
+def write_topology(bolts):
+    """Builds and serializes a chain of a spout and "bolts" bolts."""
+    from petrel.topologybuilder import TopologyBuilder
+    def run():
+        builder = TopologyBuilder()
+        builder.setSpout('spout', Component('spout.py'), 1)
+        previous = 'spout'
+        for i in range(bolts):
+            id = 'bolt%d' % i
+            builder.setBolt(id, Component('%s.py' % id), 4).fieldsGrouping(previous, ['word'])
+            previous = id
+        builder.write(io.BytesIO())
+    return run, 1
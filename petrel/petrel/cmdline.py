@@ -13,6 +13,7 @@ import six
 from .util import read_yaml
 from .package import build_jar
 from .status import status
+from .skew import skew
 
 
 def _ensure_str(b):
@@ -120,6 +121,22 @@ def main():
                         help='YAML file with the topology configuration')
     parser_kill.set_defaults(func=kill)
 
+    parser_skew = subparsers.add_parser('skew', help='predict how fields grouping spreads a sample of tuples over tasks')
+    parser_skew.add_argument('--input', dest='input', required=True,
+                        help='sample of the grouped stream: one JSON list of tuple values per line ("-" for stdin)')
+    parser_skew.add_argument('--config', dest='config',
+                        help='YAML file with the topology configuration, for petrel.parallelism settings')
+    parser_skew.add_argument('--definition', dest='definition',
+                        help='python module and function defining the topology (must be in current directory)')
+    parser_skew.add_argument('--component', dest='component', help='only analyze the grouping of this bolt')
+    parser_skew.add_argument('--source', dest='source', help='component that emitted the sample')
+    parser_skew.add_argument('--stream', dest='stream', help='stream of the sample')
+    parser_skew.add_argument('--top', dest='top', type=int, default=10, help='number of heaviest keys to list')
+    parser_skew.add_argument('--max-parallelism', dest='max_parallelism', type=int,
+                        help='highest parallelism to consider (default: 32 or twice the current one)')
+    parser_skew.add_argument('--json', dest='json_output', action='store_true', help='print the report as JSON')
+    parser_skew.set_defaults(func=skew)
+
     try:
         args = parser.parse_args()
         func = args.__dict__.pop('func')
@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod
+import math
 import os
 import sys
 
@@ -37,9 +38,47 @@ class Spout(EmitterBase, storm.Spout):
     __metaclass__ = ABCMeta
 
 
+class PrefetchSpout(EmitterBase, storm.PrefetchSpout):
+    __metaclass__ = ABCMeta
+
+
+class ReliableSpout(EmitterBase, storm.ReliableSpout):
+    __metaclass__ = ABCMeta
+
+
 class BasicBolt(EmitterBase, storm.BasicBolt):
     __metaclass__ = ABCMeta
 
 
 class Bolt(EmitterBase, storm.Bolt):
     __metaclass__ = ABCMeta
+
+
+class BatchBolt(EmitterBase, storm.BatchBolt):
+    __metaclass__ = ABCMeta
+
+    def getComponentConfiguration(self, topology_conf=None):
+        """Adds tick tuples, which let the bolt process a partial batch once
+        it times out, at the rate of the timeout run() will use given the
+        component configuration and "topology_conf"."""
+        conf = dict(topology_conf or {})
+        conf.update(self._json)
+        component_conf = dict(self._json)
+        component_conf.setdefault('topology.tick.tuple.freq.secs',
+                                  max(1, int(math.ceil(self.get_batch_timeout(conf)))))
+        return component_conf
+
+
+class ThreadPoolBolt(EmitterBase, storm.ThreadPoolBolt):
+    __metaclass__ = ABCMeta
+
+
+class ProcessPoolBolt(EmitterBase, storm.ProcessPoolBolt):
+    __metaclass__ = ABCMeta
+
+
+if sys.version_info >= (3, 5):
+    from petrel import asyncbolt
+
+    class AsyncBolt(EmitterBase, asyncbolt.AsyncBolt):
+        __metaclass__ = ABCMeta
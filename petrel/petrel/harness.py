@@ -0,0 +1,369 @@
+"""Runs one spout or bolt module the way Storm's ShellSpout and ShellBolt
+do: as a "python -m petrel.run <module> <log>" subprocess, talking the
+multilang protocol over its stdin and stdout. Unlike petrel.mock, this
+exercises the whole I/O path, so it can measure the task's real throughput
+and latency without a Storm cluster:
+
+    from petrel.harness import Harness
+
+    with Harness('splitsentence', source_fields=['sentence']) as harness:
+        report = harness.run_bolt([['the cow jumped over the moon']] * 10000)
+
+Or from the command line, in the topology directory:
+
+    python -m petrel.harness splitsentence --fields sentence --input sentences.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import six
+
+from petrel import storm
+
+
+class HarnessError(Exception):
+    pass
+
+
+class Harness(object):
+    """Drives the task in "module", which must have a run() function as
+    for "petrel submit". The module is imported from "cwd", by default the
+    current directory.
+
+    "conf" is the topology configuration the task receives. The task is
+    given the id "task_id" of component "component". Its input tuples come
+    from "source_component", whose fields are "source_fields". "serializer"
+    is the multilang serializer's Java class name, as in
+    "topology.multilang.serializer"; the default is JSON. Emits that need
+    task ids are told they went to "target_tasks".
+
+    Emits, logs and errors are counted. If "collect" is True, the emit
+    messages are also kept in "emits". The task's log is written to
+    "log_path", or to a temporary file that close() removes."""
+    def __init__(self, module, conf=None, component='component', task_id=1,
+                 source_component='source', source_fields=None, serializer=None,
+                 target_tasks=(2,), collect=False, python=sys.executable, log_path=None,
+                 cwd=None):
+        self.module = module
+        self.conf = dict(conf or {})
+        if serializer is not None:
+            self.conf['topology.multilang.serializer'] = serializer
+        self.component = component
+        self.task_id = task_id
+        self.source_component = source_component
+        self.source_fields = source_fields
+        self.serializer_name = serializer
+        self.serializer = storm.get_serializer(serializer)
+        self.target_tasks = list(target_tasks)
+        self.collect = collect
+        self.python = python
+        self.log_path = log_path
+        self.cwd = cwd
+        self.process = None
+        self.pid = None
+        self.emits = []
+        self.logs = []
+        self.errors = []
+        self.counts = dict((k, 0) for k in ('tuples', 'emits', 'acks', 'fails', 'heartbeats'))
+        self._dir = None
+        self._write_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        """Launches the task and performs the setup handshake."""
+        self._dir = tempfile.mkdtemp(prefix='petrel-harness-')
+        if self.log_path is None:
+            self.log_path = os.path.join(self._dir, '%s.log' % self.module)
+        env = dict(os.environ)
+        if self.serializer_name is not None:
+            env['PETREL_SERIALIZER'] = self.serializer_name
+        # Run the task with this copy of petrel.
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(storm.__file__)))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        self.process = subprocess.Popen(
+            [self.python, '-m', 'petrel.run', self.module, self.log_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, cwd=self.cwd)
+        self._reader = storm.FrameReader(self.process.stdout, self.serializer)
+
+        context = {
+            'taskid': self.task_id,
+            'componentid': self.component,
+            # Storm sends task ids as string keys, as JSON requires.
+            'task->component': {str(self.task_id): self.component},
+        }
+        if self.source_fields is not None:
+            context['source->stream->fields'] = {self.source_component: {'default': list(self.source_fields)}}
+        self.send({'conf': self.conf, 'context': context, 'pidDir': self._dir})
+        msg = self.read()
+        if not isinstance(msg, dict) or 'pid' not in msg:
+            raise HarnessError('Expected the task to send its pid, got: %r' % (msg,))
+        self.pid = msg['pid']
+
+    def close(self):
+        """Stops the task. Closing stdin alone would make it wait several
+        seconds after reporting the EOF to Storm."""
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir)
+            self._dir = None
+
+    def send(self, msg):
+        data = self.serializer.encode(msg)
+        with self._write_lock:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+    def read(self):
+        """Returns the next message from the task."""
+        try:
+            payload = self._reader.read_payload()
+        except storm.StormIPCException:
+            raise HarnessError('The task exited.%s' % self._log_tail())
+        try:
+            return self.serializer.decode(payload)
+        except Exception:
+            # sendFailureMsgToParent() deliberately sends an invalid message.
+            raise HarnessError('The task failed: %r.%s' % (bytes(payload), self._log_tail()))
+
+    def _log_tail(self, lines=20):
+        try:
+            with open(self.log_path) as f:
+                tail = f.readlines()[-lines:]
+        except (IOError, OSError):
+            return ''
+        return ' The end of its log:\n' + ''.join(tail)
+
+    def _handle(self, msg):
+        """Handles a message that is not specific to spouts or bolts.
+        Returns its command."""
+        if not isinstance(msg, dict):
+            raise HarnessError('Unexpected message from the task: %r' % (msg,))
+        command = msg.get('command')
+        if command == 'emit':
+            self.counts['emits'] += 1
+            if self.collect:
+                self.emits.append(msg)
+            if msg.get('need_task_ids', True):
+                task = msg.get('task')
+                self.send([task] if task is not None else self.target_tasks)
+        elif command == 'log':
+            self.logs.append(msg.get('msg'))
+        elif command == 'error':
+            self.errors.append(msg.get('msg'))
+        return command
+
+    def run_bolt(self, source, max_pending=100, heartbeat_interval=1.0, timeout=None):
+        """Sends each list of values from "source", an iterable, to the bolt
+        as a tuple, with a heartbeat every "heartbeat_interval" seconds, and
+        waits for every tuple to be acked or failed. At most "max_pending"
+        tuples are in flight at once. If "timeout" seconds pass first, the
+        task is killed and HarnessError is raised. Returns report()."""
+        pending = threading.Semaphore(max_pending)
+        # Tuple id -> time sent.
+        sent = {}
+        # "heartbeat" is when the unanswered heartbeat was sent.
+        state = {'sent_all': False, 'error': None, 'heartbeat': None}
+        finished = threading.Event()
+        latency = storm.Histogram()
+        heartbeat_latency = storm.Histogram()
+
+        # Writing from a separate thread means neither side can block the
+        # other by filling a pipe.
+        def write():
+            try:
+                next_heartbeat = time.time() + heartbeat_interval
+                for i, values in enumerate(source):
+                    while not pending.acquire(False):
+                        next_heartbeat = self._heartbeat(state, next_heartbeat, heartbeat_interval)
+                        if finished.wait(0.001):
+                            return
+                    id = str(i)
+                    sent[id] = storm.now_ns()
+                    self.send({'id': id, 'comp': self.source_component, 'stream': 'default',
+                               'task': 1, 'tuple': values})
+                    self.counts['tuples'] += 1
+                    next_heartbeat = self._heartbeat(state, next_heartbeat, heartbeat_interval)
+                state['sent_all'] = True
+                # Keep the heartbeats going until the last tuple completes.
+                while not finished.wait(0.01):
+                    next_heartbeat = self._heartbeat(state, next_heartbeat, heartbeat_interval)
+            except Exception as e:
+                state['error'] = e
+                # Interrupt the read below.
+                self.process.kill()
+
+        writer = threading.Thread(target=write, name='petrel-harness-writer')
+        writer.daemon = True
+        timer = self._start_timer(timeout)
+        started = completed = time.time()
+        writer.start()
+        try:
+            # Also wait for the answer to any heartbeat sent.
+            while (not (state['sent_all'] and not sent) or state['heartbeat'] is not None) \
+                    and state['error'] is None:
+                msg = self.read()
+                command = self._handle(msg)
+                if command in ('ack', 'fail'):
+                    start = sent.pop(msg['id'], None)
+                    if start is not None:
+                        latency.record(storm.now_ns() - start)
+                        pending.release()
+                        completed = time.time()
+                    self.counts['acks' if command == 'ack' else 'fails'] += 1
+                elif command == 'sync':
+                    start, state['heartbeat'] = state['heartbeat'], None
+                    if start is not None:
+                        heartbeat_latency.record(storm.now_ns() - start)
+                    self.counts['heartbeats'] += 1
+            elapsed = completed - started
+        except HarnessError:
+            if timer is not None and timer.expired:
+                raise HarnessError('Timed out after %s seconds' % timeout)
+            if state['error'] is not None:
+                raise state['error']
+            raise
+        finally:
+            finished.set()
+            if timer is not None:
+                timer.cancel()
+        writer.join()
+        if state['error'] is not None:
+            raise state['error']
+        return self.report(elapsed, latency, heartbeat_latency)
+
+    def _heartbeat(self, state, next_heartbeat, interval):
+        now = time.time()
+        if now < next_heartbeat:
+            return next_heartbeat
+        if state['heartbeat'] is None:
+            state['heartbeat'] = storm.now_ns()
+            self.send({'id': '-1', 'comp': None, 'stream': '__heartbeat', 'task': -1, 'tuple': []})
+        return now + interval
+
+    def run_spout(self, count=None, seconds=None, ack=True, timeout=None):
+        """Sends "next" commands until the spout has emitted "count" tuples
+        or "seconds" have passed. Each emitted tuple with an id is acked (or
+        failed, if "ack" is False) before the next "next" command. The
+        latency histogram covers each command's round trip. Returns
+        report()."""
+        if count is None and seconds is None:
+            raise ValueError('Specify count or seconds')
+        latency = storm.Histogram()
+        timer = self._start_timer(timeout)
+        started = time.time()
+        try:
+            while ((count is None or self.counts['emits'] < count) and
+                   (seconds is None or time.time() - started < seconds)):
+                ids = []
+                for command in self._spout_commands(ids, ack):
+                    start = storm.now_ns()
+                    self.send(command)
+                    while True:
+                        msg = self.read()
+                        if self._handle(msg) == 'sync':
+                            break
+                        if msg.get('command') == 'emit' and msg.get('id') is not None:
+                            ids.append(msg['id'])
+                    latency.record(storm.now_ns() - start)
+            elapsed = time.time() - started
+        except HarnessError:
+            if timer is not None and timer.expired:
+                raise HarnessError('Timed out after %s seconds' % timeout)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return self.report(elapsed, latency)
+
+    def _spout_commands(self, ids, ack):
+        yield {'command': 'next'}
+        # "ids" fills up while the response to "next" is read.
+        while ids:
+            self.counts['acks' if ack else 'fails'] += 1
+            yield {'command': 'ack' if ack else 'fail', 'id': ids.pop(0)}
+
+    def _start_timer(self, timeout):
+        if timeout is None:
+            return None
+        def expire():
+            timer.expired = True
+            if self.process is not None:
+                self.process.kill()
+        timer = threading.Timer(timeout, expire)
+        timer.expired = False
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def report(self, elapsed, latency, heartbeat_latency=None):
+        """Returns the counts, the tuples (or emits, for spouts) per second
+        and latency percentiles in microseconds. For bolts, the latency is
+        from sending a tuple to reading its ack or fail."""
+        result = dict(self.counts)
+        count = self.counts['tuples'] or self.counts['emits']
+        result['elapsed_secs'] = elapsed
+        result['tuples_per_sec'] = count / elapsed if elapsed else 0.0
+        result['latency'] = latency.snapshot()
+        if heartbeat_latency is not None:
+            result['heartbeat_latency'] = heartbeat_latency.snapshot()
+        result['errors'] = len(self.errors)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m petrel.harness',
+        description='Run a spout or bolt module over the multilang protocol and report its throughput')
+    parser.add_argument('module', help='module with a run() function, in the current directory')
+    parser.add_argument('--spout', action='store_true', help='the module is a spout')
+    parser.add_argument('--input', help='for bolts: file with one JSON list of tuple values per line')
+    parser.add_argument('--fields', nargs='*', help="for bolts: the input tuples' field names")
+    parser.add_argument('--count', type=int, help='number of tuples to send (bolts) or emit (spouts)')
+    parser.add_argument('--seconds', type=float, help='for spouts: how long to run')
+    parser.add_argument('--serializer', help='multilang serializer class, e.g. storm.petrel.MsgPackSerializer')
+    parser.add_argument('--max-pending', type=int, default=100, help='for bolts: tuples in flight')
+    parser.add_argument('--conf', help='JSON file with the topology configuration')
+    args = parser.parse_args()
+
+    conf = None
+    if args.conf:
+        with open(args.conf) as f:
+            conf = json.load(f)
+    with Harness(args.module, conf=conf, source_fields=args.fields, serializer=args.serializer) as harness:
+        if args.spout:
+            report = harness.run_spout(count=args.count, seconds=args.seconds)
+        else:
+            if not args.input:
+                parser.error('--input is required for bolts')
+            with open(args.input) as f:
+                source = (json.loads(line) for line in f if line.strip())
+                if args.count is not None:
+                    source = (values for i, values in zip(six.moves.range(args.count), source))
+                report = harness.run_bolt(source, max_pending=args.max_pending)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
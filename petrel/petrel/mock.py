@@ -1,6 +1,10 @@
-from collections import deque, defaultdict, namedtuple
+from collections import deque, defaultdict, namedtuple, OrderedDict
+import inspect
+import random
 
-import storm
+import six
+
+from petrel import storm
 
 python_id = id
 
@@ -9,56 +13,303 @@ LIST = 1
 TUPLE = 2
 NAMEDTUPLE = 3
 
+# The Mock of the last run, for component_stats().
+_last_mock = None
+
+_END = object()
+
 class MockSpout(storm.Spout):
+    """Emits the items of "data" in order, one per nextTuple() call. "data"
+    may be any iterable, e.g. a generator reading a sample file; items are
+    only read as they are emitted."""
     def __init__(self, output_fields, data):
         self.output_fields = output_fields
         self.data = data
         self.index = 0
+        self._iter = None
 
     def declareOutputFields(self):
         return self.output_fields
 
     def nextTuple(self):
-        if self.index < len(self.data):
-            storm.emit(self.data[self.index])
+        if self._iter is None:
+            self._iter = iter(self.data)
+        values = next(self._iter, _END)
+        if values is not _END:
+            storm.emit(values)
             self.index += 1
 
+class ComponentStats(object):
+    """Counts and times the calls to one component during a mock run."""
+    def __init__(self, emitter, name):
+        self.emitter = emitter
+        self.name = name
+        self.calls = 0
+        self.tuples = 0
+        self.emitted = 0
+        self.max_fan_out = 0
+        self.process_time = storm.Histogram()
+
+    def record(self, elapsed_ns, tuples, emitted):
+        self.calls += 1
+        self.tuples += tuples
+        self.emitted += emitted
+        self.process_time.record(elapsed_ns)
+        fan_out = emitted // tuples if tuples else emitted
+        if fan_out > self.max_fan_out:
+            self.max_fan_out = fan_out
+
+    def report(self):
+        """Returns the tuples read and emitted, the time spent in the
+        component and the tuples read (emitted, for a spout) per second of
+        that time, percentiles of the time per call, and the tuples emitted
+        per tuple read (per call, for a spout)."""
+        process_secs = self.process_time.total / 1e9
+        count = self.tuples or self.emitted
+        return {
+            'component': self.name,
+            'calls': self.calls,
+            'tuples': self.tuples,
+            'emitted': self.emitted,
+            'process_secs': process_secs,
+            'tuples_per_sec': count / process_secs if process_secs else 0.0,
+            'process_time': self.process_time.snapshot(),
+            'fan_out': float(self.emitted) / (self.tuples or self.calls) if self.calls else 0.0,
+            'max_fan_out': self.max_fan_out,
+        }
+
+
+class MockTuple(storm.Tuple):
+    """A tuple emitted during a mock run. "edges" maps the root id of each
+    tuple tree the tuple belongs to to its edge id in that tree, and
+    "ack_val" is the XOR of the edge ids of the tuples anchored to it."""
+    __slots__ = ['edges', 'ack_val']
+    def __init__(self, id, component, stream, task, values):
+        super(MockTuple, self).__init__(id, component, stream, task, values)
+        self.edges = None
+        self.ack_val = 0
+
+class Acker(object):
+    """Tracks tuple trees as Storm's acker does. A spout tuple emitted with
+    an id starts a tree with a random 64 bit root id. Each tuple in the tree
+    gets a random edge id, which is XORed into the tree's value once when
+    the tuple is emitted and once when it is acked, so the value returns to
+    zero when every tuple has been acked. A tree fails when any of its
+    tuples is failed, or when it is not complete within "timeout"
+    seconds."""
+    def __init__(self, timeout=30.0, seed=0):
+        self.timeout_ns = int(timeout * 1e9)
+        self.random = random.Random(seed)
+        # root id -> [value, start time, spout, message id], oldest first.
+        self.trees = OrderedDict()
+        # (spout, message id, acked) for the spout, in completion order.
+        self.done = deque()
+        # Message ids of failed trees, to count replays.
+        self.failed_ids = set()
+        self.complete_latency = storm.Histogram()
+        self.acked = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.replayed = 0
+
+    def _new_id(self):
+        return self.random.getrandbits(64) or 1
+
+    def emit_spout(self, spout, msg_id, tup, has_consumers=True):
+        """Starts the tree of a spout tuple emitted with id "msg_id"."""
+        if msg_id in self.failed_ids:
+            self.failed_ids.discard(msg_id)
+            self.replayed += 1
+        if not has_consumers:
+            # Storm acks a tuple nobody receives right away.
+            self.acked += 1
+            self.complete_latency.record(0)
+            self.done.append((spout, msg_id, True))
+            return
+        root = self._new_id()
+        edge = self._new_id()
+        tup.edges = {root: edge}
+        self.trees[root] = [edge, storm.now_ns(), spout, msg_id]
+
+    def emit_bolt(self, tup, anchors):
+        """Adds "tup", anchored to "anchors", to their trees."""
+        edges = None
+        for anchor in anchors:
+            anchor_edges = anchor.edges if isinstance(anchor, MockTuple) else None
+            if not anchor_edges:
+                continue
+            edge = self._new_id()
+            anchor.ack_val ^= edge
+            if edges is None:
+                edges = {}
+            for root in anchor_edges:
+                edges[root] = edges.get(root, 0) ^ edge
+        tup.edges = edges
+
+    def ack(self, tup):
+        edges = tup.edges if isinstance(tup, MockTuple) else None
+        if not edges:
+            return
+        tup.edges = None
+        ack_val = tup.ack_val
+        for root, edge in six.iteritems(edges):
+            tree = self.trees.get(root)
+            # The tree may already have failed.
+            if tree is None:
+                continue
+            tree[0] ^= edge ^ ack_val
+            if not tree[0]:
+                del self.trees[root]
+                self.acked += 1
+                self.complete_latency.record(storm.now_ns() - tree[1])
+                self.done.append((tree[2], tree[3], True))
+
+    def fail(self, tup):
+        edges = tup.edges if isinstance(tup, MockTuple) else None
+        if not edges:
+            return
+        tup.edges = None
+        for root in edges:
+            tree = self.trees.pop(root, None)
+            if tree is not None:
+                self.failed += 1
+                self._fail_tree(tree)
+
+    def expire(self, now=None):
+        """Fails the trees older than the timeout."""
+        if now is None:
+            now = storm.now_ns()
+        trees = self.trees
+        while trees:
+            root = next(iter(trees))
+            tree = trees[root]
+            if now - tree[1] < self.timeout_ns:
+                break
+            del trees[root]
+            self.timed_out += 1
+            self._fail_tree(tree)
+
+    def _fail_tree(self, tree):
+        self.failed_ids.add(tree[3])
+        self.done.append((tree[2], tree[3], False))
+
+    def report(self):
+        """Returns the number of trees acked, failed by a bolt, timed out
+        and still pending, the number of spout tuples re-emitted with the
+        id of a failed tree, and percentiles of the complete latency."""
+        return {
+            'acked': self.acked,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'pending': len(self.trees),
+            'replayed': self.replayed,
+            'complete_latency': self.complete_latency.snapshot(),
+        }
+
 class Mock(object):
     def __init__(self):
         self.output_type = {}
         self.pending = defaultdict(deque)
         self.processed = defaultdict(deque)
         self.emitter = None
+        # Used to decode the values passed to emitEncoded().
+        self.serializer = storm.SERIALIZER
+        # If false, tuples read by the next component are not kept in
+        # "processed".
+        self.keep_processed = True
+        # emitter_id() -> ComponentStats
+        self.emitter_stats = {}
+        self.acker = Acker()
+        # emitter_id() of components whose output nobody receives. Their
+        # tuples are not added to tuple trees.
+        self.sinks = set()
+        # If set, overrides the anchors passed to emit(), as for
+        # storm.OutputCollector.
+        self.anchors = None
+        # The tuple being processed by a ThreadPoolBolt or AsyncBolt, which
+        # ack() and fail() apply to when not passed a tuple.
+        self.current = None
     
     def __enter__(self):
+        global _last_mock
+        _last_mock = self
         self.old_emit = storm.emit
         storm.emit = self.emit
         self.old_emitMany = storm.emitMany
         storm.emitMany = self.emitMany
+        self.old_collector = storm.collector
+        # Each run starts with fresh metric values. See metric_values().
+        storm.metrics.clear()
         return self
 
     def __exit__(self, type, value, traceback):
         storm.emit = self.old_emit
         storm.emitMany = self.old_emitMany
+        storm.collector = self.old_collector
     
     def activate(self, emitter):
         self.emitter = emitter
         if isinstance(emitter, storm.Spout):
             storm.MODE = storm.Spout
-        elif isinstance(emitter, (storm.Bolt, storm.BasicBolt)):
+        elif isinstance(emitter, (storm.Bolt, storm.BasicBolt, storm.BatchBolt, storm.ThreadPoolBolt)) or _is_async(emitter):
             storm.MODE = storm.Bolt
         else:
             assert False, "Neither a spout nor a bolt!"
+        # The mock also stands in for the task's OutputCollector.
+        emitter.collector = storm.collector = self
+        # Let the next component access the emitter's fields by name.
+        declare = getattr(emitter, 'declareOutputFields', None)
+        if declare is not None:
+            fields = declare()
+            storm.set_schema(self.component_id(emitter), None, fields)
+            storm.set_schema(self.component_id(emitter), 'default', fields)
     
     def emit(self, *args, **kwargs):
-        self.__emit(*args, **kwargs)
-        #return readTaskIds()
+        return self.__emit(*args, **kwargs)
+
+    def emitDirect(self, task, *args, **kwargs):
+        kwargs['directTask'] = task
+        return self.__emit(*args, **kwargs)
+
+    # The mock is also passed to AsyncBolt.process() and
+    # ThreadPoolBolt.process() as the tuple's collector, whose ack() and
+    # fail() take no arguments.
+    def ack(self, tup=None):
+        self.acker.ack(self.current if tup is None else tup)
+
+    def fail(self, tup=None):
+        self.acker.fail(self.current if tup is None else tup)
+
+    def ackMany(self, tuples):
+        for tup in tuples:
+            self.acker.ack(tup)
+
+    def failMany(self, tuples):
+        for tup in tuples:
+            self.acker.fail(tup)
+
+    def deliver_acks(self):
+        """Fails the tuple trees that have timed out, then calls the spout's
+        ack() or fail() for each tree completed or failed since the last
+        call. Returns the number of calls."""
+        acker = self.acker
+        acker.expire()
+        done = acker.done
+        n = len(done)
+        while done:
+            spout, msg_id, acked = done.popleft()
+            self.activate(spout)
+            if acked:
+                spout.ack(msg_id)
+            else:
+                spout.fail(msg_id)
+        return n
     
     def __emit(self, *args, **kwargs):
         if storm.MODE == storm.Bolt:
-            self.emitBolt(*args, **kwargs)
+            return self.emitBolt(*args, **kwargs)
         elif storm.MODE == storm.Spout:
-            self.emitSpout(*args, **kwargs)
+            return self.emitSpout(*args, **kwargs)
 
     def emitMany(self, *args, **kwargs):
         if storm.MODE == storm.Bolt:
@@ -66,13 +317,22 @@ class Mock(object):
         elif storm.MODE == storm.Spout:
             self.emitManySpout(*args, **kwargs)
 
-    def emitManyBolt(self, tuples, stream=None, anchors = [], directTask=None):
-        for t in tuples:
-            self.emitBolt(t, stream, anchors, directTask)
+    def emitManyBolt(self, tuples, stream=None, anchors = [], directTask=None, need_task_ids=False):
+        for t, kwargs in storm.iter_emit_many(tuples, stream=stream, anchors=anchors, directTask=directTask):
+            self.emitBolt(t, **kwargs)
     
-    def emitManySpout(self, tuples, stream=None, anchors = [], directTask=None):
-        for t in tuples:
-            self.emitSpout(t, stream, id, directTask)
+    def emitManySpout(self, tuples, stream=None, id=None, directTask=None, need_task_ids=False):
+        for t, kwargs in storm.iter_emit_many(tuples, stream=stream, id=id, directTask=directTask):
+            self.emitSpout(t, **kwargs)
+
+    def emitEncoded(self, values, stream=None, id=None):
+        self.emitSpout(self.serializer.decode(values), stream=stream, id=id)
+
+    def component_id(self, emitter=None):
+        """The component name given to the emitter's tuples."""
+        if emitter is None:
+            emitter = self.emitter
+        return type(emitter).__name__
 
     def emitter_id(self, emitter=None):
         if emitter is None:
@@ -82,20 +342,122 @@ class Mock(object):
     def emitBolt(self, tup, stream=None, anchors = [], directTask=None):
         # Nice idea, but throws off profiling
         #assert len(tup) == len(self.emitter.declareOutputFields())
-        # TODO: We should probably be capturing "anchors" so tests can verify
-        # the topology is anchoring output tuples correctly.
-        self.pending[self.emitter_id()].append(storm.Tuple(id=None, component=None, stream=stream, task=directTask, values=tup))
+        if isinstance(tup, storm.Tuple):
+            # Re-emitting an input tuple.
+            tup = list(tup.values)
+        emitter_id = self.emitter_id()
+        result = MockTuple(id=None, component=self.component_id(), stream=stream, task=directTask, values=tup)
+        if self.anchors is not None:
+            anchors = self.anchors
+        if anchors and emitter_id not in self.sinks:
+            self.acker.emit_bolt(result, anchors)
+        self.pending[emitter_id].append(result)
         
     def emitSpout(self, tup, stream=None, id=None, directTask=None):
         # Nice idea, but throws off profiling
         #assert len(tup) == len(self.emitter.declareOutputFields())
-        self.pending[self.emitter_id()].append(storm.Tuple(id=id, component=None, stream=stream, task=directTask, values=tup))
+        emitter_id = self.emitter_id()
+        result = MockTuple(id=id, component=self.component_id(), stream=stream, task=directTask, values=tup)
+        if id is not None:
+            self.acker.emit_spout(self.emitter, id, result, emitter_id not in self.sinks)
+        self.pending[emitter_id].append(result)
 
     def read(self, source_emitter):
         emitter_id = self.emitter_id(source_emitter)
         result = self.pending[emitter_id].popleft()
-        self.processed[emitter_id].append(result)
+        if self.keep_processed:
+            self.processed[emitter_id].append(result)
         return result
+
+    def get_stats(self, emitter):
+        emitter_id = self.emitter_id(emitter)
+        stats = self.emitter_stats.get(emitter_id)
+        if stats is None:
+            stats = self.emitter_stats[emitter_id] = ComponentStats(emitter, self.component_id(emitter))
+        return stats
+
+    def component_stats(self):
+        """Returns {emitter: ComponentStats.report()} for the components
+        run so far."""
+        return dict((stats.emitter, stats.report()) for stats in six.itervalues(self.emitter_stats))
+
+    def next_tuple(self, spout):
+        """Calls spout.nextTuple(). Returns the number of tuples emitted."""
+        self.activate(spout)
+        output = self.pending[self.emitter_id(spout)]
+        before = len(output)
+        start = storm.now_ns()
+        spout.nextTuple()
+        elapsed = storm.now_ns() - start
+        emitted = len(output) - before
+        self.get_stats(spout).record(elapsed, 0, emitted)
+        return emitted
+
+    def process(self, bolt, previous, loop=None, flush=True):
+        """Passes the pending tuples emitted by "previous" to "bolt". A
+        BatchBolt is passed full batches, then, if "flush" is true, one
+        final partial batch. Asynchronous bolts run in the asyncio event
+        loop "loop", or in a new one."""
+        pending = self.pending[self.emitter_id(previous)]
+        if isinstance(bolt, storm.BatchBolt):
+            conf = getattr(bolt, 'conf', None) or {}
+            batch_size = int(conf.get('petrel.batch.size', bolt.batch_size))
+            if not pending or not flush and len(pending) < batch_size:
+                return
+        elif not pending:
+            return
+        self.activate(bolt)
+        output = self.pending[self.emitter_id(bolt)]
+        stats = self.get_stats(bolt)
+        now_ns = storm.now_ns
+        new_loop = None
+        try:
+            while pending:
+                before = len(output)
+                if isinstance(bolt, storm.BatchBolt):
+                    if not flush and len(pending) < batch_size:
+                        break
+                    batch = [self.read(previous) for j in range(min(batch_size, len(pending)))]
+                    start = now_ns()
+                    # Anchors the emits to the batch and acks it.
+                    bolt.run_batch(batch)
+                    tuples = len(batch)
+                elif isinstance(bolt, storm.ThreadPoolBolt) or _is_async(bolt):
+                    tup = self.read(previous)
+                    self.current = tup
+                    self.anchors = (tup,)
+                    start = now_ns()
+                    try:
+                        if isinstance(bolt, storm.ThreadPoolBolt):
+                            bolt.process(tup, self)
+                        else:
+                            if loop is None:
+                                import asyncio
+                                loop = new_loop = asyncio.new_event_loop()
+                            loop.run_until_complete(bolt.process(tup, self))
+                    except storm.FailedException:
+                        self.fail(tup)
+                    else:
+                        if getattr(bolt, 'auto_ack', True):
+                            self.ack(tup)
+                    tuples = 1
+                elif isinstance(bolt, storm.BasicBolt):
+                    tup = self.read(previous)
+                    self.anchors = (tup,)
+                    start = now_ns()
+                    bolt.process(tup)
+                    self.ack(tup)
+                    tuples = 1
+                else:
+                    tup = self.read(previous)
+                    start = now_ns()
+                    bolt.process(tup)
+                    tuples = 1
+                stats.record(now_ns() - start, tuples, len(output) - before)
+        finally:
+            self.anchors = self.current = None
+            if new_loop is not None:
+                new_loop.close()
     
     def get_output_type(self, emitter):
         emitter_id = self.emitter_id(emitter)
@@ -104,6 +466,35 @@ class Mock(object):
             
         return self.output_type[emitter_id]
 
+    def result_maker(self, result_type):
+        """Returns a function (storm tuple, emitter) -> result of type
+        "result_type"."""
+        def make_storm_tuple(t, emitter):
+            return t
+        
+        def make_python_list(t, emitter):
+            return list(t.values)
+        
+        def make_named_tuple(t, emitter):
+            return self.get_output_type(emitter)(*t.values)
+
+        if result_type == STORM_TUPLE:
+            return make_storm_tuple
+        elif result_type == LIST:
+            return make_python_list
+        elif result_type == NAMEDTUPLE:
+            return make_named_tuple
+        else:
+            assert False, 'Invalid result type specified: %s' % result_type
+
+    def configure(self, config, emitters):
+        """Sets up tuple tree tracking for a simple topology: the output of
+        the last of "emitters" is not received by any component, and trees
+        time out after "topology.message.timeout.secs" in "config"."""
+        self.sinks = set([self.emitter_id(emitters[-1])])
+        if config is not None and 'topology.message.timeout.secs' in config:
+            self.acker = Acker(float(config['topology.message.timeout.secs']))
+
     @classmethod
     def run_simple_topology(cls, config, emitters, result_type=NAMEDTUPLE, max_spout_emits=None):
         """Tests a simple topology. "Simple" means there it has no branches
@@ -115,53 +506,111 @@ class Mock(object):
         # same components. This can be useful for testing spout ack() and fail()
         # behavior.
         if config is not None:
-            for emitter in emitters:
-                emitter.initialize(config, {})
+            _initialize(config, emitters)
 
         with cls() as self:
+            self.configure(config, emitters)
             # Read from the spout.
             spout = emitters[0]
             spout_id = self.emitter_id(spout)
-            old_length = -1
             length = len(self.pending[spout_id])
-            while length > old_length and (max_spout_emits is None or length < max_spout_emits):
-                old_length = length 
-                self.activate(spout)
-                spout.nextTuple()
+            while max_spout_emits is None or length < max_spout_emits:
+                if not self.next_tuple(spout):
+                    break
                 length = len(self.pending[spout_id])
 
             # For each bolt in the sequence, consume all upstream input.
             for i, bolt in enumerate(emitters[1:]):
-                previous = emitters[i]
-                self.activate(bolt)
-                while len(self.pending[self.emitter_id(previous)]) > 0:
-                    bolt.process(self.read(previous))
+                self.process(bolt, emitters[i])
 
-        def make_storm_tuple(t, emitter):
-            return t
-        
-        def make_python_list(t, emitter):
-            return list(t.values)
-        
-        def make_python_tuple(t, emitter):
-            return tuple(t.values)
-
-        def make_named_tuple(t, emitter):
-            return self.get_output_type(emitter)(*t.values)
-
-        if result_type == STORM_TUPLE:
-            make = make_storm_tuple
-        elif result_type == LIST:
-            make = make_python_list
-        elif result_type == NAMEDTUPLE:
-            make = make_named_tuple
-        else:
-            assert False, 'Invalid result type specified: %s' % result_type
+            # Call the spout's ack() and fail(). Tuples the spout emits
+            # from fail() are not processed; run again to replay them.
+            self.deliver_acks()
 
+        make = self.result_maker(result_type)
         result_values = \
             [ [ make(t, emitter) for t in self.processed[self.emitter_id(emitter)]] for emitter in emitters[:-1] ] + \
             [ [ make(t, emitters[-1]) for t in self.pending[self.emitter_id(emitters[-1])] ] ]
         return dict((k, v) for k, v in zip(emitters, result_values))
+
+    @classmethod
+    def stream_simple_topology(cls, config, emitters, callback, result_type=NAMEDTUPLE, max_spout_emits=None):
+        """Runs a simple topology like run_simple_topology(), but passes each
+        tuple the spout emits down the whole chain before asking the spout
+        for the next one, and passes each tuple the last component emits
+        to "callback" instead of keeping it. Memory use therefore does not
+        grow with the input, so a MockSpout can stream a large sample file.
+        The spout's ack() and fail() are called before each nextTuple()
+        call, and the run continues while the spout emits, so tuples it
+        replays after fail() are processed too. Returns component_stats()."""
+        if config is not None:
+            _initialize(config, emitters)
+
+        loop = None
+        if any(_is_async(emitter) for emitter in emitters):
+            import asyncio
+            loop = asyncio.new_event_loop()
+        try:
+            with cls() as self:
+                self.configure(config, emitters)
+                self.keep_processed = False
+                make = self.result_maker(result_type)
+                spout = emitters[0]
+                last = emitters[-1]
+                output = self.pending[self.emitter_id(last)]
+                emitted = 0
+                flush = False
+                while True:
+                    self.deliver_acks()
+                    if max_spout_emits is None or emitted < max_spout_emits:
+                        n = self.next_tuple(spout)
+                        emitted += n
+                    else:
+                        n = 0
+                    # Once the spout is done, flush partial batches.
+                    flush = not n
+                    for i, bolt in enumerate(emitters[1:]):
+                        self.process(bolt, emitters[i], loop, flush)
+                    while output:
+                        callback(make(output.popleft(), last))
+                    # The spout may replay tuples failed during the flush.
+                    if flush and not self.acker.done:
+                        break
+        finally:
+            if loop is not None:
+                loop.close()
+        return self.component_stats()
         
+def _initialize(config, emitters):
+    """Initializes "emitters" with "config", which, as in Storm, is also
+    available to them as "self.conf"."""
+    for emitter in emitters:
+        emitter.conf = config
+        emitter.initialize(config, {})
+
+def _is_async(emitter):
+    # True for petrel.asyncbolt.AsyncBolt. inspect.iscoroutinefunction()
+    # does not exist before Python 3.5.
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    return iscoroutinefunction is not None and iscoroutinefunction(getattr(emitter, 'process', None))
+
+def metric_values():
+    """Returns the values of the metrics in storm.metrics recorded since the
+    last Mock started."""
+    return storm.metrics.values()
+
+def component_stats():
+    """Returns the per component stats of the last mock run. See
+    ComponentStats.report()."""
+    return _last_mock.component_stats() if _last_mock is not None else {}
+
+def acker_stats():
+    """Returns the tuple tree stats of the last mock run. See
+    Acker.report()."""
+    return _last_mock.acker.report() if _last_mock is not None else Acker().report()
+
 def run_simple_topology(*l, **kw):
     return Mock.run_simple_topology(*l, **kw)
+
+def stream_simple_topology(*l, **kw):
+    return Mock.stream_simple_topology(*l, **kw)
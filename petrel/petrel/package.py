@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import io
+import json
 import os
 import sys
 import shutil
@@ -14,6 +15,8 @@ from itertools import chain
 
 import six
 
+from .emitter import BatchBolt
+from .storm import MsgPackSerializer
 from .topologybuilder import TopologyBuilder
 from .util import read_yaml
 
@@ -87,6 +90,8 @@ def build_jar(source_jar_path, dest_jar_path, config, venv=None, definition=None
 
     pip_options = config_yaml.get('petrel.pip_options', '')
 
+    serializer = config_yaml.get('topology.multilang.serializer', '')
+
     module_name, dummy, function_name = definition.rpartition('.')
     
     topology_dir = os.getcwd()
@@ -145,6 +150,11 @@ petrel.host: %s
                 # virtualenv set up with the necessary libraries.
                 v.execution_command = os.path.join(venv, 'bin/python')
 
+            # The tick rate of a BatchBolt depends on its batch timeout,
+            # which the configuration YAML may set.
+            if isinstance(v, BatchBolt):
+                builder._commons[k].json_conf = json.dumps(v.getComponentConfiguration(config_yaml))
+
             # If a parallelism value was specified in the configuration YAML,
             # override any setting provided in the topology definition script.
             if k in parallelism:
@@ -152,7 +162,7 @@ petrel.host: %s
 
             v.execution_command, v.script = \
                 intercept(venv, v.execution_command, os.path.splitext(v.script)[0],
-                          jar, pip_options, logdir)
+                          jar, pip_options, logdir, serializer)
 
         if len(parallelism):
             raise ValueError(
@@ -172,9 +182,18 @@ petrel.host: %s
             sys.path[:] = sys.path[1:]
 
 
-def intercept(venv, execution_command, script, jar, pip_options, logdir):
+def intercept(venv, execution_command, script, jar, pip_options, logdir, serializer=''):
     #create_virtualenv = 1 if execution_command == EmitterBase.DEFAULT_PYTHON else 0
     create_virtualenv = 1 if venv is None else 0
+    # The binary serializer needs msgpack on the worker. Install the same
+    # version we have locally, as we do for Thrift.
+    extra_packages = ''
+    if serializer == MsgPackSerializer.name:
+        msgpack_version = pkg_resources.get_distribution('msgpack').version
+        # Older versions cannot decode the Long map keys Storm sends.
+        if pkg_resources.parse_version(msgpack_version) < pkg_resources.parse_version('0.6.1'):
+            raise ValueError('%s requires msgpack 0.6.1 or later, found %s' % (serializer, msgpack_version))
+        extra_packages = 'msgpack==%s' % msgpack_version
     script_base_name = os.path.splitext(script)[0]
     intercept_script = 'setup_%s.sh' % script_base_name
 
@@ -275,7 +294,7 @@ if [[ "$unamestr" != 'Darwin' ]]; then
             # This may not matter since Petrel only uses Thrift for topology build
             # and submission, but I've had some odd version problems with Thrift
             # and Storm/Java so I want to be safe.
-            for f in thrift==%(thrift_version)s PyYAML==3.10
+            for f in thrift==%(thrift_version)s PyYAML==3.10 %(extra_packages)s
             do
                 echo "Installing $f" >>$VENV_LOG 2>&1
                 pip install %(pip_options)s $f >>$VENV_LOG 2>&1
@@ -329,6 +348,8 @@ fi
 
 ELAPSED=$(($SECONDS-$START))
 echo "Task setup took $ELAPSED seconds" >>$LOG 2>&1
+# Tells petrel.storm which multilang serializer the Storm worker uses.
+export PETREL_SERIALIZER=%(serializer)s
 echo "Launching: python -m petrel.run $SCRIPT $LOG" >>$LOG 2>&1
 # We use exec to avoid creating another process. Creating a second process is
 # not only less efficient but also confuses the way Storm monitors processes.
@@ -343,6 +364,8 @@ exec python -m petrel.run $SCRIPT $LOG
         thrift_version=pkg_resources.get_distribution("thrift").version,
         petrel_version=pkg_resources.get_distribution("petrel").version,
         pip_options=pip_options,
+        extra_packages=extra_packages,
+        serializer=serializer,
     ))
 
     return '/bin/bash', intercept_script
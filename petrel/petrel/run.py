@@ -2,10 +2,19 @@ from __future__ import print_function
 
 import os
 import sys
+import time
+import atexit
+import signal
 import socket
+import cProfile
+import functools
+import threading
+import multiprocessing.util
 import logging.config
 import traceback
 
+from six.moves import queue
+
 from petrel import storm
 
 LOG_CONFIG_FILE = 'logconfig.ini'
@@ -48,32 +57,270 @@ def log_config():
     
     if os.path.exists(LOG_CONFIG_FILE):
         logging.config.fileConfig(LOG_CONFIG_FILE)
+        if os.environ.get('PETREL_ASYNC_LOGGING', '1') not in ('', '0'):
+            start_async_logging()
+
+
+class LogQueue(object):
+    """Hands log records to a background thread, which passes them to the
+    handlers logconfig.ini set up. Writing to files or syslog then no
+    longer blocks the task. If the thread falls more than "capacity"
+    records behind, further records are dropped and counted rather than
+    blocking; the count is logged once the thread catches up.
+
+    Processes forked by multiprocessing, e.g. ProcessPoolBolt's pool, do
+    not inherit the thread, so they get the loggers' own handlers back."""
+    def __init__(self, capacity=10000):
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0
+        self.thread = None
+        self.replaced = []
+
+    def replace_handlers(self, logger):
+        """Moves the logger's handlers, except StormHandlers, behind the
+        queue."""
+        handlers = [h for h in logger.handlers if not isinstance(h, StormHandler)]
+        if handlers:
+            logger.handlers = [h for h in logger.handlers if isinstance(h, StormHandler)]
+            logger.addHandler(QueueHandler(self, handlers))
+            self.replaced.append((logger, handlers))
+
+    def restore_handlers(self):
+        """Undoes replace_handlers()."""
+        for logger, handlers in self.replaced:
+            logger.handlers = [h for h in logger.handlers
+                               if not (isinstance(h, QueueHandler) and h.log_queue is self)] + handlers
+        self.replaced = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='petrel-logging')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+        multiprocessing.util.register_after_fork(self, LogQueue._after_fork)
+
+    def _after_fork(self):
+        self.thread = None
+        self.restore_handlers()
+
+    def stop(self, timeout=5.0):
+        """Writes the queued records and stops the thread."""
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+
+    def put(self, handlers, record):
+        try:
+            self.queue.put_nowait((handlers, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            handlers, record = item
+            self._handle(handlers, record)
+            if self.dropped and self.queue.empty():
+                dropped, self.dropped = self.dropped, 0
+                self._handle(handlers, logging.makeLogRecord({
+                    'name': 'petrel.run', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Dropped %d log records because the logging queue was full' % dropped}))
+
+    def _handle(self, handlers, record):
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+
+class QueueHandler(logging.Handler):
+    """Stands in for a logger's handlers, sending its records to them
+    through a LogQueue."""
+    def __init__(self, log_queue, handlers):
+        super(QueueHandler, self).__init__(min(h.level for h in handlers))
+        self.log_queue = log_queue
+        self.handlers = handlers
+
+    def emit(self, record):
+        # The arguments may change once we return, e.g. if they include a
+        # list the task keeps using, so render the message now.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.log_queue.put(self.handlers, record)
+
+
+log_queue = None
+
+
+def start_async_logging(capacity=10000):
+    """Moves the handlers of the root logger and every configured logger
+    behind a single LogQueue. StormHandler stays synchronous, since it
+    writes to Storm through the task's output buffer."""
+    global log_queue
+    if log_queue is not None:
+        return log_queue
+    log_queue = LogQueue(capacity)
+    loggers = [logging.getLogger()] + [
+        l for l in logging.Logger.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+    for logger in loggers:
+        log_queue.replace_handlers(logger)
+    log_queue.start()
+    return log_queue
 
 
 # This code is still a work in progress. It may have bugs that cause
 # topologies to be unstable. I've seen it cause ShellSpout.querySubprocess()
 # in Java to receive a JSONObject with a null "command" value.
 class StormHandler(logging.Handler):
-    def __init__(self, *l, **kw):
-        super(StormHandler, self).__init__(*l, **kw)
+    """Sends log records to Storm's log with "log" commands. Records are
+    buffered and sent together in one command once "capacity" records are
+    waiting, "flush_interval" seconds after the first of them, or at once
+    for records at "flush_level" or above. The interval is checked when
+    records arrive and whenever the task syncs, i.e. on every heartbeat and
+    spout command, so records are sent even if no more follow."""
+    def __init__(self, level=logging.NOTSET, capacity=100, flush_interval=1.0, flush_level=logging.ERROR):
+        super(StormHandler, self).__init__(level)
         hostname = socket.gethostname().split('.')[0]
         script_name = os.getenv('SCRIPT') # Should be passed by setup_*.sh.
         if script_name is None:
             script_name = '<unknown>'
         process_id = os.getpid()
         self.format_string = '[%s][%s][%d] %%s' % (hostname, script_name, process_id)
-    
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.lines = []
+        self.records = 0
+        self.deadline = None
+        storm.sync_hooks.append(self.flush_due)
+
     def emit(self, record):
         msg = self.format(record)
-        for line in msg.split('\n'):
-            formatted_line = self.format_string % line
-            #print >> sys.stderr, "Calling storm.log with: %s" % formatted_line
-            storm.log('%s' % formatted_line)
+        format_string = self.format_string
+        self.lines.extend(format_string % line for line in msg.split('\n'))
+        self.records += 1
+        if self.deadline is None:
+            self.deadline = time.time() + self.flush_interval
+        if (self.records >= self.capacity or record.levelno >= self.flush_level
+                or time.time() >= self.deadline):
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            msg = '\n'.join(self.lines)
+            del self.lines[:]
+            self.records = 0
+            self.deadline = None
+            storm.log(msg)
+
+    def flush_due(self):
+        """Flushes the buffered records if the interval has passed."""
+        if self.deadline is not None and time.time() >= self.deadline:
+            # sync() may run on the reader thread.
+            self.acquire()
+            try:
+                self.flush()
+            finally:
+                self.release()
+
+    def close(self):
+        if self.flush_due in storm.sync_hooks:
+            storm.sync_hooks.remove(self.flush_due)
+        try:
+            self.flush()
+        finally:
+            super(StormHandler, self).close()
 
 # Comment this out until logging to Storm proves to be stable.
 #logging.StormHandler = StormHandler
 
 
+# Sending this signal to a task starts or stops profiling it. SIGUSR1 is
+# used by rdebug.
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR2', None)
+
+profiler = None
+_profile_timer = None
+
+
+def start_profile(duration=None):
+    """Starts profiling the main thread with cProfile. If "duration" is
+    given, profiling stops by itself after that many seconds."""
+    global profiler, _profile_timer
+    if profiler is not None:
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    log = logging.getLogger('petrel.run')
+    log.info('Started profiling%s', ' for %s seconds' % duration if duration else '')
+    if duration:
+        # Profiling can only be stopped from the main thread, so the timer
+        # leaves that to it rather than calling stop_profile().
+        _profile_timer = threading.Timer(
+            duration, storm.main_thread_calls.append, [functools.partial(_stop_timed_profile, profiler)])
+        _profile_timer.daemon = True
+        _profile_timer.start()
+
+
+def _stop_timed_profile(timed_profiler):
+    if profiler is timed_profiler:
+        stop_profile()
+
+
+def stop_profile():
+    """Stops profiling and writes the statistics to a .pstats file next to
+    the log file. Returns the file's path."""
+    global profiler, _profile_timer
+    if profiler is None:
+        return None
+    profiler.disable()
+    if _profile_timer is not None:
+        _profile_timer.cancel()
+        _profile_timer = None
+    path = '%s.%d.%s.pstats' % (
+        os.path.splitext(log_file_path)[0], os.getpid(), time.strftime('%Y%m%d-%H%M%S'))
+    profiler.dump_stats(path)
+    profiler = None
+    logging.getLogger('petrel.run').info('Wrote profile to %s', path)
+    return path
+
+
+def _toggle_profile():
+    if profiler is None:
+        duration = float(os.environ.get('PETREL_PROFILE_SECS', 0))
+        start_profile(duration or None)
+    else:
+        stop_profile()
+
+
+def toggle_profile(sig, frame):
+    # The signal may arrive while the main thread holds a lock that logging
+    # needs, e.g. the log queue's, so the main thread toggles profiling
+    # before it reads its next tuple or command.
+    storm.main_thread_calls.append(_toggle_profile)
+
+
+def install_profile_handler():
+    """Makes PROFILE_SIGNAL toggle profiling, which happens when the task
+    next reads a tuple or command. If the PETREL_PROFILE_SECS environment
+    variable is set, each profile stops after that many seconds. View the output with, e.g.:
+    python -m pstats <log file>.<pid>.<time>.pstats"""
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, toggle_profile)
+
+
 def main():
     if len(sys.argv) != 3:
         print("Usage: %s <module> <log file>" % os.path.splitext(os.path.basename(sys.argv[0]))[0], file=sys.stderr)
@@ -100,6 +347,7 @@ def main():
         log_initialized = True
         
         storm.initialize_profiling()
+        install_profile_handler()
         
         sys.path[:0] = [ os.getcwd() ]
         module = __import__(module_name)
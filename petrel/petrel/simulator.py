@@ -0,0 +1,463 @@
+"""Runs a whole topology in one Python process, without Storm. Unlike
+mock.run_simple_topology(), the topology may branch, each component runs as
+many tasks as its parallelism hint, and tuples are routed between tasks by
+the declared groupings:
+
+    from petrel.simulator import Simulator
+    import create
+
+    sim = Simulator.from_create(create.create, config)
+    sim.run(max_spout_emits=100000)
+    print(sim.stats())
+
+Stages are interleaved: spouts are only asked for more tuples while fewer
+than "max_queued" tuples are waiting for bolts, so memory stays bounded
+however much data the spouts produce."""
+from collections import deque, defaultdict
+import copy
+import random
+import struct
+import time
+
+import six
+
+from petrel import storm
+from petrel.mock import Mock, _is_async
+
+python_id = id
+
+
+def _int32(h):
+    h &= 0xFFFFFFFF
+    return h - 0x100000000 if h & 0x80000000 else h
+
+
+def java_hash(value):
+    """Returns hashCode() of the Java object Storm's multilang serializer
+    creates for "value": a String, Long, Double, Boolean, List, Map, byte[]
+    or null. Storm's fields grouping hashes the grouping fields' values
+    like this."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1231 if value else 1237
+    if isinstance(value, six.integer_types):
+        if -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+            # Long.hashCode()
+            value &= 0xFFFFFFFFFFFFFFFF
+            return _int32(value ^ (value >> 32))
+        # BigInteger.hashCode()
+        magnitude = abs(value)
+        words = []
+        while magnitude:
+            words.append(magnitude & 0xFFFFFFFF)
+            magnitude >>= 32
+        h = 0
+        for word in reversed(words):
+            h = (31 * h + word) & 0xFFFFFFFF
+        return _int32(h if value > 0 else -h)
+    if isinstance(value, float):
+        # Double.hashCode(), with NaN canonicalized as doubleToLongBits() does.
+        if value != value:
+            bits = 0x7FF8000000000000
+        else:
+            bits = struct.unpack('>Q', struct.pack('>d', value))[0]
+        return _int32(bits ^ (bits >> 32))
+    if isinstance(value, six.binary_type) and six.PY3 or isinstance(value, bytearray):
+        # byte[], as hashed by Arrays.deepHashCode(). Bytes are signed.
+        h = 1
+        for b in bytearray(value):
+            h = (31 * h + (b - 256 if b > 127 else b)) & 0xFFFFFFFF
+        return _int32(h)
+    if isinstance(value, six.binary_type):
+        # A Python 2 str is sent as a String.
+        value = value.decode('utf-8')
+    if isinstance(value, six.text_type):
+        # String.hashCode() is computed over UTF-16 code units.
+        data = value.encode('utf-16-be')
+        h = 0
+        for unit in struct.unpack('>%dH' % (len(data) // 2), data):
+            h = (31 * h + unit) & 0xFFFFFFFF
+        return _int32(h)
+    if isinstance(value, (list, tuple)):
+        h = 1
+        for item in value:
+            h = (31 * h + java_hash(item)) & 0xFFFFFFFF
+        return _int32(h)
+    if isinstance(value, dict):
+        h = 0
+        for k, v in six.iteritems(value):
+            h = (h + (java_hash(k) ^ java_hash(v))) & 0xFFFFFFFF
+        return _int32(h)
+    raise TypeError('Cannot compute the Java hash code of %r' % type(value).__name__)
+
+
+def fields_task_index(values, num_tasks):
+    """Returns the index, among the target component's tasks in ascending
+    order, of the task Storm's fields grouping sends a tuple to. "values"
+    are the tuple's values for the grouping fields."""
+    # Storm uses Math.floorMod(), which matches Python's %.
+    return java_hash(list(values)) % num_tasks
+
+
+GROUPINGS = ('shuffle', 'local_or_shuffle', 'none', 'fields', 'global', 'all', 'direct')
+
+
+def builder_inputs(common):
+    """Converts the inputs of a TopologyBuilder component to
+    {(component, stream): (grouping, fields)}."""
+    inputs = {}
+    for stream_id, grouping in six.iteritems(common.inputs):
+        if grouping.fields is not None:
+            kind = 'fields' if grouping.fields else 'global'
+            inputs[(stream_id.componentId, stream_id.streamId)] = (kind, list(grouping.fields))
+            continue
+        for kind in GROUPINGS:
+            if getattr(grouping, kind, None) is not None:
+                inputs[(stream_id.componentId, stream_id.streamId)] = (kind, None)
+                break
+        else:
+            raise ValueError('Unsupported grouping for %s: %r' % (stream_id.componentId, grouping))
+    return inputs
+
+
+class _Task(object):
+    """One task of a simulated component."""
+    def __init__(self, component, task_id, emitter):
+        self.component = component
+        self.task_id = task_id
+        self.emitter = emitter
+        self.queue = deque()
+        self.executed = 0
+        self.emitted = 0
+        self.acked = 0
+        self.failed = 0
+        self.process_time = 0.0
+        self.idle = False
+        # Round-robin position for each shuffle-grouped target.
+        self.shuffles = {}
+
+
+class Simulator(Mock):
+    """Simulates a topology. Add components with add_spout() and
+    add_bolt(), or load them from a topology definition with from_create()
+    or from_builder(), then call run().
+
+    Tasks are numbered from 1, consecutively in order of component id.
+    Storm also numbers its system components, such as __acker, so task ids
+    differ from a cluster's; only each task's index among its component's
+    tasks, which fields grouping uses, matches Storm. Each task after the
+    first gets a deep copy of the component object passed in, taken before
+    it is initialized, so the object passed in is task index 0.
+
+    Groupings are "shuffle" (also used for "local_or_shuffle" and "none"),
+    "fields", "global", "all" and "direct". Fields grouping picks tasks with
+    Storm's hash, so a key goes to the same task index as on a cluster.
+    Shuffle grouping is seeded with "seed", so runs are repeatable."""
+    def __init__(self, config=None, max_queued=1000, bolt_batch=100, seed=0):
+        super(Simulator, self).__init__()
+        self.config = config or {}
+        self.max_queued = max_queued
+        self.bolt_batch = bolt_batch
+        self.random = random.Random(seed)
+        self.components = {}
+        self.tasks = {}
+        self.queued = 0
+        self.spout_emits = 0
+        self.elapsed = 0.0
+        self._by_emitter = {}
+        self._targets = {}
+
+    @classmethod
+    def from_create(cls, create, config=None, **kwargs):
+        """Builds the topology by calling "create", the create(builder)
+        function that "petrel submit" uses."""
+        from petrel.topologybuilder import TopologyBuilder
+        builder = TopologyBuilder()
+        create(builder)
+        return cls.from_builder(builder, config, **kwargs)
+
+    @classmethod
+    def from_builder(cls, builder, config=None, **kwargs):
+        self = cls(config, **kwargs)
+        for id, spout in six.iteritems(builder._spouts):
+            common = builder._commons[id]
+            self.add_spout(id, spout, common.parallelism_hint or 1, self._builder_streams(common))
+        for id, bolt in six.iteritems(builder._bolts):
+            common = builder._commons[id]
+            self.add_bolt(id, bolt, builder_inputs(common), common.parallelism_hint or 1,
+                          self._builder_streams(common))
+        return self
+
+    @staticmethod
+    def _builder_streams(common):
+        return dict((stream, info.output_fields) for stream, info in six.iteritems(common.streams))
+
+    def add_spout(self, id, spout, parallelism=1, streams=None):
+        """Adds a spout. "streams" maps any streams besides "default" to
+        their fields."""
+        self._add(id, spout, parallelism, streams, None)
+
+    def add_bolt(self, id, bolt, inputs, parallelism=1, streams=None):
+        """Adds a bolt. "inputs" maps (component, stream) to (grouping,
+        fields), e.g. {('split', 'default'): ('fields', ['word'])}. fields
+        is only used for fields grouping."""
+        self._add(id, bolt, parallelism, streams, inputs)
+
+    def _add(self, id, emitter, parallelism, streams, inputs):
+        if id in self.components:
+            raise KeyError('Component has already been declared for id %s' % id)
+        streams = dict(streams or {})
+        streams['default'] = emitter.declareOutputFields()
+        self.components[id] = {
+            'emitter': emitter,
+            'parallelism': max(1, int(parallelism)),
+            'streams': streams,
+            'inputs': inputs,
+        }
+
+    def _prepare(self):
+        # Like Storm, number tasks from 1 in order of component id, but
+        # without system components.
+        task_id = 1
+        self.tasks = {}
+        for id in sorted(self.components):
+            spec = self.components[id]
+            emitter = spec['emitter']
+            copies = [copy.deepcopy(emitter) for i in range(spec['parallelism'] - 1)]
+            self.tasks[id] = []
+            for instance in [emitter] + copies:
+                task = _Task(id, task_id, instance)
+                self.tasks[id].append(task)
+                self._by_emitter[python_id(instance)] = task
+                task_id += 1
+
+        # (source component, stream) -> [(grouping, field indexes, target tasks)]
+        self._targets = defaultdict(list)
+        for id, spec in six.iteritems(self.components):
+            for (source, stream), (grouping, fields) in six.iteritems(spec['inputs'] or {}):
+                if source not in self.components:
+                    raise KeyError('%s subscribes to unknown component %s' % (id, source))
+                source_fields = self.components[source]['streams'].get(stream)
+                if source_fields is None:
+                    raise KeyError('%s subscribes to undeclared stream %s of %s' % (id, stream, source))
+                if grouping not in GROUPINGS:
+                    raise ValueError('Unsupported grouping for %s: %s' % (id, grouping))
+                indexes = [list(source_fields).index(f) for f in fields] if grouping == 'fields' else None
+                self._targets[(source, stream)].append((grouping, indexes, self.tasks[id]))
+
+        task_to_component = dict(
+            (task.task_id, id) for id, tasks in six.iteritems(self.tasks) for task in tasks)
+        schemas = dict((id, spec['streams']) for id, spec in six.iteritems(self.components))
+        for id, tasks in six.iteritems(self.tasks):
+            for stream, fields in six.iteritems(self.components[id]['streams']):
+                storm.set_schema(id, stream, fields)
+            for task in tasks:
+                conf = dict(self.config)
+                get_conf = getattr(task.emitter, 'getComponentConfiguration', None)
+                component_conf = get_conf() if get_conf is not None else None
+                if component_conf:
+                    conf.update(component_conf)
+                context = {
+                    'taskid': task.task_id,
+                    'componentid': id,
+                    'task->component': task_to_component,
+                    'source->stream->fields': schemas,
+                }
+                task.emitter.conf = conf
+                self.activate(task.emitter)
+                task.emitter.initialize(conf, context)
+
+    def component_id(self, emitter=None):
+        if emitter is None:
+            emitter = self.emitter
+        return self._by_emitter[python_id(emitter)].component
+
+    def ack(self, tup=None):
+        self._by_emitter[python_id(self.emitter)].acked += 1
+
+    def fail(self, tup=None):
+        self._by_emitter[python_id(self.emitter)].failed += 1
+
+    def ackMany(self, tuples):
+        self._by_emitter[python_id(self.emitter)].acked += len(tuples)
+
+    def failMany(self, tuples):
+        self._by_emitter[python_id(self.emitter)].failed += len(tuples)
+
+    def emitBolt(self, tup, stream=None, anchors=[], directTask=None):
+        if isinstance(tup, storm.Tuple):
+            tup = list(tup.values)
+        return self._route(tup, stream, directTask)
+
+    def emitSpout(self, tup, stream=None, id=None, directTask=None):
+        self.spout_emits += 1
+        return self._route(tup, stream, directTask, id)
+
+    def _route(self, values, stream, directTask, id=None):
+        source = self._by_emitter[python_id(self.emitter)]
+        source.emitted += 1
+        if stream is None:
+            stream = 'default'
+        result = []
+        for grouping, indexes, tasks in self._targets.get((source.component, stream), ()):
+            if grouping == 'direct':
+                if directTask is None:
+                    raise ValueError('Stream %s of %s is direct grouped; use emitDirect()' % (stream, source.component))
+                targets = [t for t in tasks if t.task_id == directTask]
+            elif directTask is not None:
+                continue
+            elif grouping == 'fields':
+                targets = [tasks[fields_task_index([values[i] for i in indexes], len(tasks))]]
+            elif grouping == 'global':
+                targets = tasks[:1]
+            elif grouping == 'all':
+                targets = tasks
+            else:
+                targets = [self._shuffle(source, tasks)]
+            for target in targets:
+                target.queue.append(storm.Tuple(
+                    id, source.component, stream, source.task_id, values))
+                result.append(target.task_id)
+            self.queued += len(targets)
+        return result
+
+    def _shuffle(self, source, tasks):
+        # Like Storm's ShuffleGrouping: go round a shuffled list of the
+        # tasks, shuffling it again after each round.
+        key = python_id(tasks)
+        state = source.shuffles.get(key)
+        if state is None or state[1] >= len(tasks):
+            order = list(tasks)
+            self.random.shuffle(order)
+            state = source.shuffles[key] = [order, 0]
+        task = state[0][state[1]]
+        state[1] += 1
+        return task
+
+    def _execute(self, task, loop):
+        bolt = task.emitter
+        self.activate(bolt)
+        n = min(len(task.queue), self.bolt_batch)
+        if isinstance(bolt, storm.BatchBolt):
+            size = max(1, int(bolt.conf.get('petrel.batch.size', bolt.batch_size)))
+            batches = [[task.queue.popleft() for j in range(min(size, n - i))] for i in range(0, n, size)]
+        else:
+            batches = [[task.queue.popleft()] for i in range(n)]
+        self.queued -= n
+        start = time.time()
+        # Bolts other than Bolt are acked for, as their run() methods do.
+        for batch in batches:
+            if isinstance(bolt, storm.BatchBolt):
+                bolt.run_batch(batch)
+            elif isinstance(bolt, storm.ThreadPoolBolt) or loop is not None and _is_async(bolt):
+                try:
+                    if isinstance(bolt, storm.ThreadPoolBolt):
+                        bolt.process(batch[0], self)
+                    else:
+                        loop.run_until_complete(bolt.process(batch[0], self))
+                except storm.FailedException:
+                    self.fail()
+                else:
+                    if getattr(bolt, 'auto_ack', True):
+                        self.ack()
+            elif isinstance(bolt, storm.BasicBolt):
+                bolt.process(batch[0])
+                self.ack()
+            else:
+                bolt.process(batch[0])
+        task.process_time += time.time() - start
+        task.executed += n
+
+    def run(self, max_spout_emits=None, max_seconds=None):
+        """Runs the topology until the spouts stop emitting and every tuple
+        has been processed, or until the spouts have emitted
+        "max_spout_emits" tuples or "max_seconds" have passed. Returns
+        stats()."""
+        loop = None
+        if any(_is_async(spec['emitter']) for spec in six.itervalues(self.components)):
+            import asyncio
+            loop = asyncio.new_event_loop()
+        started = time.time()
+        try:
+            with self:
+                self._prepare()
+                # Run downstream bolts first, so tuples already emitted
+                # are consumed before more arrive.
+                order = self._bolt_order()
+                spouts = [t for id in sorted(self.components) if self.components[id]['inputs'] is None
+                          for t in self.tasks[id]]
+                while True:
+                    if max_seconds is not None and time.time() - started >= max_seconds:
+                        break
+                    for task in order:
+                        if task.queue:
+                            self._execute(task, loop)
+                    if self.queued >= self.max_queued:
+                        continue
+                    if max_spout_emits is not None and self.spout_emits >= max_spout_emits:
+                        if not self.queued:
+                            break
+                        continue
+                    for task in spouts:
+                        before = task.emitted
+                        self.activate(task.emitter)
+                        start = time.time()
+                        task.emitter.nextTuple()
+                        task.process_time += time.time() - start
+                        task.idle = task.emitted == before
+                    if not self.queued and all(task.idle for task in spouts):
+                        break
+        finally:
+            self.elapsed = time.time() - started
+            if loop is not None:
+                loop.close()
+        return self.stats()
+
+    def _bolt_order(self):
+        """Bolt tasks, sinks first. Cycles are broken arbitrarily."""
+        downstream = defaultdict(set)
+        for id, spec in six.iteritems(self.components):
+            for source, stream in spec['inputs'] or ():
+                downstream[source].add(id)
+        order = []
+        visited = set()
+        def visit(id):
+            if id in visited:
+                return
+            visited.add(id)
+            for child in sorted(downstream[id]):
+                visit(child)
+            if self.components[id]['inputs'] is not None:
+                order.extend(self.tasks[id])
+        for id in sorted(self.components):
+            visit(id)
+        return order
+
+    def task_load(self, component):
+        """Returns {task id: tuples executed} for a bolt."""
+        return dict((task.task_id, task.executed) for task in self.tasks[component])
+
+    def stats(self):
+        """Returns per component counts of tuples executed (for bolts),
+        emitted, acked and failed, the time spent in nextTuple(), process()
+        or process_batch(), and the tuples executed (emitted, for spouts)
+        per second of that time. "tasks" lists each task's executed
+        count."""
+        result = {}
+        for id, tasks in six.iteritems(self.tasks):
+            process_time = sum(task.process_time for task in tasks)
+            executed = sum(task.executed for task in tasks)
+            emitted = sum(task.emitted for task in tasks)
+            # Spouts are measured by what they emit.
+            count = executed if self.components[id]['inputs'] is not None else emitted
+            result[id] = {
+                'tasks': [task.executed for task in tasks],
+                'executed': executed,
+                'emitted': emitted,
+                'acked': sum(task.acked for task in tasks),
+                'failed': sum(task.failed for task in tasks),
+                'process_secs': process_time,
+                'tuples_per_sec': count / process_time if process_time else 0.0,
+            }
+        return result
@@ -0,0 +1,228 @@
+"""Predicts how evenly fields grouping spreads a sample of tuples over a
+bolt's tasks. Storm sends a tuple to the task whose index is the Java hash
+of its grouping values modulo the number of tasks, so a few frequent keys
+can overload one task however many tasks there are. This module computes
+the same assignment offline, from the topology's create(builder) function
+and a sample of the tuples the upstream component emits:
+
+    petrel skew --input words.json --config topology.yaml
+
+Each line of the sample is a JSON list of the tuple's values, in the order
+of the upstream component's declared fields, or a JSON object mapping
+field names to values."""
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import six
+
+from petrel.simulator import fields_task_index, java_hash
+
+
+def load_topology(definition=None, config=None):
+    """Returns the components of the topology "petrel submit" would build,
+    as Simulator.components: {id: {"parallelism", "streams", "inputs",
+    ...}}. "definition" is "module.function" in the current directory
+    (create.create by default), and "config" the topology YAML file, whose
+    "petrel.parallelism.<component>" settings override parallelism hints."""
+    from petrel.simulator import Simulator
+    from petrel.util import read_yaml
+
+    module_name, dummy, function_name = (definition or 'create.create').rpartition('.')
+    module_dir = os.getcwd()
+    added_path_entry = module_dir not in sys.path
+    if added_path_entry:
+        sys.path[:0] = [module_dir]
+    try:
+        create = getattr(__import__(module_name), function_name)
+        components = Simulator.from_create(create).components
+    finally:
+        if added_path_entry:
+            sys.path.remove(module_dir)
+
+    if config is not None:
+        for k, v in six.iteritems(read_yaml(config) or {}):
+            if k.startswith('petrel.parallelism'):
+                id = k.split('.')[-1]
+                if id not in components:
+                    raise ValueError('Parallelism settings error: There are no components named: %s' % id)
+                components[id]['parallelism'] = int(v)
+    return components
+
+
+def fields_groupings(components):
+    """Returns (source, stream, bolt, fields) for each fields grouping in
+    the topology, sorted."""
+    result = []
+    for id, spec in six.iteritems(components):
+        for (source, stream), (grouping, fields) in six.iteritems(spec['inputs'] or {}):
+            if grouping == 'fields':
+                result.append((source, stream, id, list(fields)))
+    return sorted(result)
+
+
+def count_keys(tuples, fields, source_fields):
+    """Counts the tuples per distinct key, i.e. the values of "fields".
+    Returns {key: [values, count]}, where key is the values' JSON."""
+    indexes = [list(source_fields).index(f) for f in fields]
+    counts = {}
+    for values in tuples:
+        if isinstance(values, dict):
+            key_values = [values[f] for f in fields]
+        else:
+            key_values = [values[i] for i in indexes]
+        key = json.dumps(key_values, sort_keys=True)
+        entry = counts.get(key)
+        if entry is None:
+            counts[key] = [key_values, 1]
+        else:
+            entry[1] += 1
+    return counts
+
+
+def task_loads(hashes, counts, num_tasks):
+    """Returns the tuples sent to each task index. "hashes" and "counts"
+    list each key's Java hash and tuple count."""
+    loads = [0] * num_tasks
+    for h, n in zip(hashes, counts):
+        loads[h % num_tasks] += n
+    return loads
+
+
+def analyze(counts, parallelism, top=10, max_parallelism=None, tolerance=0.05):
+    """Analyzes the key counts from count_keys() for a bolt with
+    "parallelism" tasks. Returns a dict with:
+
+    tasks: tuples and distinct keys per task index
+    imbalance: the busiest task's tuples over the mean
+    effective_parallelism: tuples over the busiest task's tuples, i.e. the
+        speedup over one task if throughput is limited by the busiest task
+    heaviest_keys: the "top" keys with the most tuples, and their task
+    key_bound: the parallelism past which the heaviest key alone is at
+        least a task's fair share, so that more tasks cannot help
+    best_parallelism: the smallest parallelism up to "max_parallelism"
+        whose busiest task, under Storm's hash, gets within "tolerance" of
+        the fewest tuples any of those parallelisms achieves
+    """
+    entries = sorted(six.itervalues(counts), key=lambda e: (-e[1], json.dumps(e[0])))
+    hashes = [java_hash(values) for values, n in entries]
+    tuple_counts = [n for values, n in entries]
+    total = sum(tuple_counts)
+    heaviest = tuple_counts[0] if tuple_counts else 0
+
+    loads = task_loads(hashes, tuple_counts, parallelism)
+    keys = [0] * parallelism
+    for h in hashes:
+        keys[h % parallelism] += 1
+    busiest = max(loads)
+
+    if max_parallelism is None:
+        max_parallelism = max(32, 2 * parallelism)
+    busiest_by_parallelism = [max(task_loads(hashes, tuple_counts, p))
+                              for p in six.moves.range(1, max_parallelism + 1)]
+    lowest = min(busiest_by_parallelism + [busiest])
+    for p, load in enumerate(busiest_by_parallelism, 1):
+        if load <= lowest * (1 + tolerance):
+            best_parallelism, best_load = p, load
+            break
+    else:
+        best_parallelism, best_load = parallelism, busiest
+
+    def share(n):
+        return float(n) / total if total else 0.0
+
+    return {
+        'tuples': total,
+        'keys': len(entries),
+        'parallelism': parallelism,
+        'tasks': [{'task': i, 'tuples': loads[i], 'keys': keys[i], 'share': share(loads[i])}
+                  for i in range(parallelism)],
+        'imbalance': busiest * parallelism / float(total) if total else 0.0,
+        'effective_parallelism': float(total) / busiest if busiest else 0.0,
+        'heaviest_keys': [
+            {'key': values, 'tuples': n, 'share': share(n), 'task': fields_task_index(values, parallelism)}
+            for values, n in entries[:top]],
+        'key_bound': -(-total // heaviest) if heaviest else 0,
+        'max_parallelism': max_parallelism,
+        'best_parallelism': best_parallelism,
+        'best_busiest_tuples': best_load,
+        'best_effective_parallelism': float(total) / best_load if best_load else 0.0,
+    }
+
+
+def read_tuples(path):
+    """Yields the tuples in a sample file, or standard input if "path" is
+    "-"."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def print_report(source, stream, bolt, fields, report, out=None):
+    if out is None:
+        out = sys.stdout
+    print('%s -> %s, fields grouping on %s: %d tuples, %d distinct keys, %d tasks' % (
+        source if stream == 'default' else '%s (%s)' % (source, stream), bolt, ', '.join(fields),
+        report['tuples'], report['keys'], report['parallelism']), file=out)
+    print('%6s %10s %7s %8s' % ('task', 'tuples', 'share', 'keys'), file=out)
+    for task in report['tasks']:
+        print('%6d %10d %6.1f%% %8d' % (task['task'], task['tuples'], task['share'] * 100, task['keys']), file=out)
+    print('The busiest task gets %.2fx the mean load; effective parallelism %.2f of %d' % (
+        report['imbalance'], report['effective_parallelism'], report['parallelism']), file=out)
+    print('Heaviest keys:', file=out)
+    print('%10s %7s %6s  %s' % ('tuples', 'share', 'task', 'key'), file=out)
+    for key in report['heaviest_keys']:
+        print('%10d %6.1f%% %6d  %s' % (key['tuples'], key['share'] * 100, key['task'], json.dumps(key['key'])),
+              file=out)
+    print('The heaviest key limits useful parallelism to %d tasks' % report['key_bound'], file=out)
+    print('Best parallelism up to %d: %d (busiest task %d tuples, effective parallelism %.2f)' % (
+        report['max_parallelism'], report['best_parallelism'], report['best_busiest_tuples'],
+        report['best_effective_parallelism']), file=out)
+
+
+def skew(input, config=None, definition=None, component=None, source=None, stream=None,
+         top=10, max_parallelism=None, json_output=False):
+    """Implements "petrel skew": analyzes each fields grouping of the
+    sampled stream. The stream is chosen by --component, --source and
+    --stream, which may be omitted if only one stream is fields grouped."""
+    components = load_topology(definition, config)
+    groupings = [g for g in fields_groupings(components)
+                 if (source is None or g[0] == source) and (stream is None or g[1] == stream)
+                 and (component is None or g[2] == component)]
+    if not groupings:
+        raise ValueError('No matching fields grouping in the topology')
+    streams = sorted(set((g[0], g[1]) for g in groupings))
+    if len(streams) > 1:
+        raise ValueError('The sample must come from one stream; choose one of %s with --source and --stream' %
+                         ', '.join('%s/%s' % s for s in streams))
+
+    source, stream = streams[0]
+    source_fields = components[source]['streams'][stream]
+    # Count once per distinct set of grouping fields. The sample is only
+    # held in memory if there is more than one.
+    counts = {}
+    tuples = read_tuples(input)
+    if len(set(tuple(g[3]) for g in groupings)) > 1:
+        tuples = list(tuples)
+    reports = []
+    for i, (source, stream, bolt, fields) in enumerate(groupings):
+        key = tuple(fields)
+        if key not in counts:
+            counts[key] = count_keys(tuples, fields, source_fields)
+        report = analyze(counts[key], components[bolt]['parallelism'], top, max_parallelism)
+        report.update(source=source, stream=stream, component=bolt, fields=fields)
+        reports.append(report)
+        if not json_output:
+            if i:
+                print()
+            print_report(source, stream, bolt, fields, report)
+    if json_output:
+        print(json.dumps(reports, indent=2, sort_keys=True))
+    return reports
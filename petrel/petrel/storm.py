@@ -4,13 +4,28 @@ import sys
 import os
 import time
 import socket
+import struct
 import logging
+import threading
+import multiprocessing
 
 from collections import deque
 
 import json
 
 import six
+from six.moves import queue
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    # Python 3.8 and later.
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
 
 storm_log = logging.getLogger('storm')
 
@@ -30,20 +45,436 @@ MAX_MESSAGE_SIZE = 16777216
 class StormIPCException(Exception):
     pass
 
-#reads lines and reconstructs newlines appropriately
-def readMsg():
-    msg = ""
-    while True:
-        line = sys.stdin.readline()
-        if not line:
+
+class FailedException(Exception):
+    """Raised from the process() method of a bolt that acks automatically
+    (e.g. AsyncBolt) to fail the current tuple instead of acking it. As with
+    Storm's FailedException, other exceptions terminate the task."""
+    pass
+
+
+def _binary_stream(stream):
+    """Returns the byte-oriented stream underlying a text stream. On Python 2,
+    stdin and stdout are already byte streams."""
+    return getattr(stream, 'buffer', stream)
+
+
+class Serializer(object):
+    """Base class for multilang serializers. A serializer converts messages
+    to and from framed byte strings. It must match the serializer the Storm
+    worker uses (Storm's "topology.multilang.serializer" setting), which is
+    identified by the Java class name in "name"."""
+    name = None
+
+    def encode(self, msg):
+        """Returns "msg" as a complete frame, ready to write to Storm."""
+        raise NotImplementedError()
+
+    def encode_failure(self, msg):
+        """Returns a frame that the Storm worker will fail to parse as a
+        message. See sendFailureMsgToParent()."""
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """Decodes the payload of a single frame."""
+        raise NotImplementedError()
+
+    def encode_value(self, value):
+        """Encodes a single value for use with compile_message()."""
+        raise NotImplementedError()
+
+    def compile_message(self, fixed, keys):
+        """Prepares to encode many messages that share the same "fixed"
+        dict of fields. Returns a function that takes one encoded value (see
+        encode_value()) for each of "keys", in order, and returns the frame
+        for the complete message."""
+        raise NotImplementedError()
+
+    def decode_tuple(self, data):
+        """Decodes a message that is normally a tuple sent to a bolt. Returns
+        a Tuple, or the decoded message if it is something else (e.g. a list
+        of task ids)."""
+        msg = self.decode(data)
+        if isinstance(msg, dict):
+            return Tuple(msg['id'], intern_string(msg['comp']), intern_string(msg['stream']),
+                         msg['task'], msg['tuple'])
+        return msg
+
+    def find_frame(self, buffer, start, hint):
+        """Looks for a complete frame in "buffer" beginning at "start". If
+        found, returns a tuple (payload_start, payload_end, frame_end).
+        Otherwise returns None. "hint" is an offset at or after "start"
+        before which a previous call already searched without success."""
+        raise NotImplementedError()
+
+
+class JsonSerializer(Serializer):
+    """Storm's default serializer: one JSON document per message, followed by
+    a line containing "end". Storm writes the keys of a tuple message in no
+    particular order, so tuples are decoded in full as they are read."""
+    name = 'org.apache.storm.multilang.JsonSerializer'
+
+    def encode(self, msg):
+        return json_encode(msg).encode('utf-8') + b'\nend\n'
+
+    def encode_failure(self, msg):
+        return msg.encode('utf-8') + b'\nend\n'
+
+    def decode(self, data):
+        return json_decode(data.decode('utf-8'))
+
+    # Values are encoded compactly, skipping the json.dumps() wrapper.
+    _encode_value = json.JSONEncoder(separators=(',', ':')).encode
+
+    def encode_value(self, value):
+        return self._encode_value(value).encode('utf-8')
+
+    def compile_message(self, fixed, keys):
+        # Split the message around the variable values, e.g.
+        # '{"command": "emit", "anchors": ' + anchors + ', "tuple": ' + tuple + '}'
+        separator = ', ' if fixed else ''
+        prefixes = []
+        for key in keys:
+            prefixes.append(('%s%s: ' % (separator, json_encode(key))).encode('utf-8'))
+            separator = ', '
+        prefixes[0] = json_encode(fixed)[:-1].encode('utf-8') + prefixes[0]
+        suffix = b'}' + self._delimiter
+        return _compile_frame(prefixes, suffix)
+
+    _delimiter = b'\nend\n'
+
+    def find_frame(self, buffer, start, hint):
+        end = buffer.find(self._delimiter, hint)
+        if end < 0:
+            return None
+        return start, end, end + len(self._delimiter)
+
+
+class MsgPackSerializer(Serializer):
+    """Compact binary serializer. Each message is a MessagePack document
+    preceded by its length as a 4-byte big-endian integer. Unlike JSON, bytes
+    values are carried natively. Requires the "msgpack" package and
+    storm.petrel.MsgPackSerializer (in the Petrel jar) on the Storm side."""
+    name = 'storm.petrel.MsgPackSerializer'
+
+    _length = struct.Struct('>I')
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('The msgpack package is required to use %s' % self.name)
+        # strict_map_key=False accepts the Long map keys the Java side
+        # sends, which msgpack 1.0 rejects by default.
+        self._unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+
+    def encode(self, msg):
+        data = msgpack.packb(msg, use_bin_type=True)
+        return self._length.pack(len(data)) + data
+
+    def encode_failure(self, msg):
+        # The Storm side rejects any message that is not a map.
+        return self.encode(msg)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def encode_value(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode_tuple(self, data):
+        # Decode the envelope but leave the values encoded; see LazyTuple.
+        # Reusing one Unpacker keeps this as cheap as a full decode for small
+        # tuples.
+        first = data[0]
+        if not (0x80 <= first <= 0x8f or first in (0xde, 0xdf)):
+            return self.decode(data)
+        unpacker = self._unpacker
+        try:
+            base = unpacker.tell()
+            unpacker.feed(data)
+            msg = {}
+            encoded = None
+            for i in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == 'tuple':
+                    start = unpacker.tell() - base
+                    unpacker.skip()
+                    encoded = memoryview(data)[start:unpacker.tell() - base].tobytes()
+                else:
+                    msg[key] = unpacker.unpack()
+        except Exception:
+            # Don't leave a partly read message in the unpacker.
+            self._unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+            raise
+        return LazyTuple(msg['id'], intern_string(msg['comp']), intern_string(msg['stream']),
+                         msg['task'], encoded, self)
+
+    def compile_message(self, fixed, keys):
+        packer = msgpack.Packer(use_bin_type=True)
+        header = packer.pack_map_header(len(fixed) + len(keys)) + b''.join(
+            packer.pack(k) + packer.pack(v) for k, v in six.iteritems(fixed))
+        prefixes = [packer.pack(key) for key in keys]
+        prefixes[0] = header + prefixes[0]
+        fixed_size = sum(len(prefix) for prefix in prefixes)
+        pack_length = self._length.pack
+
+        render = _compile_frame(prefixes, b'')
+        def render_frame(*values):
+            return pack_length(fixed_size + sum(len(value) for value in values)) + render(*values)
+        return render_frame
+
+    def find_frame(self, buffer, start, hint):
+        header_end = start + self._length.size
+        if len(buffer) < header_end:
+            return None
+        length, = self._length.unpack_from(buffer, start)
+        if length > MAX_MESSAGE_SIZE:
+            raise StormIPCException('Message length %d exceeds maximum of %d' % (length, MAX_MESSAGE_SIZE))
+        end = header_end + length
+        if len(buffer) < end:
+            return None
+        return header_end, end, end
+
+
+def _compile_frame(prefixes, suffix):
+    """Returns a function that interleaves "prefixes" with its arguments and
+    appends "suffix". Messages usually have one or two variable parts, so
+    those cases avoid the generic loop."""
+    if len(prefixes) == 1:
+        prefix, = prefixes
+        return lambda value: b''.join((prefix, value, suffix))
+    elif len(prefixes) == 2:
+        prefix1, prefix2 = prefixes
+        return lambda value1, value2: b''.join((prefix1, value1, prefix2, value2, suffix))
+    else:
+        def render(*values):
+            chunks = []
+            for prefix, value in zip(prefixes, values):
+                chunks.append(prefix)
+                chunks.append(value)
+            chunks.append(suffix)
+            return b''.join(chunks)
+        return render
+
+
+SERIALIZERS = dict((cls.name, cls) for cls in (JsonSerializer, MsgPackSerializer))
+
+
+def get_serializer(name=None):
+    """Returns a serializer instance given the Java class name configured in
+    "topology.multilang.serializer". The default is JSON."""
+    if not name:
+        return JsonSerializer()
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError('Unsupported multilang serializer: %s' % name)
+
+
+SERIALIZER = JsonSerializer()
+
+
+class FrameReader(object):
+    """Reads frames from a byte stream. Reads are done in large chunks into a
+    single buffer, and frame boundaries are found directly in the bytes. One
+    read may return several frames; they are then returned without touching
+    the stream again."""
+    CHUNK_SIZE = 65536
+
+    # When a search fails, the next search restarts this many bytes before the
+    # end of the buffer in case a delimiter or header was split across reads.
+    SEARCH_OVERLAP = 16
+
+    def __init__(self, stream, serializer, on_block=None):
+        self.serializer = serializer
+        # Called before any read that may block, e.g. to flush output that
+        # Storm is waiting for.
+        self.on_block = on_block
+        self._buffer = bytearray()
+        self._start = 0
+        self._hint = 0
+        if stream is None:
+            # Data is supplied with feed(), e.g. by an asyncio stream.
+            self._read = None
+            return
+        read1 = getattr(stream, 'read1', None)
+        if read1 is not None:
+            self._read = read1
+        else:
+            # Python 2 file objects have no read1(). os.read() returns as
+            # soon as some data is available.
+            fd = stream.fileno()
+            self._read = lambda size: os.read(fd, size)
+
+    def read_payload(self):
+        """Returns the payload of the next frame, reading more data from the
+        stream if no complete frame is buffered."""
+        while True:
+            payload = self.next_payload()
+            if payload is not None:
+                return payload
+            self._fill()
+
+    def next_payload(self):
+        """Returns the payload of the next buffered frame, or None if no
+        complete frame is buffered. Never reads from the stream."""
+        frame = self.serializer.find_frame(self._buffer, self._start, self._hint)
+        if frame is None:
+            self._hint = max(self._start, len(self._buffer) - self.SEARCH_OVERLAP)
+            return None
+        payload_start, payload_end, self._start = frame
+        self._hint = self._start
+        return self._buffer[payload_start:payload_end]
+
+    def feed(self, data):
+        """Adds data read elsewhere to the buffer."""
+        self._compact()
+        self._buffer += data
+
+    def read_message(self):
+        return self.serializer.decode(self.read_payload())
+
+    def _compact(self):
+        # Drop the frames already consumed before reading more.
+        if self._start:
+            del self._buffer[:self._start]
+            self._hint -= self._start
+            self._start = 0
+
+    def _fill(self):
+        self._compact()
+        if self.on_block is not None:
+            self.on_block()
+        data = self._read(self.CHUNK_SIZE)
+        if not data:
             raise StormIPCException('Read EOF from stdin')
-        if line[0:-1] == "end":
-            break
-        msg = msg + line
-    return json_decode(msg[0:-1])
+        self._buffer += data
+
+
+_reader = None
+
+
+def _get_reader():
+    global _reader
+    if _reader is None:
+        _reader = FrameReader(_binary_stream(sys.stdin), SERIALIZER, output_buffer.flush)
+    return _reader
+
+
+def readMsg():
+    return _get_reader().read_message()
+
+
+class OutputBuffer(object):
+    """Coalesces encoded messages sent to Storm so that several of them go
+    out in a single write. The buffer is flushed:
+    - by sync(), i.e. at the end of every spout command and heartbeat
+    - before any read from Storm that may block
+    - when it holds at least "flush_bytes" bytes
+    - on the first write after "flush_interval" seconds have passed since
+      the oldest buffered message was written.
+    Setting flush_bytes to 0 flushes every message immediately.
+
+    The counters "flushes", "messages" and "bytes_flushed" help tune these
+    settings for a component. They can be set in the topology configuration
+    or in getComponentConfiguration() using "petrel.output.flush_bytes" and
+    "petrel.output.flush_ms".
+
+    If more than one thread writes to the buffer, set "lock" to a
+    threading.Lock so that messages are not interleaved."""
+    DEFAULT_FLUSH_BYTES = 65536
+    DEFAULT_FLUSH_INTERVAL = 0.1
+
+    def __init__(self, stream, flush_bytes=DEFAULT_FLUSH_BYTES, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.stream = stream
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._chunks = []
+        self._size = 0
+        self._deadline = None
+        self.flushes = 0
+        self.messages = 0
+        self.bytes_flushed = 0
+        self.lock = None
+
+    def configure(self, conf):
+        """Reads the flush settings from a Storm configuration dict."""
+        self.flush_bytes = int(conf.get('petrel.output.flush_bytes', self.flush_bytes))
+        if 'petrel.output.flush_ms' in conf:
+            self.flush_interval = float(conf['petrel.output.flush_ms']) / 1000.0
+
+    def write(self, data, messages=1):
+        """Buffers "data", which holds one or more encoded messages."""
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    self._write(data, messages)
+            else:
+                self._write(data, messages)
+        except StormIPCException as e:
+            self._log_error(e)
+            raise
+
+    def _write(self, data, messages):
+        self._chunks.append(data)
+        self._size += len(data)
+        self.messages += messages
+        if self._size >= self.flush_bytes:
+            self._flush()
+        elif self._deadline is None:
+            self._deadline = time.time() + self.flush_interval
+        elif time.time() >= self._deadline:
+            self._flush()
+
+    def flush(self):
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    self._flush()
+            else:
+                self._flush()
+        except StormIPCException as e:
+            self._log_error(e)
+            raise
+
+    def _log_error(self, e):
+        # Not from _flush(): a StormHandler may write the record to this
+        # buffer, which would deadlock on the lock.
+        storm_log.exception(str(e))
+
+    def _flush(self):
+        if not self._chunks:
+            return
+        data = b''.join(self._chunks)
+        del self._chunks[:]
+        self._size = 0
+        self._deadline = None
+        try:
+            self.stream.write(data)
+            self.stream.flush()
+        except (IOError, OSError) as e:
+            raise StormIPCException('%s error [Errno %d] in sendMsgToParent: %s' % (
+                type(e).__name__,
+                e.errno,
+                str(e)))
+        self.flushes += 1
+        self.bytes_flushed += len(data)
+
+    @property
+    def bytes_per_flush(self):
+        return float(self.bytes_flushed) / self.flushes if self.flushes else 0.0
+
+    def stats(self):
+        return {
+            'flushes': self.flushes,
+            'messages': self.messages,
+            'bytes_flushed': self.bytes_flushed,
+            'bytes_per_flush': self.bytes_per_flush,
+        }
+
+
+output_buffer = OutputBuffer(_binary_stream(old_stdout))
 
 MODE = None
-ANCHOR_TUPLE = None
 
 #queue up commands we read while trying to read taskids
 pending_commands = deque()
@@ -52,6 +483,8 @@ pending_commands = deque()
 def readTaskIds():
     if pending_taskids:
         return pending_taskids.popleft()
+    elif _reader_thread is not None:
+        return _reader_thread.next_task_ids()
     else:
         msg = readMsg()
         while type(msg) is not list:
@@ -63,7 +496,21 @@ def readTaskIds():
 pending_taskids = deque()
 
 
+# Functions to call on the main thread before it reads its next tuple or
+# command. Signal handlers and other threads queue work here rather than
+# doing it themselves, e.g. because the main thread may hold the lock a log
+# call needs, or because the work must run on the main thread.
+main_thread_calls = deque()
+
+
+def run_main_thread_calls():
+    while main_thread_calls:
+        main_thread_calls.popleft()()
+
+
 def readCommand():
+    if main_thread_calls:
+        run_main_thread_calls()
     if pending_commands:
         return pending_commands.popleft()
     else:
@@ -75,21 +522,104 @@ def readCommand():
 
 
 def readTuple():
-    cmd = readCommand()
-    return Tuple(cmd["id"], cmd["comp"], cmd["stream"], cmd["task"], cmd["tuple"])
+    if main_thread_calls:
+        run_main_thread_calls()
+    if pending_commands:
+        cmd = pending_commands.popleft()
+        return Tuple(cmd["id"], intern_string(cmd["comp"]), intern_string(cmd["stream"]),
+                     cmd["task"], cmd["tuple"])
+    if _reader_thread is not None:
+        return _reader_thread.next_tuple()
+    reader = _get_reader()
+    while True:
+        msg = SERIALIZER.decode_tuple(reader.read_payload())
+        if isinstance(msg, Tuple):
+            return msg
+        pending_taskids.append(msg)
+
+
+class ReaderThread(threading.Thread):
+    """Reads from Storm on its own thread so that heartbeats are answered
+    while the main thread is busy in process(). Storm kills a bolt that
+    does not answer heartbeats within "supervisor.worker.timeout.secs",
+    which a single slow tuple can otherwise cause.
+
+    Heartbeat tuples are answered with sync() as soon as they are read.
+    Other tuples are queued for readTuple(), and task id lists for
+    readTaskIds(). If reading fails, e.g. at EOF, the exception is raised
+    by the next of those calls on the main thread."""
+    def __init__(self, reader):
+        threading.Thread.__init__(self, name='petrel-reader')
+        self.daemon = True
+        self.reader = reader
+        self.tuples = queue.Queue()
+        self.task_ids = queue.Queue()
+        self.heartbeats = 0
+
+    def run(self):
+        read_payload = self.reader.read_payload
+        decode_tuple = self.reader.serializer.decode_tuple
+        try:
+            while True:
+                msg = decode_tuple(read_payload())
+                if not isinstance(msg, Tuple):
+                    self.task_ids.put(msg)
+                elif msg.is_heartbeat_tuple():
+                    self.heartbeats += 1
+                    sync()
+                else:
+                    self.tuples.put(msg)
+        except Exception as e:
+            self.tuples.put(e)
+            self.task_ids.put(e)
+
+    def _get(self, items):
+        try:
+            item = items.get_nowait()
+        except queue.Empty:
+            # Storm may be waiting for our output before sending more.
+            output_buffer.flush()
+            item = items.get()
+        if isinstance(item, Exception):
+            # Leave it for any later call, too.
+            items.put(item)
+            raise item
+        return item
+
+    def next_tuple(self):
+        return self._get(self.tuples)
+
+    def next_task_ids(self):
+        return self._get(self.task_ids)
+
+
+_reader_thread = None
+
+
+def start_reader_thread():
+    """Starts reading from Storm on a ReaderThread. From then on, the output
+    buffer is locked, since both threads write to it."""
+    global _reader_thread
+    if _reader_thread is None:
+        output_buffer.lock = threading.Lock()
+        reader = _get_reader()
+        # Only the main thread knows when its output should be flushed.
+        reader.on_block = None
+        _reader_thread = ReaderThread(reader)
+        _reader_thread.start()
+    return _reader_thread
+
+
+# Component and stream names repeat in every tuple. Keeping a single copy of
+# each saves memory when many tuples are held at once.
+_strings = {}
+
+def intern_string(s):
+    return _strings.setdefault(s, s)
 
 
 def sendMsgToParent(msg):
-    print(json_encode(msg), file=old_stdout)
-    print('end', file=old_stdout)
-    try:
-        old_stdout.flush()
-    except (IOError, OSError) as e:
-        storm_log.exception(str(e))
-        raise StormIPCException('%s error [Errno %d] in sendMsgToParent: %s' % (
-            type(e).__name__,
-            e.errno,
-            str(e)))
+    output_buffer.write(SERIALIZER.encode(msg))
 
 
 # This function is probably obsolete with the addition of the new
@@ -108,13 +638,28 @@ def sendFailureMsgToParent(msg):
     is cleaner than simply letting the task die without notifying Storm,
     because this way Storm restarts the task more quickly."""
     assert isinstance(msg, six.string_types)
-    print(msg, file=old_stdout)
-    print('end', file=old_stdout)
+    output_buffer.write(SERIALIZER.encode_failure(msg))
+    output_buffer.flush()
     storm_log.error('Sent failure message ("%s") to Storm', msg)
 
 
+# Functions called by sync(), e.g. to send buffered log records.
+sync_hooks = []
+
+
 def sync():
+    # Tasks sync at least once per heartbeat, so this is a convenient time to
+    # send metrics and anything else that is due.
+    if _reader_thread is None or threading.current_thread() is not _reader_thread:
+        metrics.send_due()
+    elif metrics.due() and metrics.send_due not in main_thread_calls:
+        # Reading and resetting a count here could lose the main thread's
+        # increments in between.
+        main_thread_calls.append(metrics.send_due)
+    for hook in sync_hooks:
+        hook()
     sendMsgToParent({'command':'sync'})
+    output_buffer.flush()
 
 
 def sendpid(heartbeatdir):
@@ -123,115 +668,307 @@ def sendpid(heartbeatdir):
     open(heartbeatdir + "/" + str(pid), "w").close()    
 
 
+class OutputCollector(object):
+    """Sends a bolt's emits, acks and fails to Storm. Each task gets one as
+    "self.collector" before initialize() is called.
+
+    Most of an emit message is the same from one emit to the next. The
+    collector encodes that part once for each stream and direct task, and
+    then only encodes the tuple values and anchor ids for each emit.
+
+    "anchors" holds the tuples being processed by a BasicBolt or BatchBolt.
+    When set, it replaces the anchors passed to emit()."""
+    def __init__(self, serializer, output):
+        self.serializer = serializer
+        self.output = output
+        self.anchors = None
+        self.emitted = 0
+        self._encode = serializer.encode_value
+        self._templates = {}
+        self._render_ack = serializer.compile_message({'command': 'ack'}, ('id',))
+        self._render_fail = serializer.compile_message({'command': 'fail'}, ('id',))
+        self._no_anchors = self._encode([])
+        self._last_anchor_id = None
+        self._last_anchors = None
+        self._last_anchor_list = None
+        self._last_anchor_list_ids = None
+
+    def _template(self, stream, directTask, need_task_ids):
+        key = (stream, directTask, need_task_ids)
+        render = self._templates.get(key)
+        if render is None:
+            fixed = {'command': 'emit', 'need_task_ids': need_task_ids}
+            if stream is not None:
+                fixed['stream'] = stream
+            if directTask is not None:
+                fixed['task'] = directTask
+            render = self._templates[key] = self.serializer.compile_message(fixed, ('anchors', 'tuple'))
+        return render
+
+    def _encode_anchors(self, anchors):
+        if self.anchors is not None:
+            anchors = self.anchors
+        if not anchors:
+            return self._no_anchors
+        # A bolt usually emits several tuples anchored to the same input(s),
+        # so remember the last encoded anchors.
+        if len(anchors) == 1:
+            anchor_id = anchors[0].id
+            if anchor_id != self._last_anchor_id:
+                self._last_anchors = self._encode([anchor_id])
+                self._last_anchor_id = anchor_id
+            return self._last_anchors
+        # Compare ids rather than the list itself, which the bolt may have
+        # refilled since the last emit.
+        ids = [a.id for a in anchors]
+        if ids != self._last_anchor_list:
+            self._last_anchor_list_ids = self._encode(ids)
+            self._last_anchor_list = ids
+        return self._last_anchor_list_ids
+
+    def _encode_values(self, values):
+        # An input Tuple may be passed to emit() to send its values on
+        # unchanged, reusing their encoded form when possible.
+        if isinstance(values, Tuple):
+            return values.encode_values(self.serializer)
+        return self._encode(values)
+
+    def _frame(self, tup, stream=None, anchors=(), directTask=None, need_task_ids=False):
+        return self._template(stream, directTask, need_task_ids)(
+            self._encode_anchors(anchors), self._encode_values(tup))
+
+    def emit(self, tup, stream=None, anchors=(), directTask=None, need_task_ids=False):
+        """Emits a tuple. "tup" is a list of values, or an input Tuple whose
+        values are sent on unchanged. Returns the ids of the receiving tasks
+        if need_task_ids is True."""
+        self.output.write(self._frame(tup, stream, anchors, directTask, need_task_ids))
+        self.emitted += 1
+        if need_task_ids:
+            return readTaskIds()
+
+    def emitDirect(self, task, *args, **kwargs):
+        kwargs['directTask'] = task
+        return self.emit(*args, **kwargs)
+
+    def emitMany(self, tuples, stream=None, anchors=(), directTask=None, need_task_ids=False):
+        """Emits several tuples in a single write. See iter_emit_many()."""
+        return self._emitMany(tuples, need_task_ids,
+                              dict(stream=stream, anchors=anchors, directTask=directTask))
+
+    def _emitMany(self, tuples, need_task_ids, defaults):
+        frames = [self._frame(tup, need_task_ids=need_task_ids, **kwargs)
+                  for tup, kwargs in iter_emit_many(tuples, **defaults)]
+        if frames:
+            self.output.write(b''.join(frames), len(frames))
+            self.emitted += len(frames)
+        if need_task_ids:
+            return [readTaskIds() for frame in frames]
+
+    def ack(self, tup):
+        self.output.write(self._render_ack(self._encode(tup.id)))
+
+    def fail(self, tup):
+        self.output.write(self._render_fail(self._encode(tup.id)))
+
+    def bind(self, tup, output=None):
+        """Returns a TupleCollector for emits anchored to "tup". Its messages
+        go to "output" if given, otherwise to this collector's output."""
+        return TupleCollector(self, tup, output)
+
+    def ackMany(self, tuples):
+        """Acks several tuples in a single write."""
+        encode = self._encode
+        render = self._render_ack
+        if tuples:
+            self.output.write(b''.join([render(encode(tup.id)) for tup in tuples]), len(tuples))
+
+    def failMany(self, tuples):
+        """Fails several tuples in a single write."""
+        encode = self._encode
+        render = self._render_fail
+        if tuples:
+            self.output.write(b''.join([render(encode(tup.id)) for tup in tuples]), len(tuples))
+
+
+class TupleCollector(object):
+    """Emission context for one input tuple. Emits are anchored to that tuple
+    and ack() and fail() apply to it. Unlike the global emit functions, it
+    holds no state shared with other tuples, so bolts that process several
+    tuples at once (e.g. AsyncBolt) give each one its own TupleCollector.
+    Emits never request task ids, because the reply could not be matched to
+    the emit that asked for it."""
+    def __init__(self, collector, tup, output=None):
+        self.collector = collector
+        self.tuple = tup
+        self.output = collector.output if output is None else output
+        self._encode = collector._encode
+        self._anchors = collector._encode([tup.id])
+
+    def emit(self, tup, stream=None, anchors=None, directTask=None):
+        """Emits a tuple anchored to the input tuple, or to "anchors" if
+        given."""
+        if anchors is None:
+            encoded_anchors = self._anchors
+        else:
+            encoded_anchors = self._encode([a.id for a in anchors])
+        self.output.write(self.collector._template(stream, directTask, False)(
+            encoded_anchors, self.collector._encode_values(tup)))
+
+    def emitDirect(self, task, *args, **kwargs):
+        kwargs['directTask'] = task
+        self.emit(*args, **kwargs)
+
+    def emitMany(self, tuples, stream=None, anchors=None, directTask=None):
+        """Emits several tuples in a single write. See iter_emit_many()."""
+        frames = []
+        for tup, kwargs in iter_emit_many(tuples, stream=stream, anchors=anchors, directTask=directTask):
+            anchors = kwargs['anchors']
+            if anchors is None:
+                encoded_anchors = self._anchors
+            else:
+                encoded_anchors = self._encode([a.id for a in anchors])
+            frames.append(self.collector._template(kwargs['stream'], kwargs['directTask'], False)(
+                encoded_anchors, self.collector._encode_values(tup)))
+        if frames:
+            self.output.write(b''.join(frames), len(frames))
+
+    def ack(self):
+        self.output.write(self.collector._render_ack(self._encode(self.tuple.id)))
+
+    def fail(self):
+        self.output.write(self.collector._render_fail(self._encode(self.tuple.id)))
+
+
+class SpoutOutputCollector(OutputCollector):
+    """OutputCollector for spouts, whose emits carry a message id instead of
+    anchors.
+
+    When "sent_times" is a dict, the emit time of every "sample_every"th
+    tuple with a message id is recorded in it, keyed by the id. The spout
+    removes the entry when the tuple is acked or failed."""
+    sample_every = 16
+
+    def __init__(self, serializer, output):
+        super(SpoutOutputCollector, self).__init__(serializer, output)
+        self.sent_times = None
+        self._sample_count = 0
+
+    def _sample(self, id):
+        self._sample_count += 1
+        if self._sample_count >= self.sample_every:
+            self._sample_count = 0
+            try:
+                self.sent_times[id] = time.time()
+            except TypeError:
+                # The id isn't hashable, e.g. a list.
+                pass
+    def _template(self, stream, directTask, need_task_ids, has_id):
+        key = (stream, directTask, need_task_ids, has_id)
+        render = self._templates.get(key)
+        if render is None:
+            fixed = {'command': 'emit', 'need_task_ids': need_task_ids}
+            if stream is not None:
+                fixed['stream'] = stream
+            if directTask is not None:
+                fixed['task'] = directTask
+            keys = ('id', 'tuple') if has_id else ('tuple',)
+            render = self._templates[key] = self.serializer.compile_message(fixed, keys)
+        return render
+
+    def _frame(self, tup, stream=None, id=None, directTask=None, need_task_ids=False):
+        if id is None:
+            return self._template(stream, directTask, need_task_ids, False)(self._encode(tup))
+        if self.sent_times is not None:
+            self._sample(id)
+        return self._template(stream, directTask, need_task_ids, True)(
+            self._encode(id), self._encode(tup))
+
+    def emit(self, tup, stream=None, id=None, directTask=None, need_task_ids=False):
+        """Emits a tuple. If "id" is given, Storm tracks the tuple and later
+        calls the spout's ack() or fail() with that id."""
+        self.output.write(self._frame(tup, stream, id, directTask, need_task_ids))
+        self.emitted += 1
+        if need_task_ids:
+            return readTaskIds()
+
+    def emitMany(self, tuples, stream=None, id=None, directTask=None, need_task_ids=False):
+        return self._emitMany(tuples, need_task_ids,
+                              dict(stream=stream, id=id, directTask=directTask))
+
+    def emitEncoded(self, values, stream=None, id=None):
+        """Emits a tuple whose values were already encoded with the
+        serializer's encode_value(), e.g. to replay a stored tuple."""
+        if id is None:
+            self.output.write(self._template(stream, None, False, False)(values))
+        else:
+            if self.sent_times is not None:
+                self._sample(id)
+            self.output.write(self._template(stream, None, False, True)(self._encode(id), values))
+        self.emitted += 1
+
+
+# The collector of the running task. The module-level emit functions below
+# delegate to it.
+collector = None
+
+
+def getCollector():
+    global collector
+    if collector is None:
+        collector_class = SpoutOutputCollector if MODE == Spout else OutputCollector
+        collector = collector_class(SERIALIZER, output_buffer)
+    return collector
+
+
+def iter_emit_many(tuples, **defaults):
+    """Helper for emitMany(). Each item in "tuples" is either a list of
+    values, or a dict with the values under "tuple" plus any emit() keyword
+    arguments that apply to that tuple only, e.g.
+    {"tuple": ["word"], "stream": "words", "anchors": [tup], "directTask": 3}.
+    Yields (values, kwargs) pairs, with "defaults" filling in the kwargs."""
+    for item in tuples:
+        if isinstance(item, dict):
+            kwargs = dict(defaults)
+            kwargs.update(item)
+            yield kwargs.pop('tuple'), kwargs
+        else:
+            yield item, defaults
+
+
 def emit(*args, **kwargs):
-    result = __emit(*args, **kwargs)
-    if result:
-        return readTaskIds()
+    return getCollector().emit(*args, **kwargs)
 
 
 def emitMany(*args, **kwargs):
-    """A more efficient way to emit a number of tuples at once."""
-    global MODE
-    if MODE == Bolt:
-        emitManyBolt(*args, **kwargs)
-    elif MODE == Spout:
-        emitManySpout(*args, **kwargs)
+    """A more efficient way to emit a number of tuples at once. The messages
+    for all the tuples are encoded together and sent in a single write. See
+    iter_emit_many() for how to override the emit options per tuple."""
+    return getCollector().emitMany(*args, **kwargs)
 
 
 def emitDirect(task, *args, **kwargs):
-    kwargs["directTask"] = task
-    __emit(*args, **kwargs)
-
-
-def __emit(*args, **kwargs):
-    global MODE
-    if MODE == Bolt:
-        return emitBolt(*args, **kwargs)
-    elif MODE == Spout:
-        return emitSpout(*args, **kwargs)
-
-
-def emitManyBolt(tuples, stream=None, anchors = [], directTask=None):
-    global ANCHOR_TUPLE
-    if ANCHOR_TUPLE is not None:
-        anchors = [ANCHOR_TUPLE]
-    m = {
-        "command": "emit",
-        "anchors": [a.id for a in anchors],
-        "tuple": None,
-        "need_task_ids": False,
-    }
-    if stream is not None:
-        m["stream"] = stream
-    if directTask is not None:
-        m["task"] = directTask
-    
-    lines = []
-    for tup in tuples:
-        m["tuple"] = tup
-        lines.append(json_encode(m))
-        lines.append('end')
-    print(lines, '\n', file=old_stdout)
-
-
-def emitBolt(tup, stream=None, anchors = [], directTask=None, need_task_ids=False):
-    global ANCHOR_TUPLE
-    if ANCHOR_TUPLE is not None:
-        anchors = [ANCHOR_TUPLE]
-    m = {
-        "command": "emit",
-        "anchors": [a.id for a in anchors],
-        "tuple": tup,
-        "need_task_ids": need_task_ids,
-    }
-    if stream is not None:
-        m["stream"] = stream
-    if directTask is not None:
-        m["task"] = directTask
-    sendMsgToParent(m)
-    return need_task_ids
-
-
-def emitManySpout(tuples, stream=None, id=None, directTask=None, need_task_ids=False):
-    m = {
-        "command": "emit",
-        "tuple": None,
-        "need_task_ids": need_task_ids,
-    }
-    if id is not None:
-        m["id"] = id
-    if stream is not None:
-        m["stream"] = stream
-    if directTask is not None:
-        m["task"] = directTask
-
-    lines = []
-    for tup in tuples:
-        m["tuple"] = tup
-        lines.append(json_encode(m))
-        lines.append('end')
-    print(lines, '\n', file=old_stdout)
-
-
-def emitSpout(tup, stream=None, id=None, directTask=None, need_task_ids=False):
-    m = {
-        "command": "emit",
-        "tuple": tup,
-        "need_task_ids": need_task_ids,
-    }
-    if id is not None:
-        m["id"] = id
-    if stream is not None:
-        m["stream"] = stream
-    if directTask is not None:
-        m["task"] = directTask
-    sendMsgToParent(m)
-    return need_task_ids
+    return getCollector().emitDirect(task, *args, **kwargs)
+
+
+def emitManyBolt(*args, **kwargs):
+    return getCollector().emitMany(*args, **kwargs)
+
+
+def emitBolt(*args, **kwargs):
+    return getCollector().emit(*args, **kwargs)
+
+
+def emitManySpout(*args, **kwargs):
+    return getCollector().emitMany(*args, **kwargs)
+
+
+def emitSpout(*args, **kwargs):
+    return getCollector().emit(*args, **kwargs)
 
 
 def ack(tup):
     """Acknowledge a tuple"""
-    sendMsgToParent({"command": "ack", "id": tup.id})
+    getCollector().ack(tup)
 
 
 def ackId(tupid):
@@ -241,7 +978,7 @@ def ackId(tupid):
 
 def fail(tup):
     """Fail a tuple"""
-    sendMsgToParent({"command": "fail", "id": tup.id})
+    getCollector().fail(tup)
 
 
 def reportError(msg):
@@ -253,6 +990,12 @@ def log(msg):
 
 
 def initComponent():
+    global SERIALIZER, _reader
+    # The setup script exports the serializer named in the topology
+    # configuration. It must be known before reading anything from Storm.
+    SERIALIZER = get_serializer(os.environ.get('PETREL_SERIALIZER'))
+    _reader = FrameReader(_binary_stream(sys.stdin), SERIALIZER, output_buffer.flush)
+
     # Redirect stdout and stderr to logger instances. This is particularly
     # important for stdout so 'print' statements won't crash the Storm Java
     # worker.
@@ -261,12 +1004,38 @@ def initComponent():
 
     setupInfo = readMsg()
     storm_log.info('Task received setupInfo from Storm: %s', setupInfo)
+    load_schemas(setupInfo['context'])
+    output_buffer.configure(setupInfo['conf'])
     sendpid(setupInfo['pidDir'])
+    output_buffer.flush()
     storm_log.info('Task sent pid to Storm')
     return [setupInfo['conf'], setupInfo['context']]
 
 
+# Field names of the tuples this task receives:
+# component -> stream -> {field name: index}.
+_schemas = {}
+
+def set_schema(component, stream, fields):
+    """Sets the field names of the tuples "component" emits on "stream"."""
+    _schemas.setdefault(intern_string(component), {})[intern_string(stream)] = dict(
+        (intern_string(field), i) for i, field in enumerate(fields))
+
+
+def load_schemas(context):
+    """Sets the field names of this task's input streams from the
+    "source->stream->fields" entry of the setup context."""
+    for component, streams in six.iteritems(context.get('source->stream->fields') or {}):
+        for stream, fields in six.iteritems(streams):
+            set_schema(component, stream, fields)
+
+
 class Tuple(object):
+    """A tuple received by a bolt. Values can be accessed by position
+    (tup.values[0] or tup[0]) or by field name (tup['word'] or tup.word).
+    Field names come from the schemas set up from Storm's context, so
+    looking them up allocates nothing. Field names that clash with Tuple
+    attributes (e.g. "id") are only accessible as tup['id']."""
     __slots__ = ['id', 'component', 'stream', 'task', 'values']
     def __init__(self, id, component, stream, task, values):
         self.id = id
@@ -279,7 +1048,7 @@ class Tuple(object):
         if not isinstance(other, Tuple):
             return False
         
-        for k in self.__slots__:
+        for k in Tuple.__slots__:
             if getattr(self, k) != getattr(other, k):
                 return False
             
@@ -291,7 +1060,29 @@ class Tuple(object):
     def __repr__(self):
         return '<%s%s>' % (
                 self.__class__.__name__,
-                ''.join(' %s=%r' % (k, getattr(self, k)) for k in sorted(self.__slots__)))
+                ''.join(' %s=%r' % (k, getattr(self, k)) for k in sorted(Tuple.__slots__)))
+
+    def encode_values(self, serializer):
+        return serializer.encode_value(self.values)
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            try:
+                key = _schemas[self.component][self.stream][key]
+            except KeyError:
+                raise KeyError('No field %r in stream %r of component %r' % (key, self.stream, self.component))
+        return self.values[key]
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails. Unset slots also end up here,
+        # so don't look those up again.
+        if name.startswith('_') or name in Tuple.__slots__:
+            raise AttributeError(name)
+        try:
+            index = _schemas[self.component][self.stream][name]
+        except KeyError:
+            raise AttributeError('No field %r in stream %r of component %r' % (name, self.stream, self.component))
+        return self.values[index]
 
     def is_heartbeat_tuple(self):
         return self.task == -1 and self.stream == "__heartbeat"
@@ -300,16 +1091,64 @@ class Tuple(object):
         return self.task == -1 and self.stream == "__tick"
 
 
+class LazyTuple(Tuple):
+    """Tuple whose values stay encoded until they are first accessed. If a
+    bolt emits the tuple itself (e.g. collector.emit(tup)) without having
+    accessed its values, the encoded values are sent as they are. Bolts
+    only receive LazyTuples with MsgPackSerializer."""
+    __slots__ = ['_values', '_encoded', '_serializer']
+
+    def __init__(self, id, component, stream, task, encoded, serializer):
+        self.id = id
+        self.component = component
+        self.stream = stream
+        self.task = task
+        self._values = None
+        self._encoded = encoded
+        self._serializer = serializer
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self._serializer.decode(self._encoded)
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = values
+
+    def encode_values(self, serializer):
+        # Once decoded, the values may have been modified.
+        if self._values is None and serializer.__class__ is self._serializer.__class__:
+            return self._encoded
+        return serializer.encode_value(self.values)
+
+
 class Task(object):
+    collector_class = OutputCollector
+    # Whether Bolt, BasicBolt and BatchBolt read from Storm on a separate
+    # thread. Also set by "petrel.io.reader_thread" in the conf.
+    reader_thread = False
+
     def shared_initialize(self):
+        global collector
         conf, context = initComponent()
         
         # These values are only available with a patched version of Storm.
         self.task_index = context.get('taskIndex', -1)
         self.worker_port = context.get('workerPort', -1)
+
+        self.collector = collector = self.collector_class(SERIALIZER, output_buffer)
+        self.conf = conf
+        metrics.configure(conf)
         
         self.initialize(conf, context)
 
+    def start_reading(self):
+        """Starts a ReaderThread if it is enabled for this component."""
+        if self.conf.get('petrel.io.reader_thread', self.reader_thread):
+            start_reader_thread()
+
     def report_exception(self, base_message, exception):
         parameters = (
             base_message,
@@ -332,12 +1171,6 @@ class Task(object):
 
 
 class Bolt(Task):
-    def __init__(self):
-        if TUPLE_PROFILING:
-            self.profiler = BoltProfiler()
-        else:
-            self.profiler = None
-
     def initialize(self, stormconf, context):
         pass
 
@@ -348,17 +1181,20 @@ class Bolt(Task):
         global MODE
         MODE = Bolt
         self.shared_initialize()
-        profiler = self.profiler
+        self.start_reading()
+        self.profiler = profiler = make_profiler(self)
         try:
             while True:
-                if profiler is not None: profiler.pre_read()
+                if profiler is not None: t1 = now_ns()
                 tup = readTuple()
                 if tup.is_heartbeat_tuple():
                     sync()
                 else:
-                    if profiler is not None: profiler.post_read()
+                    if profiler is not None: t2 = now_ns()
                     self.process(tup)
-                    if profiler is not None: profiler.post_process()
+                    if profiler is not None:
+                        t3 = now_ns()
+                        profiler.record(tup.stream, t2 - t1, t3 - t2, t3)
         except Exception as e:
             self.report_exception('E_BOLTFAILED', e)
             storm_log.exception('Caught exception in Bolt.run')
@@ -372,12 +1208,6 @@ class Bolt(Task):
 
 
 class BasicBolt(Task):
-    def __init__(self):
-        if TUPLE_PROFILING:
-            self.profiler = BasicBoltProfiler()
-        else:
-            self.profiler = None
-
     def initialize(self, stormconf, context):
         pass
 
@@ -387,22 +1217,24 @@ class BasicBolt(Task):
     def run(self):
         global MODE
         MODE = Bolt
-        global ANCHOR_TUPLE
         self.shared_initialize()
-        profiler = self.profiler
+        self.start_reading()
+        collector = self.collector
+        self.profiler = profiler = make_profiler(self)
         try:
             while True:
-                if profiler is not None: profiler.pre_read()
+                if profiler is not None: t1 = now_ns()
                 tup = readTuple()
                 if tup.is_heartbeat_tuple():
                     sync()
                 else:
-                    if profiler is not None: profiler.post_read()
-                    ANCHOR_TUPLE = tup
+                    if profiler is not None: t2 = now_ns()
+                    collector.anchors = (tup,)
                     self.process(tup)
-                    if profiler is not None: profiler.post_process()
-                    ack(tup)
-                    if profiler is not None: profiler.post_ack()
+                    if profiler is not None: t3 = now_ns()
+                    collector.ack(tup)
+                    if profiler is not None:
+                        profiler.record(tup.stream, t2 - t1, t3 - t2, t3)
         except Exception as e:
             storm_log.info('Caught exception')
             self.report_exception('E_BOLTFAILED', e)
@@ -416,7 +1248,441 @@ class BasicBolt(Task):
                     repr(tup.values)[:2000])
 
 
+class Batch(object):
+    """The tuples passed to BatchBolt.process_batch(). Iterating over a batch
+    yields its tuples. "rows" lists the values of each tuple, and "columns"
+    lists the values of each field across all tuples; column(i) returns a
+    single field. Call fail() to fail every tuple in the batch instead of
+    acking them."""
+    def __init__(self, tuples):
+        self.tuples = tuples
+        self.failed = False
+        self._columns = None
+
+    def __len__(self):
+        return len(self.tuples)
+
+    def __iter__(self):
+        return iter(self.tuples)
+
+    @property
+    def rows(self):
+        return [t.values for t in self.tuples]
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = [list(column) for column in zip(*self.rows)]
+        return self._columns
+
+    def column(self, index):
+        return self.columns[index]
+
+    def fail(self):
+        self.failed = True
+
+
+class BatchBolt(Task):
+    """Bolt that processes tuples in batches rather than one at a time. The
+    bolt collects up to "batch_size" tuples, or whatever arrived within
+    "batch_timeout" seconds of the first one, and passes them to
+    process_batch(). Emits made in process_batch() are anchored to every
+    tuple in the batch. Afterwards, the whole batch is acked (or failed if
+    the batch's fail() was called) in a single write.
+
+    The timeout is checked when tuples, heartbeats or tick tuples arrive.
+    Heartbeats come every few seconds, unless the reader thread answers
+    them, so the component should also receive tick tuples
+    ("topology.tick.tuple.freq.secs") at least as often as the timeout.
+    petrel.emitter.BatchBolt sets this up. The batch
+    settings can also be configured with "petrel.batch.size" and
+    "petrel.batch.timeout_ms"."""
+    batch_size = 100
+    batch_timeout = 1.0
+
+    def initialize(self, stormconf, context):
+        pass
+
+    def process_batch(self, batch):
+        pass
+
+    def get_batch_timeout(self, conf):
+        """Returns the batch timeout in seconds, from "petrel.batch.timeout_ms"
+        in "conf" or else "batch_timeout"."""
+        if 'petrel.batch.timeout_ms' in conf:
+            return float(conf['petrel.batch.timeout_ms']) / 1000.0
+        return self.batch_timeout
+
+    def run(self):
+        global MODE
+        MODE = Bolt
+        self.shared_initialize()
+        self.start_reading()
+        conf = self.conf
+        batch_size = int(conf.get('petrel.batch.size', self.batch_size))
+        batch_timeout = self.get_batch_timeout(conf)
+        tuples = []
+        started = None
+        try:
+            while True:
+                tup = readTuple()
+                if tup.is_heartbeat_tuple():
+                    sync()
+                elif not tup.is_tick_tuple():
+                    if not tuples:
+                        started = time.time()
+                    tuples.append(tup)
+                if tuples and (len(tuples) >= batch_size or time.time() - started >= batch_timeout):
+                    self.run_batch(tuples)
+                    tuples = []
+        except Exception as e:
+            self.report_exception('E_BOLTFAILED', e)
+            storm_log.exception('Caught exception in BatchBolt.run')
+            if tuples:
+                storm_log.error(
+                    'The error occurred while processing a batch of %d tuples starting with: %s',
+                    len(tuples), repr(tuples[0].values)[:2000])
+
+    def run_batch(self, tuples):
+        collector = self.collector
+        batch = Batch(tuples)
+        collector.anchors = tuples
+        try:
+            self.process_batch(batch)
+        finally:
+            collector.anchors = None
+        if batch.failed:
+            collector.failMany(tuples)
+        else:
+            collector.ackMany(tuples)
+
+
+class _TupleOutput(object):
+    """Collects the messages a ThreadPoolBolt worker writes for one tuple.
+    Once the tuple has been handed to the writer thread, later writes (e.g.
+    a delayed ack) go to the writer directly."""
+    def __init__(self, writes):
+        self.writes = writes
+        self.frames = []
+        self.messages = 0
+
+    def write(self, data, messages=1):
+        if self.frames is None:
+            self.writes.put((None, data, messages))
+        else:
+            self.frames.append(data)
+            self.messages += messages
+
+    def close(self, seq):
+        frames, self.frames = self.frames, None
+        self.writes.put((seq, b''.join(frames), self.messages))
+
+
+class ThreadPoolBolt(Task):
+    """Bolt that runs process() on a pool of worker threads, for bolts that
+    spend most of their time in blocking calls. process() receives the tuple
+    and a TupleCollector, which anchors emits to that tuple:
+
+        def process(self, tup, collector):
+            collector.emit([lookup(tup.values[0])])
+
+    If "auto_ack" is True (the default, as with BasicBolt) the tuple is acked
+    when process() returns. Otherwise process() must call collector.ack() or
+    collector.fail(), as with Bolt. Raising FailedException fails the tuple;
+    other exceptions terminate the task.
+
+    A single writer thread sends all messages to Storm, flushing whenever it
+    has nothing else to write. "ordering" controls the order of each tuple's
+    output:
+        None: as tuples complete.
+        "key": in input order for tuples with the same key(). Each key is
+            always handled by the same thread.
+        "global": in input order. Output from fast tuples is held back
+            until slower tuples received before them have completed.
+
+    These can also be configured with "petrel.threads.count",
+    "petrel.threads.ordering" and "petrel.threads.max_pending", the number of
+    tuples that may be waiting for a thread before reading from Storm
+    pauses."""
+    num_threads = 8
+    ordering = None
+    auto_ack = True
+    max_pending = 100
+
+    def initialize(self, stormconf, context):
+        pass
+
+    def process(self, tup, collector):
+        pass
+
+    def key(self, tup):
+        """Returns the key whose tuples keep their order when ordering is
+        "key"."""
+        return tup.values[0]
+
+    def run(self):
+        global MODE
+        MODE = Bolt
+        self.shared_initialize()
+        conf = self.conf
+        num_threads = max(1, int(conf.get('petrel.threads.count', self.num_threads)))
+        ordering = conf.get('petrel.threads.ordering', self.ordering)
+        if ordering not in (None, 'key', 'global'):
+            raise ValueError('Invalid petrel.threads.ordering: %r' % ordering)
+        max_pending = int(conf.get('petrel.threads.max_pending', self.max_pending))
+
+        # Only the writer thread may touch the output buffer.
+        if _reader is not None:
+            _reader.on_block = None
+        self._failed = False
+        writes = queue.Queue()
+        if ordering == 'key':
+            work = [queue.Queue(max(1, max_pending // num_threads)) for i in range(num_threads)]
+        else:
+            work = [queue.Queue(max_pending)] * num_threads
+        writer = self._start_thread(self._write_loop, writes, ordering == 'global')
+        for i in range(num_threads):
+            self._start_thread(self._work_loop, work[i], writes)
+
+        sync_frame = SERIALIZER.encode({'command': 'sync'})
+        key = self.key
+        seq = 0
+        try:
+            while not self._failed:
+                tup = readTuple()
+                if tup.is_heartbeat_tuple():
+                    writes.put((None, sync_frame, 1))
+                    continue
+                if ordering == 'key':
+                    work[hash(key(tup)) % num_threads].put((seq, tup))
+                else:
+                    work[0].put((seq, tup))
+                seq += 1
+        except Exception as e:
+            storm_log.exception('Caught exception in ThreadPoolBolt.run')
+            # Let the tuples already read finish first.
+            for q in set(work):
+                q.join()
+            writes.put((None, None, (e, None)))
+        writer.join()
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        # Don't keep the process alive once run() returns.
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _work_loop(self, work, writes):
+        while True:
+            seq, tup = work.get()
+            output = _TupleOutput(writes)
+            collector = self.collector.bind(tup, output)
+            try:
+                self.process(tup, collector)
+            except FailedException:
+                collector.fail()
+                output.close(seq)
+            except Exception as e:
+                storm_log.exception('Caught exception in ThreadPoolBolt.process')
+                writes.put((seq, None, (e, tup)))
+            else:
+                if self.auto_ack:
+                    collector.ack()
+                output.close(seq)
+            finally:
+                work.task_done()
+
+    def _write_loop(self, writes, ordered):
+        output = self.collector.output
+        held = {}
+        next_seq = 0
+        while True:
+            try:
+                seq, data, messages = writes.get_nowait()
+            except queue.Empty:
+                metrics.send_due()
+                output.flush()
+                seq, data, messages = writes.get()
+            if data is None:
+                exception, tup = messages
+                self._failed = True
+                self.report_exception('E_BOLTFAILED', exception)
+                if tup is not None:
+                    storm_log.error(
+                        'The error occurred while processing this tuple: %s',
+                        repr(tup.values)[:2000])
+                return
+            if not ordered or seq is None:
+                if messages:
+                    output.write(data, messages)
+                continue
+            held[seq] = (data, messages)
+            while next_seq in held:
+                data, messages = held.pop(next_seq)
+                if messages:
+                    output.write(data, messages)
+                next_seq += 1
+
+
+class _SharedBytes(object):
+    """Stands in for a large bytes value that was copied to shared memory
+    rather than pickled."""
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+def _share(obj, threshold, blocks):
+    # Replaces large bytes values in "obj" with _SharedBytes. The new shared
+    # memory blocks are appended to "blocks".
+    if threshold is None:
+        return obj
+    if isinstance(obj, (bytes, bytearray)):
+        if len(obj) < threshold:
+            return obj
+        block = shared_memory.SharedMemory(create=True, size=len(obj))
+        blocks.append(block)
+        block.buf[:len(obj)] = obj
+        return _SharedBytes(block.name, len(obj))
+    if type(obj) in (list, tuple):
+        return type(obj)([_share(o, threshold, blocks) for o in obj])
+    if type(obj) is dict:
+        return dict((k, _share(v, threshold, blocks)) for k, v in six.iteritems(obj))
+    return obj
+
+
+def _unshare(obj, unlink):
+    # Reverses _share(), unlinking the blocks if "unlink" is True.
+    if isinstance(obj, _SharedBytes):
+        block = shared_memory.SharedMemory(name=obj.name)
+        try:
+            return bytes(block.buf[:obj.size])
+        finally:
+            block.close()
+            if unlink:
+                block.unlink()
+    if type(obj) in (list, tuple):
+        return type(obj)([_unshare(o, unlink) for o in obj])
+    if type(obj) is dict:
+        return dict((k, _unshare(v, unlink)) for k, v in six.iteritems(obj))
+    return obj
+
+
+def _run_compute(cls, args, threshold):
+    # Runs in a pool process. The parent unlinks the blocks created for the
+    # result once it has read them.
+    blocks = []
+    result = _share(cls.compute(*_unshare(args, False)), threshold, blocks)
+    for block in blocks:
+        block.close()
+    return result
+
+
+class ProcessPoolBolt(ThreadPoolBolt):
+    """ThreadPoolBolt that runs the CPU-bound part of its work in a pool of
+    processes, so one task can use several cores. Reading from and writing
+    to Storm stay in the task's own process.
+
+    compute() must be a staticmethod; it runs in a pool process. submit()
+    calls it there and returns its result. By default, process() passes the
+    tuple's values to compute() and emits each list of values it returns:
+
+        @staticmethod
+        def compute(text):
+            return [[word] for word in parse(text)]
+
+    process() may be overridden to do other work around submit(), which is
+    safe to call from the worker threads.
+
+    The pool has "num_processes" processes ("petrel.processes.count",
+    default: one per CPU) and is created after initialize(), so the pool
+    processes share whatever initialize() loaded. On Python 3.8 and later,
+    bytes values of at least "shared_memory_threshold" bytes
+    ("petrel.processes.shared_memory_threshold") in the arguments and result
+    are passed in shared memory instead of being pickled."""
+    num_processes = None
+    shared_memory_threshold = 65536
+
+    _pool = None
+    _threshold = None
+
+    @staticmethod
+    def compute(*args):
+        return []
+
+    def process(self, tup, collector):
+        for values in self.submit(*tup.values):
+            collector.emit(values)
+
+    def submit(self, *args):
+        """Calls compute() with "args" in a pool process and returns the
+        result. Without a pool (e.g. under petrel.mock) compute() is called
+        directly."""
+        if self._pool is None:
+            return type(self).compute(*args)
+        blocks = []
+        try:
+            shared = _share(args, self._threshold, blocks)
+            result = self._pool.apply(_run_compute, (type(self), shared, self._threshold))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return _unshare(result, True)
+
+    def shared_initialize(self):
+        super(ProcessPoolBolt, self).shared_initialize()
+        self.start_pool()
+
+    def start_pool(self):
+        conf = self.conf
+        processes = int(conf.get('petrel.processes.count', self.num_processes or multiprocessing.cpu_count()))
+        if shared_memory is not None:
+            self._threshold = int(conf.get('petrel.processes.shared_memory_threshold',
+                                           self.shared_memory_threshold))
+            # Start this process's resource tracker first, so the pool
+            # processes report to it rather than starting their own. Each
+            # block is then tracked once, from its creation until this
+            # process unlinks it, wherever it was created or attached.
+            resource_tracker.ensure_running()
+        self._pool = multiprocessing.Pool(processes)
+        # One thread per process is enough to keep the pool busy.
+        self.num_threads = processes
+
+
 class Spout(Task):
+    """Base class for spouts.
+
+    Each "next" command from Storm calls nextTuple() up to "max_batch" times,
+    stopping early when a call emits nothing. Storm waits for a reply to
+    every "next", so emitting several tuples per command saves round trips.
+    Note that Storm only checks "topology.max.spout.pending" between "next"
+    commands, so it can be exceeded by up to max_batch - 1 calls' worth of
+    tuples. With max_batch above 1, the batch grows by one per "next" while
+    each batch is filled and the sampled ack latency is below
+    "target_latency" seconds, and halves when the latency is above it.
+
+    When a "next" command emits nothing, the spout sleeps before replying,
+    starting at "idle_sleep" seconds and doubling for each idle "next" up to
+    "max_idle_sleep" (0 disables sleeping).
+
+    These can also be configured for each component, e.g. from
+    getComponentConfiguration(), with "petrel.spout.max_batch",
+    "petrel.spout.target_latency_ms", "petrel.spout.idle_sleep_ms" and
+    "petrel.spout.max_idle_sleep_ms"."""
+    collector_class = SpoutOutputCollector
+
+    max_batch = 1
+    target_latency = 0.5
+    idle_sleep = 0.001
+    max_idle_sleep = 0.05
+
+    # The current batch size and sleep, and the smoothed ack latency.
+    batch = 1
+    sleep = 0.0
+    ack_latency = None
+
     def initialize(self, conf, context):
         pass
 
@@ -429,127 +1695,722 @@ class Spout(Task):
     def nextTuple(self):
         pass
 
+    def shared_initialize(self):
+        super(Spout, self).shared_initialize()
+        conf = self.conf
+        self.max_batch = max(1, int(conf.get('petrel.spout.max_batch', self.max_batch)))
+        if 'petrel.spout.target_latency_ms' in conf:
+            self.target_latency = float(conf['petrel.spout.target_latency_ms']) / 1000.0
+        if 'petrel.spout.idle_sleep_ms' in conf:
+            self.idle_sleep = float(conf['petrel.spout.idle_sleep_ms']) / 1000.0
+        if 'petrel.spout.max_idle_sleep_ms' in conf:
+            self.max_idle_sleep = float(conf['petrel.spout.max_idle_sleep_ms']) / 1000.0
+        if self.max_batch > 1:
+            self.collector.sent_times = {}
+
+    def handle_next(self):
+        """Handles Storm's "next" command."""
+        collector = self.collector
+        start = collector.emitted
+        self.next_batch()
+        emitted = collector.emitted - start
+        if emitted:
+            self.sleep = 0.0
+            if self.max_batch > 1:
+                if self.ack_latency is not None and self.ack_latency > self.target_latency:
+                    self.batch = max(1, self.batch // 2)
+                elif emitted >= self.batch:
+                    self.batch = min(self.max_batch, self.batch + 1)
+        elif self.max_idle_sleep > 0:
+            self.sleep = min(self.max_idle_sleep, max(self.idle_sleep, self.sleep * 2))
+            time.sleep(self.sleep)
+
+    def next_batch(self):
+        """Calls nextTuple() up to "batch" times, stopping when a call emits
+        nothing."""
+        collector = self.collector
+        for i in range(self.batch):
+            emitted = collector.emitted
+            self.nextTuple()
+            if collector.emitted == emitted:
+                break
+
+    def _completed(self, id):
+        # Updates the ack latency if the tuple's emit time was sampled.
+        try:
+            sent = self.collector.sent_times.pop(id, None)
+        except TypeError:
+            return
+        if sent is not None:
+            latency = time.time() - sent
+            if self.ack_latency is None:
+                self.ack_latency = latency
+            else:
+                self.ack_latency += 0.2 * (latency - self.ack_latency)
+
+    def activate(self):
+        """Called when the topology is activated."""
+        pass
+
+    def deactivate(self):
+        """Called when the topology is deactivated. nextTuple() is not called
+        again until it is reactivated."""
+        pass
+
     def run(self):
         global MODE
         MODE = Spout
         self.shared_initialize()
+        sent_times = self.collector.sent_times
         try:
             while True:
                 msg = readCommand()
                 command = msg["command"]
                 if command == "next":
-                    self.nextTuple()
+                    self.handle_next()
                 elif command == "ack":
+                    if sent_times:
+                        self._completed(msg["id"])
                     self.ack(msg["id"])
                 elif command == "fail":
+                    if sent_times:
+                        # Timeouts would skew the latency, so just forget
+                        # the tuple.
+                        try:
+                            sent_times.pop(msg["id"], None)
+                        except TypeError:
+                            pass
                     self.fail(msg["id"])
+                elif command == "activate":
+                    self.activate()
+                elif command == "deactivate":
+                    self.deactivate()
                 sync()
         except Exception as e:
             self.report_exception('E_SPOUTFAILED', e)
             storm_log.exception('Caught exception in Spout.run: %s', str(e))
 
 
-class BoltProfiler(object):
-    """Helper class for Bolt. Implements some simple log-based counters for
-    profiling performance."""
-    MAX_COUNT = 1000
+class PrefetchSpout(Spout):
+    """Spout whose data comes from a fetch() generator running on a
+    background thread. The thread fills a queue of up to "queue_size" items,
+    and nextTuple() only takes items from the queue, so a slow source does
+    not hold up acks, fails and heartbeats.
+
+    fetch() yields lists of values, or dicts as accepted by emitMany() (e.g.
+    {"tuple": values, "id": 5}). Each nextTuple() emits up to "max_emit"
+    queued items in one write. If the queue is empty, it waits up to
+    "poll_timeout" seconds for an item. Fetching pauses while the topology
+    is deactivated.
+
+    These can also be configured with "petrel.prefetch.queue_size",
+    "petrel.prefetch.max_emit" and "petrel.prefetch.poll_ms". stats()
+    reports the queue depth and how long nextTuple() has waited for data."""
+    queue_size = 1000
+    max_emit = 100
+    poll_timeout = 0.01
+
+    fetched = 0
+    emitted = 0
+    wait_time = 0.0
+    _queue = None
+
+    def fetch(self):
+        return iter(())
+
+    def start_fetching(self):
+        """Starts the fetch thread. Called by the first nextTuple() if not
+        called before."""
+        conf = getattr(self, 'conf', None) or {}
+        self._max_emit = int(conf.get('petrel.prefetch.max_emit', self.max_emit))
+        if 'petrel.prefetch.poll_ms' in conf:
+            self._poll_timeout = float(conf['petrel.prefetch.poll_ms']) / 1000.0
+        else:
+            self._poll_timeout = self.poll_timeout
+        self._queue = queue.Queue(int(conf.get('petrel.prefetch.queue_size', self.queue_size)))
+        self._active = threading.Event()
+        self._active.set()
+        self._error = None
+        self._thread = threading.Thread(target=self._fetch_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch_loop(self):
+        try:
+            items = iter(self.fetch())
+            while True:
+                # Don't ask the source for more while deactivated.
+                self._active.wait()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self._queue.put(item)
+                self.fetched += 1
+        except Exception as e:
+            storm_log.exception('Caught exception in PrefetchSpout.fetch')
+            self._error = e
+
+    def activate(self):
+        if self._queue is not None:
+            self._active.set()
+
+    def deactivate(self):
+        if self._queue is not None:
+            self._active.clear()
+
+    def nextTuple(self):
+        if self._queue is None:
+            self.start_fetching()
+        q = self._queue
+        items = []
+        try:
+            if q.empty():
+                started = time.time()
+                try:
+                    items.append(q.get(timeout=self._poll_timeout))
+                finally:
+                    self.wait_time += time.time() - started
+            while len(items) < self._max_emit:
+                items.append(q.get_nowait())
+        except queue.Empty:
+            pass
+        if items:
+            self.collector.emitMany(items)
+            self.emitted += len(items)
+        elif self._error is not None:
+            raise self._error
+
+    @property
+    def queue_depth(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'fetched': self.fetched,
+            'emitted': self.emitted,
+            'wait_time': self.wait_time,
+        }
+
+
+class ReliableSpout(Spout):
+    """Spout that tracks its tuples and replays them when they fail.
+    nextTuple() emits with self.emit(), which assigns the tuple an integer
+    message id and returns it. The encoded values are kept until the tuple
+    is acked, so a pending tuple costs little more than its encoded size.
+
+    A failed tuple is replayed by a later "next" command, before nextTuple()
+    is called, after a delay of "retry_delay" seconds multiplied by
+    "retry_backoff" for each earlier retry, up to "max_retry_delay". After
+    "max_retries" retries (None for no limit) it is dropped and dropped() is
+    called. While the stored values exceed "max_pending_bytes", nextTuple()
+    is not called, but replays continue.
+
+    acked() and dropped() may be overridden instead of ack() and fail().
+    These can also be configured with "petrel.reliable.max_retries",
+    "petrel.reliable.retry_delay_ms", "petrel.reliable.retry_backoff",
+    "petrel.reliable.max_retry_delay_ms" and
+    "petrel.reliable.max_pending_bytes". stats() reports the pending tuples,
+    the bytes they hold and how many emits were replays."""
+    max_retries = 3
+    retry_delay = 1.0
+    retry_backoff = 2.0
+    max_retry_delay = 60.0
+    max_pending_bytes = 64 * 1024 * 1024
+
+    def __init__(self):
+        super(ReliableSpout, self).__init__()
+        self._next_id = 0
+        # Message id -> (stream, encoded values)
+        self._pending = {}
+        self._pending_bytes = 0
+        # Message id -> number of times replayed, for failed tuples only.
+        self._retries = {}
+        # Replay delay -> deque of (due time, message id). Every entry in a
+        # deque has the same delay, so each deque is in due time order.
+        self._replays = {}
+        self.emitted = 0
+        self.replayed = 0
+        self.dropped_count = 0
+
+    def shared_initialize(self):
+        super(ReliableSpout, self).shared_initialize()
+        conf = self.conf
+        if 'petrel.reliable.max_retries' in conf:
+            max_retries = conf['petrel.reliable.max_retries']
+            self.max_retries = None if max_retries is None or max_retries < 0 else int(max_retries)
+        if 'petrel.reliable.retry_delay_ms' in conf:
+            self.retry_delay = float(conf['petrel.reliable.retry_delay_ms']) / 1000.0
+        if 'petrel.reliable.max_retry_delay_ms' in conf:
+            self.max_retry_delay = float(conf['petrel.reliable.max_retry_delay_ms']) / 1000.0
+        self.retry_backoff = float(conf.get('petrel.reliable.retry_backoff', self.retry_backoff))
+        self.max_pending_bytes = int(conf.get('petrel.reliable.max_pending_bytes', self.max_pending_bytes))
+
+    def emit(self, values, stream=None):
+        """Emits a tracked tuple and returns its message id."""
+        id = self._next_id
+        self._next_id += 1
+        encoded = self.collector.serializer.encode_value(values)
+        self._pending[id] = (stream, encoded)
+        self._pending_bytes += len(encoded)
+        self.collector.emitEncoded(encoded, stream, id)
+        self.emitted += 1
+        return id
+
+    def next_batch(self):
+        if self._replays:
+            self.replay()
+        if self._pending_bytes < self.max_pending_bytes:
+            super(ReliableSpout, self).next_batch()
+
+    def replay(self, now=None):
+        """Re-emits the failed tuples whose delay has passed."""
+        if now is None:
+            now = time.time()
+        for delay, replays in list(self._replays.items()):
+            while replays and replays[0][0] <= now:
+                id = replays.popleft()[1]
+                entry = self._pending.get(id)
+                if entry is None:
+                    # Acked since it failed, or removed by a subclass.
+                    continue
+                stream, encoded = entry
+                self.collector.emitEncoded(encoded, stream, id)
+                self.replayed += 1
+            if not replays:
+                del self._replays[delay]
+
+    def ack(self, id):
+        entry = self._pending.pop(id, None)
+        if entry is not None:
+            self._pending_bytes -= len(entry[1])
+            self._retries.pop(id, None)
+            self.acked(id)
+
+    def fail(self, id):
+        entry = self._pending.get(id)
+        if entry is None:
+            return
+        retries = self._retries.get(id, 0)
+        if self.max_retries is not None and retries >= self.max_retries:
+            del self._pending[id]
+            self._retries.pop(id, None)
+            self._pending_bytes -= len(entry[1])
+            self.dropped_count += 1
+            self.dropped(id, self.collector.serializer.decode(entry[1]))
+            return
+        self._retries[id] = retries + 1
+        delay = min(self.max_retry_delay, self.retry_delay * self.retry_backoff ** retries)
+        replays = self._replays.get(delay)
+        if replays is None:
+            replays = self._replays[delay] = deque()
+        replays.append((time.time() + delay, id))
+
+    def acked(self, id):
+        """Called when a tuple has been fully processed."""
+        pass
+
+    def dropped(self, id, values):
+        """Called when a tuple has failed more than "max_retries" times."""
+        pass
 
+    def stats(self):
+        total = self.emitted + self.replayed
+        return {
+            'pending': len(self._pending),
+            'pending_bytes': self._pending_bytes,
+            'waiting_replay': sum(len(r) for r in self._replays.values()),
+            'emitted': self.emitted,
+            'replayed': self.replayed,
+            'dropped': self.dropped_count,
+            'replay_rate': float(self.replayed) / total if total else 0.0,
+        }
+
+
+if hasattr(time, 'perf_counter_ns'):
+    # Python 3.7 and later.
+    now_ns = time.perf_counter_ns
+elif hasattr(time, 'perf_counter'):
+    now_ns = lambda: int(time.perf_counter() * 1e9)
+else:
+    now_ns = lambda: int(time.time() * 1e9)
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets. Each power of two is
+    split into SUB_BUCKETS buckets, so recorded values are kept to within
+    1/SUB_BUCKETS of their true value, and a few hundred buckets cover
+    nanoseconds to hours."""
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (self.SUB_BUCKETS * 64)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """Records a value in nanoseconds."""
+        if value < self.SUB_BUCKETS:
+            index = max(0, value)
+        else:
+            shift = value.bit_length() - self.SUB_BITS - 1
+            index = ((shift + 1) << self.SUB_BITS) + (value >> shift) - self.SUB_BUCKETS
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def _upper_bound(self, index):
+        if index < self.SUB_BUCKETS:
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        return (((index & (self.SUB_BUCKETS - 1)) + self.SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, p):
+        """Returns an upper bound on the "p"th percentile, in nanoseconds."""
+        if not self.count:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        """Returns the count, and the mean, p50, p99, p999 and max in
+        microseconds."""
+        return {
+            'count': self.count,
+            'mean_us': self.total / 1000.0 / self.count if self.count else 0.0,
+            'p50_us': self.percentile(50) / 1000.0,
+            'p99_us': self.percentile(99) / 1000.0,
+            'p999_us': self.percentile(99.9) / 1000.0,
+            'max_us': self.max / 1000.0,
+        }
+
+
+class TupleProfiler(object):
+    """Measures how long a bolt spends reading, processing, acking and
+    emitting, with a Histogram of each per input stream. "process" covers
+    the whole process() call, including any emits and acks made in it; "emit"
+    and "ack" are the totals for each tuple. Snapshots are logged every
+    "interval" seconds.
+
+    Profiling is enabled by setting "petrel.profile.tuples" to true in the
+    component conf or the PETREL_TUPLE_PROFILING environment variable to 1.
+    The log interval is "petrel.profile.interval_secs"."""
+    KINDS = ('read', 'process', 'ack', 'emit')
+
+    def __init__(self, interval=60.0):
+        self.interval_ns = int(interval * 1e9)
+        self.streams = {}
+        self._emit_ns = self._ack_ns = 0
+        self._next_dump = None
+
+    def attach(self, collector):
+        """Times the collector's emits, acks and fails. Calls made through
+        the global emit functions are included."""
+        def timed(method, attr):
+            def wrapper(*args, **kwargs):
+                start = now_ns()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    setattr(self, attr, getattr(self, attr) + now_ns() - start)
+            return wrapper
+        # emitDirect() calls emit(), so it is timed as well.
+        for name in ('emit', 'emitMany'):
+            setattr(collector, name, timed(getattr(collector, name), '_emit_ns'))
+        for name in ('ack', 'fail', 'ackMany', 'failMany'):
+            setattr(collector, name, timed(getattr(collector, name), '_ack_ns'))
+
+    def histograms(self, stream):
+        histograms = self.streams.get(stream)
+        if histograms is None:
+            histograms = self.streams[stream] = dict((kind, Histogram()) for kind in self.KINDS)
+        return histograms
+
+    def record(self, stream, read_ns, process_ns, now):
+        """Records one tuple's timings. Call with the time at which the tuple
+        was read and processed, in nanoseconds."""
+        histograms = self.histograms(stream)
+        histograms['read'].record(read_ns)
+        histograms['process'].record(process_ns)
+        histograms['emit'].record(self._emit_ns)
+        histograms['ack'].record(self._ack_ns)
+        self._emit_ns = self._ack_ns = 0
+        if self._next_dump is None:
+            self._next_dump = now + self.interval_ns
+        elif now >= self._next_dump:
+            self.dump()
+            self._next_dump = now + self.interval_ns
+
+    def snapshot(self):
+        """Returns {stream: {kind: Histogram.snapshot()}}."""
+        return dict(
+            (stream, dict((kind, h.snapshot()) for kind, h in six.iteritems(histograms)))
+            for stream, histograms in six.iteritems(self.streams))
+
+    def dump(self):
+        """Logs a snapshot."""
+        for stream, histograms in sorted(self.snapshot().items()):
+            for kind in self.KINDS:
+                h = histograms[kind]
+                storm_log.info(
+                    'Tuple profile: stream=%s %s count=%d mean=%.1fus p50=%.1fus p99=%.1fus p999=%.1fus max=%.1fus',
+                    stream, kind, h['count'], h['mean_us'], h['p50_us'], h['p99_us'], h['p999_us'], h['max_us'])
+
+
+class Counter(object):
+    """Metric that counts events. Reports the count since the last report."""
     def __init__(self):
-        self.read_time = self.process_time = 0.0
-        self.num_tuples = self.total_num_tuples = 0
-        self.start_interval = None
-
-    def pre_read(self):
-        self.t1 = time.time()
-        if self.start_interval is None:
-            self.start_interval = self.t1
-
-    def post_read(self):
-        self.t2 = time.time()
-        self.read_time += self.t2 - self.t1
-
-    def post_process(self):
-        self.t3 = time.time()
-        self.process_time += self.t3 - self.t2
-
-        self.num_tuples += 1
-        if self.num_tuples % self.MAX_COUNT == 0 or self.t3 - self.start_interval > 1.0:
-            self.total_num_tuples += self.num_tuples
-            self.total_time = self.read_time + self.process_time
-            storm_log.debug(
-                'Bolt profile: total_num_tuples=%d, num_tuples=%d, avg_read_time=%f (%.1f%%), avg_process_time=%f (%.1f%%)',
-                self.total_num_tuples,
-                self.num_tuples,
-                self.read_time / self.num_tuples, self.read_time / self.total_time * 100.0,
-                self.process_time / self.num_tuples, self.process_time / self.total_time * 100.0)
-
-            # Clear the timing data.
-            self.start_interval = None
-            self.num_tuples = 0
-            self.read_time = self.process_time = 0.0
-
-
-class BasicBoltProfiler(object):
-    """Helper class for BasicBolt. Implements some simple log-based counters for
-    profiling performance."""
-    MAX_COUNT = 1000
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def report(self, elapsed, reset):
+        value = self.value
+        if reset:
+            self.value = 0
+        return value
+
 
+class Gauge(object):
+    """Metric that reports a current value, either the last one set() or the
+    result of calling "function"."""
+    def __init__(self, function=None):
+        self.function = function
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def report(self, elapsed, reset):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Meter(object):
+    """Metric that counts events and reports their count and rate per second
+    since the last report."""
     def __init__(self):
-        self.read_time = self.process_time = self.ack_time = 0.0
-        self.num_tuples = self.total_num_tuples = 0
-        self.start_interval = None
-
-    def pre_read(self):
-        self.t1 = time.time()
-        if self.start_interval is None:
-            self.start_interval = self.t1
-
-    def post_read(self):
-        self.t2 = time.time()
-        self.read_time += self.t2 - self.t1
-
-    def post_process(self):
-        self.t3 = time.time()
-        self.process_time += self.t3 - self.t2
-
-    def post_ack(self):
-        self.t4 = time.time()
-        self.ack_time += self.t4 - self.t3
-
-        self.num_tuples += 1
-        if self.num_tuples % self.MAX_COUNT == 0 or self.t4 - self.start_interval > 1.0:
-            self.total_num_tuples += self.num_tuples
-            self.total_time = self.read_time + self.process_time + self.ack_time
-            storm_log.debug(
-                'BasicBolt profile: total_num_tuples=%d, num_tuples=%d, avg_read_time=%f (%.1f%%), avg_process_time=%f (%.1f%%), avg_ack_time=%f (%.1f%%)',
-                self.total_num_tuples,
-                self.num_tuples,
-                self.read_time / self.num_tuples, self.read_time / self.total_time * 100.0,
-                self.process_time / self.num_tuples, self.process_time / self.total_time * 100.0,
-                self.ack_time / self.num_tuples, self.ack_time / self.total_time * 100.0)
-
-            # Clear the timing data.
-            self.start_interval = None
-            self.num_tuples = 0
-            self.read_time = self.process_time = self.ack_time = 0.0
+        self.count = 0
+
+    def mark(self, n=1):
+        self.count += n
+
+    def report(self, elapsed, reset):
+        value = {'count': self.count, 'rate': self.count / elapsed if elapsed > 0 else 0.0}
+        if reset:
+            self.count = 0
+        return value
+
+
+class HistogramMetric(Histogram):
+    """Metric that reports the distribution of the non-negative integers
+    recorded since the last report."""
+    def report(self, elapsed, reset):
+        value = {
+            'count': self.count,
+            'mean': float(self.total) / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+        if reset:
+            self.reset()
+        return value
+
+    def record(self, value):
+        super(HistogramMetric, self).record(int(value))
+
+
+class MetricsRegistry(object):
+    """Named metrics, aggregated in the task and reported at most once per
+    "interval" seconds. Updating a metric costs no IPC.
+
+    By default, reports are logged. To send them to Storm's metrics
+    consumers instead, set "petrel.metrics.storm" to true in the conf. Each
+    metric is then sent as a multilang "metrics" command, which Storm only
+    accepts if an IShellMetric (e.g. AssignableShellMetric) with the same
+    name is registered for the component on the JVM side; otherwise Storm
+    kills the task. "petrel.metrics.interval_secs" sets the interval.
+
+    Metrics are updated without locks, so they are only reported from the
+    main thread. With a ReaderThread, that happens before the main thread
+    reads its next tuple."""
+    def __init__(self, interval=60.0):
+        self.interval = interval
+        self.to_storm = False
+        self.metrics = {}
+        self.last_report = time.time()
+        self.reports = 0
+
+    def configure(self, conf):
+        self.interval = float(conf.get('petrel.metrics.interval_secs', self.interval))
+        self.to_storm = bool(conf.get('petrel.metrics.storm', self.to_storm))
+
+    def _get(self, name, metric_class, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(*args)
+        elif not isinstance(metric, metric_class):
+            raise ValueError('Metric %r is a %s, not a %s' % (
+                name, type(metric).__name__, metric_class.__name__))
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name, function=None):
+        gauge = self._get(name, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def meter(self, name):
+        return self._get(name, Meter)
+
+    def histogram(self, name):
+        return self._get(name, HistogramMetric)
+
+    def values(self, reset=False):
+        """Returns {name: value} for all metrics. If "reset" is True, starts
+        a new reporting interval."""
+        now = time.time()
+        elapsed = now - self.last_report
+        values = dict((name, metric.report(elapsed, reset)) for name, metric in list(self.metrics.items()))
+        if reset:
+            self.last_report = now
+        return values
+
+    def clear(self):
+        """Resets every metric, keeping the metric objects."""
+        self.values(reset=True)
+
+    def due(self):
+        """Returns True if the interval has passed."""
+        return bool(self.metrics) and time.time() - self.last_report >= self.interval
+
+    def send_due(self):
+        """Reports the metrics if the interval has passed."""
+        if self.due():
+            self.send()
+
+    def send(self):
+        values = self.values(reset=True)
+        self.reports += 1
+        if self.to_storm:
+            for name, value in sorted(six.iteritems(values)):
+                sendMsgToParent({'command': 'metrics', 'name': name, 'params': value})
+        else:
+            storm_log.info('Metrics: %s', json.dumps(values, sort_keys=True, default=repr))
+
+
+metrics = MetricsRegistry()
+
+
+def make_profiler(task):
+    """Returns a TupleProfiler for "task" if profiling is enabled, or None."""
+    if not (TUPLE_PROFILING or task.conf.get('petrel.profile.tuples')):
+        return None
+    profiler = TupleProfiler(float(task.conf.get('petrel.profile.interval_secs', 60)))
+    profiler.attach(task.collector)
+    storm_log.info('Tuple profiling enabled.')
+    return profiler
 
 
 def initialize_profiling():
     global TUPLE_PROFILING
-    TUPLE_PROFILING = storm_log.isEnabledFor(logging.DEBUG)
-    if TUPLE_PROFILING:
-        storm_log.info('Tuple profiling enabled. Will log tuple processing times.')
-    else:
-        storm_log.info('Tuple profiling NOT enabled. Will not log tuple processing times.')
+    TUPLE_PROFILING = os.environ.get('PETREL_TUPLE_PROFILING', '0') not in ('', '0')
 
 
 class LogStream(object):
     """Object that implements enough of the Python stream API to be used as
     sys.stdout and sys.stderr. Messages are written to the Python logger.
+    Text is logged once its line is complete, and the complete lines from
+    one write() go out as a single record.
     """
     def __init__(self, logger):
         self.logger = logger
- 
+        self._partial = ''
+
     def write(self, message):
-        for line in message.split('\n'):
-            self.logger.error(line)
+        if '\n' not in message:
+            self._partial += message
+            return
+        lines, rest = message.rsplit('\n', 1)
+        lines, self._partial = self._partial + lines, rest
+        self.logger.error(lines)
+
+    def flush(self):
+        if self._partial:
+            partial, self._partial = self._partial, ''
+            self.logger.error(partial)
+
+
+class SampledLogger(object):
+    """Wraps a logger for messages logged for every tuple. Only one in
+    "every" messages is logged, and at most "per_second" a second if that
+    is set. Each message that is logged says how many were skipped since
+    the previous one. Messages below the logger's level cost only the
+    level check, as with a plain logger.
+
+        log = storm.SampledLogger('splitsentence', every=1000)
+        log.debug('Processing %s', tup)
+    """
+    def __init__(self, logger, every=100, per_second=None):
+        if isinstance(logger, six.string_types):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.every = max(1, int(every))
+        self.per_second = per_second
+        self.seen = 0
+        self.skipped = 0
+        self._second = None
+        self._in_second = 0
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        self.seen += 1
+        if self.seen % self.every:
+            self.skipped += 1
+            return
+        if self.per_second is not None:
+            second = int(time.time())
+            if second != self._second:
+                self._second = second
+                self._in_second = 0
+            if self._in_second >= self.per_second:
+                self.skipped += 1
+                return
+            self._in_second += 1
+        if self.skipped:
+            msg = '%s (%d similar messages skipped)' % (msg, self.skipped)
+            self.skipped = 0
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import unittest
+
+from petrel import mock
+from petrel import storm
+from petrel.asyncbolt import AsyncBolt
+from petrel.tests.test_storm import OutputTestCase
+
+
+class SleepBolt(AsyncBolt):
+    max_in_flight = 2
+
+    def __init__(self):
+        super(SleepBolt, self).__init__()
+        self.running = 0
+        self.max_running = 0
+
+    async def process(self, tup, collector):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            delay = tup.values[0]
+            await asyncio.sleep(delay)
+            if delay < 0:
+                raise storm.FailedException()
+            collector.emit([delay * 10])
+        finally:
+            self.running -= 1
+
+
+class TestAsyncBolt(OutputTestCase):
+    def run_bolt(self, bolt, messages):
+        serializer = storm.JsonSerializer()
+        bolt.collector = storm.OutputCollector(serializer, storm.output_buffer)
+        bolt.conf = {}
+        old_reader = storm._reader
+        storm._reader = storm.FrameReader(None, serializer)
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b''.join(serializer.encode(msg) for msg in messages))
+        os.close(write_fd)
+        loop = asyncio.new_event_loop()
+        try:
+            with os.fdopen(read_fd, 'rb') as stdin:
+                self.assertRaises(storm.StormIPCException, loop.run_until_complete,
+                                  bolt.run_async(loop, stdin))
+        finally:
+            loop.close()
+            storm._reader = old_reader
+        return self.sent_messages()
+
+    def test_out_of_order(self):
+        def tup(id, delay, stream='default', task=1):
+            return {'id': id, 'comp': 'spout', 'stream': stream, 'task': task, 'tuple': [delay]}
+
+        bolt = SleepBolt()
+        messages = self.run_bolt(bolt, [
+            tup('1', 0.2),
+            tup('2', 0.05),
+            tup('3', -0.01),
+            tup('hb', 0, '__heartbeat', -1),
+        ])
+        self.assertEqual([
+            {'command': 'sync'},
+            {'command': 'emit', 'anchors': ['2'], 'tuple': [0.5], 'need_task_ids': False},
+            {'command': 'ack', 'id': '2'},
+            {'command': 'fail', 'id': '3'},
+            {'command': 'emit', 'anchors': ['1'], 'tuple': [2.0], 'need_task_ids': False},
+            {'command': 'ack', 'id': '1'},
+        ], messages)
+        self.assertEqual(2, bolt.max_running)
+
+    def test_mock(self):
+        spout = mock.MockSpout(['delay'], [[0], [-1], [0.01]])
+        bolt = SleepBolt()
+        result = mock.run_simple_topology(None, [spout, bolt], result_type=mock.LIST)
+        self.assertEqual([[0], [0.1]], result[bolt])
+
+
+if __name__ == '__main__':
+    unittest.main()
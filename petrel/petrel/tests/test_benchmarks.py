@@ -0,0 +1,24 @@
+import unittest
+
+from petrel import benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run(self):
+        results = benchmarks.run_benchmarks(r'^(ack|readTuple)\[json', repeat=1, min_time=0.001)
+        self.assertEqual(
+            ['ack[json]', 'readTuple[json,large]', 'readTuple[json,medium]', 'readTuple[json,small]'],
+            sorted(results['results']))
+        for result in results['results'].values():
+            self.assertTrue(result['ns_per_op'] > 0)
+
+    def test_compare(self):
+        old = {'results': {'a': {'ns_per_op': 100.0}, 'b': {'ns_per_op': 100.0}, 'c': {'ns_per_op': 1.0}}}
+        new = {'results': {'a': {'ns_per_op': 105.0}, 'b': {'ns_per_op': 150.0}, 'd': {'ns_per_op': 1.0}}}
+        rows, regressions = benchmarks.compare(old, new, threshold=0.1)
+        self.assertEqual([('a', 100.0, 105.0, 1.05), ('b', 100.0, 150.0, 1.5)], rows)
+        self.assertEqual(['b'], regressions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+from petrel import storm
+from petrel.harness import Harness, HarnessError
+
+UPPER_BOLT = '''
+from petrel import storm
+
+class UpperBolt(storm.BasicBolt):
+    def process(self, tup):
+        if tup.word == 'fail':
+            raise ValueError(tup.word)
+        storm.emit([tup.word.upper()])
+
+def run():
+    UpperBolt().run()
+'''
+
+COUNT_SPOUT = '''
+from petrel import storm
+
+class CountSpout(storm.Spout):
+    count = 0
+
+    def nextTuple(self):
+        self.count += 1
+        storm.emit([self.count], id=self.count)
+
+    def ack(self, id):
+        storm.log('acked %s' % id)
+
+def run():
+    CountSpout().run()
+'''
+
+
+class TestHarness(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, source in (('upperbolt', UPPER_BOLT), ('countspout', COUNT_SPOUT)):
+            with open(os.path.join(self.dir, name + '.py'), 'w') as f:
+                f.write(textwrap.dedent(source))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_bolt(self):
+        with Harness('upperbolt', source_fields=['word'], cwd=self.dir, collect=True) as harness:
+            report = harness.run_bolt([['a'], ['b']] * 50, max_pending=10, heartbeat_interval=0.01, timeout=30)
+        self.assertEqual(100, report['tuples'])
+        self.assertEqual(100, report['acks'])
+        self.assertEqual(100, report['latency']['count'])
+        self.assertEqual([['A'], ['B']], [m['tuple'] for m in harness.emits[:2]])
+        self.assertEqual(['0'], harness.emits[0]['anchors'])
+
+    @unittest.skipIf(storm.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        with Harness('upperbolt', source_fields=['word'], cwd=self.dir,
+                     serializer=storm.MsgPackSerializer.name, collect=True) as harness:
+            self.assertTrue(isinstance(harness.serializer, storm.MsgPackSerializer))
+            report = harness.run_bolt([['a'], ['b']], timeout=30)
+        self.assertEqual(2, report['acks'])
+        self.assertEqual([['A'], ['B']], [m['tuple'] for m in harness.emits])
+
+    def test_spout(self):
+        with Harness('countspout', cwd=self.dir) as harness:
+            report = harness.run_spout(count=5, timeout=30)
+        self.assertEqual(5, report['emits'])
+        self.assertEqual(5, report['acks'])
+        self.assertEqual(['acked %d' % i for i in range(1, 6)], harness.logs)
+
+    def test_failure(self):
+        with Harness('upperbolt', source_fields=['word'], cwd=self.dir) as harness:
+            with self.assertRaises(HarnessError) as cm:
+                harness.run_bolt([['fail']], timeout=30)
+        self.assertTrue('E_BOLTFAILED' in str(cm.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
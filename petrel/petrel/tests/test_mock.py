@@ -0,0 +1,205 @@
+import collections
+import unittest
+
+from petrel import mock
+from petrel import storm
+
+
+class SplitBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return ['word']
+
+    def process(self, tup):
+        storm.emitMany(
+            [{'tuple': [word], 'stream': 'long'} if len(word) > 3 else [word]
+             for word in tup.sentence.split()])
+
+
+class CountBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return ['word']
+
+    def initialize(self, conf, context):
+        self.words = storm.metrics.counter('words')
+        self.lengths = storm.metrics.histogram('lengths')
+
+    def process(self, tup):
+        self.words.inc()
+        self.lengths.record(len(tup.word))
+        storm.emit(tup)
+
+
+class SumBolt(storm.BatchBolt):
+    batch_size = 2
+
+    def declareOutputFields(self):
+        return ['total']
+
+    def process_batch(self, batch):
+        storm.emit([sum(batch.column(0))])
+
+
+class ReplaySpout(storm.Spout):
+    """Emits each id once, and replays it once if it fails."""
+    def __init__(self, ids):
+        self.queue = collections.deque(ids)
+        self.acked = []
+        self.failed = []
+
+    def declareOutputFields(self):
+        return ['n']
+
+    def nextTuple(self):
+        if self.queue:
+            n = self.queue.popleft()
+            storm.emit([n], id=n)
+
+    def ack(self, id):
+        self.acked.append(id)
+
+    def fail(self, id):
+        if id not in self.failed:
+            self.queue.append(id)
+        self.failed.append(id)
+
+
+class FilterBolt(storm.Bolt):
+    """Fails multiples of 3, and never acks multiples of 5."""
+    def declareOutputFields(self):
+        return ['n']
+
+    def process(self, tup):
+        if tup.n % 3 == 0:
+            storm.fail(tup)
+        else:
+            storm.emit([tup.n], anchors=[tup])
+            if tup.n % 5 != 0:
+                storm.ack(tup)
+
+
+class EchoBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return ['n']
+
+    def process(self, tup):
+        storm.emit(tup)
+
+
+class TestMock(unittest.TestCase):
+    def test_emit_many(self):
+        spout = mock.MockSpout(['sentence'], [['a quick fox'], ['jumped']])
+        bolt = SplitBolt()
+        result = mock.run_simple_topology(None, [spout, bolt], result_type=mock.STORM_TUPLE)
+        self.assertEqual(
+            [(['a'], None), (['quick'], 'long'), (['fox'], None), (['jumped'], 'long')],
+            [(t.values, t.stream) for t in result[bolt]])
+
+    def test_emit_many_spout(self):
+        class ManySpout(storm.Spout):
+            def nextTuple(self):
+                storm.emitMany([['a'], {'tuple': ['b'], 'id': 2}], id=1)
+
+        spout = ManySpout()
+        with mock.Mock() as m:
+            m.activate(spout)
+            spout.nextTuple()
+            self.assertEqual(
+                [(['a'], 1), (['b'], 2)],
+                [(t.values, t.id) for t in m.pending[m.emitter_id(spout)]])
+
+    def test_metrics(self):
+        spout = mock.MockSpout(['word'], [['a'], ['bb'], ['ccc']])
+        bolt = CountBolt()
+        result = mock.run_simple_topology({}, [spout, bolt], result_type=mock.LIST)
+        self.assertEqual([['a'], ['bb'], ['ccc']], result[bolt])
+        values = mock.metric_values()
+        self.assertEqual(3, values['words'])
+        self.assertEqual((3, 3), (values['lengths']['count'], values['lengths']['max']))
+
+    def test_batch_bolt(self):
+        spout = mock.MockSpout(['number'], [[1], [2], [3], [4], [5]])
+        bolt = SumBolt()
+        result = mock.run_simple_topology(None, [spout, bolt], result_type=mock.LIST)
+        self.assertEqual([[3], [7], [5]], result[bolt])
+
+    def test_batch_size_conf(self):
+        spout = mock.MockSpout(['number'], [[1], [2], [3], [4], [5]])
+        bolt = SumBolt()
+        result = mock.run_simple_topology({'petrel.batch.size': 3}, [spout, bolt], result_type=mock.LIST)
+        self.assertEqual([[6], [9]], result[bolt])
+
+    def test_stream(self):
+        sentences = (['a %d' % i] for i in range(1000))
+        spout = mock.MockSpout(['sentence'], sentences)
+        split = SplitBolt()
+        count = CountBolt()
+        words = []
+        stats = mock.stream_simple_topology({}, [spout, split, count], words.append, result_type=mock.LIST)
+        self.assertEqual(2000, len(words))
+        self.assertEqual([['a'], ['0'], ['a'], ['1']], words[:4])
+        # Nothing is kept.
+        self.assertEqual(0, sum(len(q) for q in mock._last_mock.processed.values()))
+        self.assertEqual(1000, spout.index)
+        self.assertEqual(1000, stats[spout]['emitted'])
+        self.assertEqual((1000, 2000, 2.0, 2), tuple(stats[split][k] for k in ('tuples', 'emitted', 'fan_out', 'max_fan_out')))
+        self.assertEqual((2000, 2000, 1.0), tuple(stats[count][k] for k in ('tuples', 'emitted', 'fan_out')))
+        self.assertEqual(1000, stats[split]['process_time']['count'])
+        self.assertTrue(stats[count]['tuples_per_sec'] > 0)
+        self.assertEqual(stats, mock.component_stats())
+
+    def test_stream_partial_batch(self):
+        spout = mock.MockSpout(['number'], iter([[1], [2], [3]]))
+        result = []
+        mock.stream_simple_topology(None, [spout, SumBolt()], result.append, result_type=mock.LIST)
+        self.assertEqual([[3], [3]], result)
+
+    def test_max_spout_emits(self):
+        spout = mock.MockSpout(['number'], iter([[1], [2], [3], [4], [5]]))
+        result = []
+        mock.stream_simple_topology(None, [spout], result.append, result_type=mock.LIST, max_spout_emits=2)
+        self.assertEqual([[1], [2]], result)
+        result = mock.run_simple_topology(None, [spout], result_type=mock.LIST)
+        self.assertEqual([[3], [4], [5]], result[spout])
+
+
+    def test_acker(self):
+        spout = ReplaySpout([1, 2, 3, 4])
+        echo = EchoBolt()
+        result = mock.run_simple_topology(None, [spout, FilterBolt(), echo], result_type=mock.LIST)
+        self.assertEqual([[1], [2], [4]], result[echo])
+        self.assertEqual([1, 2, 4], spout.acked)
+        self.assertEqual([3], spout.failed)
+        stats = mock.acker_stats()
+        self.assertEqual((3, 1, 0, 0, 0), tuple(stats[k] for k in ('acked', 'failed', 'timed_out', 'pending', 'replayed')))
+        self.assertEqual(3, stats['complete_latency']['count'])
+
+    def test_acker_replay(self):
+        spout = ReplaySpout(range(1, 7))
+        mock.stream_simple_topology(None, [spout, FilterBolt(), EchoBolt()], lambda t: None)
+        self.assertEqual([1, 2, 4], spout.acked)
+        # 3 and 6 fail twice; 5 is never acked.
+        self.assertEqual([3, 6, 3, 6], spout.failed)
+        stats = mock.acker_stats()
+        self.assertEqual((3, 4, 1, 2), tuple(stats[k] for k in ('acked', 'failed', 'pending', 'replayed')))
+
+    def test_acker_timeout(self):
+        spout = ReplaySpout([5, 10])
+        mock.stream_simple_topology({'topology.message.timeout.secs': 0}, [spout, FilterBolt()], lambda t: None)
+        self.assertEqual([5, 10, 5, 10], spout.failed)
+        stats = mock.acker_stats()
+        self.assertEqual((0, 4, 0, 2), tuple(stats[k] for k in ('acked', 'timed_out', 'pending', 'replayed')))
+
+    def test_acker_unanchored(self):
+        class UnanchoredBolt(FilterBolt):
+            def process(self, tup):
+                storm.emit([tup.n])
+                storm.ack(tup)
+
+        # The tree completes without waiting for the unanchored tuple.
+        spout = ReplaySpout([1])
+        mock.run_simple_topology(None, [spout, UnanchoredBolt(), FilterBolt()])
+        self.assertEqual([1], spout.acked)
+
+
+if __name__ == '__main__':
+    unittest.main()
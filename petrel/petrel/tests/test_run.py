@@ -0,0 +1,177 @@
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from petrel import run
+
+
+class TestProfileHandler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_path = run.log_file_path
+        run.log_file_path = os.path.join(self.dir, 'task.log')
+
+    def tearDown(self):
+        run.stop_profile()
+        run.log_file_path = self.saved_path
+        shutil.rmtree(self.dir)
+
+    def pstats_files(self):
+        return [f for f in os.listdir(self.dir) if f.endswith('.pstats')]
+
+    def test_start_stop(self):
+        run.start_profile()
+        self.assertIsNotNone(run.profiler)
+        path = run.stop_profile()
+        self.assertIsNone(run.profiler)
+        self.assertEqual([os.path.basename(path)], self.pstats_files())
+        self.assertTrue(os.path.basename(path).startswith('task.%d.' % os.getpid()))
+
+    @unittest.skipIf(run.PROFILE_SIGNAL is None, 'No SIGUSR2 on this platform')
+    def test_timed_profile(self):
+        old_handler = signal.getsignal(run.PROFILE_SIGNAL)
+        run.install_profile_handler()
+        try:
+            run.start_profile(0.05)
+            deadline = time.time() + 5
+            while run.profiler is not None and time.time() < deadline:
+                time.sleep(0.01)
+                run.storm.run_main_thread_calls()
+            self.assertIsNone(run.profiler)
+            self.assertEqual(1, len(self.pstats_files()))
+        finally:
+            signal.signal(run.PROFILE_SIGNAL, old_handler)
+
+    @unittest.skipIf(run.PROFILE_SIGNAL is None, 'No SIGUSR2 on this platform')
+    def test_signal(self):
+        old_handler = signal.getsignal(run.PROFILE_SIGNAL)
+        run.install_profile_handler()
+        try:
+            os.kill(os.getpid(), run.PROFILE_SIGNAL)
+            # The handler leaves the work to the main loop.
+            self.assertIsNone(run.profiler)
+            run.storm.run_main_thread_calls()
+            self.assertIsNotNone(run.profiler)
+            os.kill(os.getpid(), run.PROFILE_SIGNAL)
+            run.storm.run_main_thread_calls()
+            self.assertIsNone(run.profiler)
+            self.assertEqual(1, len(self.pstats_files()))
+        finally:
+            signal.signal(run.PROFILE_SIGNAL, old_handler)
+            run.storm.main_thread_calls.clear()
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super(RecordingHandler, self).__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLogQueue(unittest.TestCase):
+    def test_queue_handler(self):
+        log_queue = run.LogQueue(capacity=2)
+        info, errors = RecordingHandler(logging.INFO), RecordingHandler(logging.ERROR)
+        handler = run.QueueHandler(log_queue, [info, errors])
+        logger = logging.getLogger('petrel.tests.queue')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            values = ['a']
+            logger.info('values: %s', values)
+            values.append('b')
+            logger.error('error')
+            logger.error('dropped')
+            self.assertEqual(1, log_queue.dropped)
+            log_queue.start()
+            log_queue.stop()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(["values: ['a']", 'error'], [r.getMessage() for r in info.records[:2]])
+        self.assertEqual(['error'], [r.getMessage() for r in errors.records])
+        self.assertTrue('Dropped 1 log records' in info.records[2].getMessage())
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'No fork on this platform')
+    def test_child_process(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        file_handler = logging.FileHandler(path)
+        logger = logging.getLogger('petrel.tests.child')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(file_handler)
+        log_queue = run.LogQueue()
+        try:
+            log_queue.replace_handlers(logger)
+            log_queue.start()
+            # The child has no thread to drain the queue, so it must write
+            # to the file itself.
+            child = multiprocessing.get_context('fork').Process(target=logger.info, args=('child',))
+            child.start()
+            child.join()
+            logger.info('parent')
+            log_queue.stop()
+            log_queue.restore_handlers()
+            self.assertEqual([file_handler], logger.handlers)
+            with open(path) as f:
+                self.assertEqual(['child', 'parent'], f.read().split())
+        finally:
+            logger.handlers = []
+            file_handler.close()
+            os.remove(path)
+
+
+class TestStormHandler(unittest.TestCase):
+    def setUp(self):
+        self.old_log = run.storm.log
+        self.sent = []
+        run.storm.log = self.sent.append
+
+    def tearDown(self):
+        run.storm.log = self.old_log
+
+    def test_batching(self):
+        handler = run.StormHandler(capacity=3, flush_interval=60)
+        handler.format_string = '%s'
+        logger = logging.getLogger('petrel.tests.storm_handler')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        try:
+            logger.info('a\nb')
+            logger.info('c')
+            self.assertEqual([], self.sent)
+            logger.error('d')
+            self.assertEqual(['a\nb\nc\nd'], self.sent)
+            logger.info('e')
+            handler.close()
+            self.assertEqual(['a\nb\nc\nd', 'e'], self.sent)
+        finally:
+            logger.removeHandler(handler)
+
+    def test_flush_on_sync(self):
+        handler = run.StormHandler(capacity=100, flush_interval=0.01)
+        handler.format_string = '%s'
+        old_output_buffer = run.storm.output_buffer
+        run.storm.output_buffer = run.storm.OutputBuffer(io.BytesIO())
+        try:
+            handler.handle(logging.makeLogRecord({'msg': 'a', 'levelno': logging.INFO}))
+            run.storm.sync()
+            self.assertEqual([], self.sent)
+            # No more records arrive; the next sync after the interval sends it.
+            time.sleep(0.02)
+            run.storm.sync()
+            self.assertEqual(['a'], self.sent)
+        finally:
+            handler.close()
+            run.storm.output_buffer = old_output_buffer
+        self.assertFalse(handler.flush_due in run.storm.sync_hooks)
@@ -0,0 +1,179 @@
+from collections import defaultdict, namedtuple
+import unittest
+
+from petrel import mock
+from petrel import storm
+from petrel.simulator import Simulator, java_hash, fields_task_index
+
+
+class SplitBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return ['word']
+
+    def process(self, tup):
+        for word in tup.sentence.split():
+            storm.emit([word])
+
+
+class WordCountBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return ['word', 'count']
+
+    def initialize(self, conf, context):
+        self.task_id = context['taskid']
+        self.counts = defaultdict(int)
+
+    def process(self, tup):
+        self.counts[tup.word] += 1
+        storm.emit([tup.word, self.counts[tup.word]])
+
+
+class RouterBolt(storm.Bolt):
+    """Sends each word to the task given by its length."""
+    def declareOutputFields(self):
+        return ['word']
+
+    def initialize(self, conf, context):
+        self.targets = sorted(t for t, c in context['task->component'].items() if c == 'sink')
+
+    def process(self, tup):
+        self.collector.emitDirect(self.targets[len(tup.word) % len(self.targets)], [tup.word], anchors=[tup])
+        self.collector.ack(tup)
+
+
+class SinkBolt(storm.BasicBolt):
+    def declareOutputFields(self):
+        return []
+
+    def initialize(self, conf, context):
+        self.task_id = context['taskid']
+        self.words = []
+
+    def process(self, tup):
+        self.words.append(tup.values[0])
+
+
+SENTENCES = [['the cow jumped over the moon'], ['an apple a day keeps the doctor away']] * 50
+
+
+class TestJavaHash(unittest.TestCase):
+    def test_hash(self):
+        # Values of hashCode() computed in Java.
+        self.assertEqual(99162322, java_hash(u'hello'))
+        self.assertEqual(0, java_hash(u''))
+        self.assertEqual(1772899, java_hash(u'\U0001F600'))
+        self.assertEqual(1, java_hash(1))
+        self.assertEqual(0, java_hash(-1))
+        self.assertEqual(1, java_hash(1 << 32))
+        self.assertEqual(1072693248, java_hash(1.0))
+        self.assertEqual(1231, java_hash(True))
+        self.assertEqual(0, java_hash(None))
+        self.assertEqual(31 + 97, java_hash([u'a']))
+        self.assertEqual(31 * 31 + 31 * 1 - 1, java_hash(bytearray(b'\x01\xff')))
+
+    def test_fields_task_index(self):
+        self.assertEqual((31 + 99162322) % 3, fields_task_index([u'hello'], 3))
+        # Negative hash codes still give a valid index, as with floorMod().
+        self.assertEqual(-2147483648, java_hash(u'polygenelubricants'))
+        self.assertEqual(3, fields_task_index([u'polygenelubricants'], 5))
+
+
+class TestSimulator(unittest.TestCase):
+    def word_count(self, **kwargs):
+        sim = Simulator(**kwargs)
+        sim.add_spout('spout', mock.MockSpout(['sentence'], SENTENCES))
+        sim.add_bolt('split', SplitBolt(), {('spout', 'default'): ('shuffle', None)}, 2)
+        sim.add_bolt('count', WordCountBolt(), {('split', 'default'): ('fields', ['word'])}, 3)
+        return sim
+
+    def test_groupings(self):
+        sim = self.word_count()
+        stats = sim.run()
+        self.assertEqual(100, stats['spout']['emitted'])
+        self.assertEqual([50, 50], stats['split']['tasks'])
+        self.assertEqual(700, stats['count']['executed'])
+        self.assertEqual(700, stats['count']['acked'])
+        # Task ids follow component order: count, split, spout.
+        self.assertEqual([1, 2, 3], [t.task_id for t in sim.tasks['count']])
+        for index, task in enumerate(sim.tasks['count']):
+            for word in task.emitter.counts:
+                self.assertEqual(index, fields_task_index([word], 3))
+        self.assertEqual(150, sum(t.emitter.counts['the'] for t in sim.tasks['count']))
+
+    def test_bounded(self):
+        class WatchBolt(WordCountBolt):
+            def process(self, tup):
+                self.max_queued = max(getattr(self, 'max_queued', 0), sim.queued)
+                super(WatchBolt, self).process(tup)
+
+        sim = Simulator(max_queued=10, bolt_batch=1)
+        sim.add_spout('spout', mock.MockSpout(['sentence'], SENTENCES))
+        sim.add_bolt('split', SplitBolt(), {('spout', 'default'): ('shuffle', None)})
+        sim.add_bolt('count', WatchBolt(), {('split', 'default'): ('fields', ['word'])})
+        sim.run()
+        # At most one sentence beyond the limit is split at a time.
+        self.assertTrue(sim.tasks['count'][0].emitter.max_queued <= 10 + 8)
+
+    def test_max_spout_emits(self):
+        sim = self.word_count()
+        stats = sim.run(max_spout_emits=10)
+        self.assertEqual(10, stats['spout']['emitted'])
+        self.assertEqual(0, sim.queued)
+
+    def test_all_global_direct(self):
+        sim = Simulator()
+        sim.add_spout('spout', mock.MockSpout(['word'], [['a'], ['bb'], ['ccc']]))
+        sim.add_bolt('all', SinkBolt(), {('spout', 'default'): ('all', None)}, 2)
+        sim.add_bolt('global', SinkBolt(), {('spout', 'default'): ('global', None)}, 2)
+        sim.add_bolt('router', RouterBolt(), {('spout', 'default'): ('shuffle', None)})
+        sim.add_bolt('sink', SinkBolt(), {('router', 'default'): ('direct', None)}, 2)
+        sim.run()
+        self.assertEqual([['a', 'bb', 'ccc']] * 2, [t.emitter.words for t in sim.tasks['all']])
+        self.assertEqual([['a', 'bb', 'ccc'], []], [t.emitter.words for t in sim.tasks['global']])
+        self.assertEqual([['bb'], ['a', 'ccc']], [t.emitter.words for t in sim.tasks['sink']])
+        self.assertEqual(3, sim.stats()['router']['acked'])
+
+    def test_from_builder(self):
+        # Stand-ins for TopologyBuilder and the Thrift structures it holds.
+        GlobalStreamId = namedtuple('GlobalStreamId', ['componentId', 'streamId'])
+        StreamInfo = namedtuple('StreamInfo', ['output_fields'])
+
+        class Grouping(object):
+            def __init__(self, fields=None, **kwargs):
+                self.fields = fields
+                self.__dict__.update(kwargs)
+
+        class Common(object):
+            def __init__(self, parallelism_hint, fields, inputs=None):
+                self.parallelism_hint = parallelism_hint
+                self.streams = {'default': StreamInfo(fields)}
+                self.inputs = inputs or {}
+
+        class Builder(object):
+            pass
+
+        builder = Builder()
+        builder._spouts = {'spout': mock.MockSpout(['sentence'], SENTENCES)}
+        builder._bolts = {'split': SplitBolt(), 'count': WordCountBolt(), 'sink': SinkBolt()}
+        builder._commons = {
+            'spout': Common(None, ['sentence']),
+            'split': Common(2, ['word'], {GlobalStreamId('spout', 'default'): Grouping(shuffle=object())}),
+            'count': Common(3, ['word', 'count'], {GlobalStreamId('split', 'default'): Grouping(fields=['word'])}),
+            'sink': Common(2, [], {GlobalStreamId('count', 'default'): Grouping(fields=[])}),
+        }
+        sim = Simulator.from_builder(builder)
+        self.assertEqual(dict(spout=1, split=2, count=3, sink=2),
+                         dict((id, spec['parallelism']) for id, spec in sim.components.items()))
+        self.assertEqual({('spout', 'default'): ('shuffle', None)}, sim.components['split']['inputs'])
+        self.assertEqual({('split', 'default'): ('fields', ['word'])}, sim.components['count']['inputs'])
+        self.assertEqual({('count', 'default'): ('global', [])}, sim.components['sink']['inputs'])
+        stats = sim.run()
+        self.assertEqual([50, 50], stats['split']['tasks'])
+        for index, task in enumerate(sim.tasks['count']):
+            for word in task.emitter.counts:
+                self.assertEqual(index, fields_task_index([word], 3))
+        self.assertEqual([700, 0], [len(t.emitter.words) for t in sim.tasks['sink']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from six import StringIO
+
+from petrel import skew
+from petrel.simulator import fields_task_index
+
+
+COMPONENTS = {
+    'spout': {'parallelism': 1, 'streams': {'default': ['sentence']}, 'inputs': None},
+    'split': {'parallelism': 2, 'streams': {'default': ['word', 'length']},
+              'inputs': {('spout', 'default'): ('shuffle', None)}},
+    'count': {'parallelism': 3, 'streams': {'default': ['word', 'count']},
+              'inputs': {('split', 'default'): ('fields', ['word'])}},
+}
+
+
+class TestSkew(unittest.TestCase):
+    def test_fields_groupings(self):
+        self.assertEqual([('split', 'default', 'count', ['word'])], skew.fields_groupings(COMPONENTS))
+
+    def test_count_keys(self):
+        counts = skew.count_keys([['a', 1], ['b', 1], {'word': 'a', 'length': 1}], ['word'], ['word', 'length'])
+        self.assertEqual({'["a"]': [['a'], 2], '["b"]': [['b'], 1]}, counts)
+
+    def test_analyze(self):
+        # One key has half of the tuples.
+        tuples = [['the', 3]] * 50 + [['w%d' % i, 2] for i in range(50)]
+        counts = skew.count_keys(tuples, ['word'], ['word', 'length'])
+        report = skew.analyze(counts, 3, top=2, max_parallelism=8)
+        self.assertEqual((100, 51, 3), (report['tuples'], report['keys'], report['parallelism']))
+        self.assertEqual(100, sum(task['tuples'] for task in report['tasks']))
+        self.assertEqual(51, sum(task['keys'] for task in report['tasks']))
+        for i, task in enumerate(report['tasks']):
+            expected = sum(1 for values in tuples if fields_task_index(values[:1], 3) == i)
+            self.assertEqual(expected, task['tuples'])
+        hot = report['heaviest_keys'][0]
+        self.assertEqual((['the'], 50, 0.5, fields_task_index(['the'], 3)),
+                         (hot['key'], hot['tuples'], hot['share'], hot['task']))
+        self.assertEqual(2, len(report['heaviest_keys']))
+        busiest = max(task['tuples'] for task in report['tasks'])
+        self.assertAlmostEqual(100.0 / busiest, report['effective_parallelism'])
+        # No parallelism can do better than two tasks' worth.
+        self.assertEqual(2, report['key_bound'])
+        self.assertTrue(report['best_busiest_tuples'] >= 50)
+        self.assertTrue(report['best_effective_parallelism'] <= 2.0)
+
+        out = StringIO()
+        skew.print_report('split', 'default', 'count', ['word'], report, out=out)
+        self.assertTrue('split -> count, fields grouping on word: 100 tuples' in out.getvalue())
+        self.assertTrue('["the"]' in out.getvalue())
+
+    def test_uniform(self):
+        counts = skew.count_keys([[i] for i in range(1000)], ['n'], ['n'])
+        report = skew.analyze(counts, 4, max_parallelism=4)
+        # Long.hashCode() of small integers is the integer itself.
+        self.assertEqual([250] * 4, [task['tuples'] for task in report['tasks']])
+        self.assertEqual((4, 250), (report['best_parallelism'], report['best_busiest_tuples']))
+        self.assertEqual(1000, report['key_bound'])
+
+
+if __name__ == '__main__':
+    unittest.main()
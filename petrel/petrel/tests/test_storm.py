@@ -0,0 +1,1052 @@
+import io
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import logging
+import unittest
+from collections import deque
+
+from petrel import storm
+
+
+class CountingStream(io.BytesIO):
+    """In-memory stream that counts reads and returns at most "limit" bytes
+    per read, like a pipe."""
+    def __init__(self, data, limit=None):
+        super(CountingStream, self).__init__(data)
+        self.limit = limit
+        self.reads = 0
+
+    def read1(self, size=-1):
+        self.reads += 1
+        if self.limit is not None:
+            size = min(size, self.limit)
+        return super(CountingStream, self).read1(size)
+
+
+class TestSerializers(unittest.TestCase):
+    def test_json_roundtrip(self):
+        serializer = storm.JsonSerializer()
+        msg = {'command': 'emit', 'tuple': ['word', 1]}
+        frame = serializer.encode(msg)
+        self.assertTrue(frame.endswith(b'\nend\n'))
+        reader = storm.FrameReader(io.BytesIO(frame), serializer)
+        self.assertEqual(msg, reader.read_message())
+
+    def test_json_multiline_message(self):
+        serializer = storm.JsonSerializer()
+        reader = storm.FrameReader(io.BytesIO(b'{"a":\n1}\nend\n[2]\nend\n'), serializer)
+        self.assertEqual({'a': 1}, reader.read_message())
+        self.assertEqual([2], reader.read_message())
+
+    def test_json_eof(self):
+        reader = storm.FrameReader(io.BytesIO(b'{}\n'), storm.JsonSerializer())
+        self.assertRaises(storm.StormIPCException, reader.read_message)
+
+    @unittest.skipIf(storm.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_roundtrip(self):
+        serializer = storm.MsgPackSerializer()
+        msg = {'command': 'emit', 'tuple': [b'\x00\xff', u'word', 1, 2.5, None]}
+        reader = storm.FrameReader(
+            io.BytesIO(serializer.encode(msg) + serializer.encode([3, 4])), serializer)
+        self.assertEqual(msg, reader.read_message())
+        self.assertEqual([3, 4], reader.read_message())
+        self.assertRaises(storm.StormIPCException, reader.read_message)
+
+    @unittest.skipIf(storm.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_int_map_keys(self):
+        # Storm's MsgPackSerializer sends Long map keys.
+        serializer = storm.MsgPackSerializer()
+        values = [{1: 2, 3: {4: u'x'}}]
+        msg = {'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 1, 'tuple': values}
+        reader = storm.FrameReader(io.BytesIO(serializer.encode(msg) * 2), serializer)
+        self.assertEqual(msg, reader.read_message())
+        self.assertEqual(values, serializer.decode_tuple(reader.read_payload()).values)
+
+    @unittest.skipIf(storm.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_truncated(self):
+        serializer = storm.MsgPackSerializer()
+        frame = serializer.encode({'command': 'sync'})
+        reader = storm.FrameReader(io.BytesIO(frame[:-1]), serializer)
+        self.assertRaises(storm.StormIPCException, reader.read_message)
+
+    def test_several_frames_per_read(self):
+        serializer = storm.JsonSerializer()
+        stream = CountingStream(b''.join(serializer.encode({'id': str(i)}) for i in range(100)))
+        reader = storm.FrameReader(stream, serializer)
+        self.assertEqual([str(i) for i in range(100)], [reader.read_message()['id'] for i in range(100)])
+        self.assertEqual(1, stream.reads)
+
+    def test_frames_split_across_reads(self):
+        for serializer in self.serializers():
+            messages = [{'id': str(i), 'tuple': ['x' * i]} for i in range(50)]
+            stream = CountingStream(b''.join(serializer.encode(m) for m in messages), limit=3)
+            reader = storm.FrameReader(stream, serializer)
+            self.assertEqual(messages, [reader.read_message() for m in messages])
+
+    def serializers(self):
+        result = [storm.JsonSerializer()]
+        if storm.msgpack is not None:
+            result.append(storm.MsgPackSerializer())
+        return result
+
+    def test_get_serializer(self):
+        self.assertTrue(isinstance(storm.get_serializer(None), storm.JsonSerializer))
+        self.assertTrue(isinstance(
+            storm.get_serializer('org.apache.storm.multilang.JsonSerializer'),
+            storm.JsonSerializer))
+        self.assertRaises(ValueError, storm.get_serializer, 'com.example.Unknown')
+
+
+class TestReadCommands(unittest.TestCase):
+    def setUp(self):
+        self.old_reader = storm._reader
+        storm.pending_commands.clear()
+        storm.pending_taskids.clear()
+
+    def tearDown(self):
+        storm._reader = self.old_reader
+
+    def feed(self, *messages):
+        serializer = storm.JsonSerializer()
+        data = b''.join(serializer.encode(m) for m in messages)
+        storm._reader = storm.FrameReader(io.BytesIO(data), serializer)
+
+    def test_interleaved_taskids_and_commands(self):
+        self.feed({'command': 'next'}, [3], {'command': 'ack', 'id': 1}, [4])
+        self.assertEqual([3], storm.readTaskIds())
+        self.assertEqual(deque([{'command': 'next'}]), storm.pending_commands)
+        self.assertEqual({'command': 'next'}, storm.readCommand())
+        self.assertEqual({'command': 'ack', 'id': 1}, storm.readCommand())
+        self.assertEqual([4], storm.readTaskIds())
+
+    def test_read_tuple(self):
+        self.feed([7], {'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 2, 'tuple': ['a']})
+        self.assertEqual(storm.Tuple('1', 'spout', 'default', 2, ['a']), storm.readTuple())
+        self.assertEqual([7], storm.readTaskIds())
+
+    def test_intern(self):
+        self.feed(*[{'id': str(i), 'comp': u''.join(['sp', 'out']), 'stream': 'default', 'task': 2, 'tuple': []}
+                    for i in range(2)])
+        self.assertTrue(storm.readTuple().component is storm.readTuple().component)
+
+    @unittest.skipIf(storm.msgpack is None, 'msgpack is not installed')
+    def test_lazy_tuple(self):
+        serializer = storm.MsgPackSerializer()
+        old_serializer = storm.SERIALIZER
+        storm.SERIALIZER = serializer
+        try:
+            data = b''.join(serializer.encode(m) for m in [
+                [7],
+                {'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 2, 'tuple': [b'\x00', u'a']},
+                {'tuple': [1], 'id': '2', 'comp': 'spout', 'stream': 'default', 'task': 2},
+            ])
+            storm._reader = storm.FrameReader(io.BytesIO(data), serializer)
+            tup = storm.readTuple()
+            self.assertTrue(isinstance(tup, storm.LazyTuple))
+            self.assertEqual('1', tup.id)
+            self.assertEqual(serializer.encode_value([b'\x00', u'a']), tup.encode_values(serializer))
+            self.assertEqual([b'\x00', u'a'], tup.values)
+            self.assertEqual(storm.Tuple('1', 'spout', 'default', 2, [b'\x00', u'a']), tup)
+            self.assertEqual([7], storm.readTaskIds())
+            tup = storm.readTuple()
+            self.assertEqual(('2', [1]), (tup.id, tup.values))
+        finally:
+            storm.SERIALIZER = old_serializer
+
+
+class TestTupleFields(unittest.TestCase):
+    def setUp(self):
+        self.old_schemas = dict(storm._schemas)
+
+    def tearDown(self):
+        storm._schemas.clear()
+        storm._schemas.update(self.old_schemas)
+
+    def test_named_access(self):
+        storm.load_schemas({'source->stream->fields': {
+            'spout': {'default': ['word', 'count'], 'other': ['id']},
+        }})
+        tup = storm.Tuple('1', 'spout', 'default', 2, ['a', 3])
+        self.assertEqual(('a', 3), (tup['word'], tup['count']))
+        self.assertEqual(('a', 3), (tup.word, tup.count))
+        self.assertEqual(3, tup[1])
+        self.assertRaises(KeyError, lambda: tup['id'])
+        self.assertRaises(AttributeError, lambda: tup.missing)
+        tup = storm.Tuple('2', 'spout', 'other', 2, [5])
+        self.assertEqual(('2', 5), (tup.id, tup['id']))
+        tup = storm.Tuple('3', 'unknown', 'default', 2, [5])
+        self.assertRaises(AttributeError, lambda: tup.word)
+
+
+class RecordingStream(io.BytesIO):
+    def __init__(self):
+        super(RecordingStream, self).__init__()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+        return super(RecordingStream, self).write(data)
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def test_coalesces_writes(self):
+        stream = RecordingStream()
+        buf = storm.OutputBuffer(stream, flush_bytes=1000, flush_interval=60)
+        for i in range(10):
+            buf.write(b'x' * 10)
+        self.assertEqual([], stream.writes)
+        buf.flush()
+        self.assertEqual([b'x' * 100], stream.writes)
+        self.assertEqual(
+            {'flushes': 1, 'messages': 10, 'bytes_flushed': 100, 'bytes_per_flush': 100.0},
+            buf.stats())
+
+    def test_flush_threshold(self):
+        stream = RecordingStream()
+        buf = storm.OutputBuffer(stream, flush_bytes=25, flush_interval=60)
+        for i in range(6):
+            buf.write(b'x' * 10)
+        self.assertEqual([30, 30], [len(w) for w in stream.writes])
+
+    def test_flush_deadline(self):
+        stream = RecordingStream()
+        buf = storm.OutputBuffer(stream, flush_bytes=1000, flush_interval=0)
+        buf.write(b'a')
+        buf.write(b'b')
+        self.assertEqual([b'ab'], stream.writes)
+
+    def test_configure(self):
+        buf = storm.OutputBuffer(RecordingStream())
+        buf.configure({'petrel.output.flush_bytes': 0, 'petrel.output.flush_ms': 5})
+        self.assertEqual(0, buf.flush_bytes)
+        self.assertEqual(0.005, buf.flush_interval)
+
+    def test_flush_before_blocking_read(self):
+        stream = RecordingStream()
+        buf = storm.OutputBuffer(stream, flush_bytes=1000, flush_interval=60)
+        serializer = storm.JsonSerializer()
+        data = serializer.encode({'command': 'next'}) + serializer.encode({'command': 'next'})
+        reader = storm.FrameReader(CountingStream(data), serializer, on_block=buf.flush)
+        buf.write(b'a')
+        reader.read_message()
+        self.assertEqual([b'a'], stream.writes)
+        # The second message is already buffered, so there is no flush.
+        buf.write(b'b')
+        reader.read_message()
+        self.assertEqual([b'a'], stream.writes)
+
+    def test_write_error_logged_outside_lock(self):
+        class BrokenStream(object):
+            def write(self, data):
+                raise IOError(32, 'Broken pipe')
+
+        class NonBlockingLock(object):
+            # Raises rather than deadlocking if taken twice.
+            def __init__(self):
+                self.lock = threading.Lock()
+
+            def __enter__(self):
+                if not self.lock.acquire(False):
+                    raise AssertionError('The output buffer lock is already held')
+
+            def __exit__(self, *exc_info):
+                self.lock.release()
+
+        class BufferHandler(logging.Handler):
+            # Like run.StormHandler, sends the record through the buffer.
+            def emit(self, record):
+                buf.write(b'log')
+
+        buf = storm.OutputBuffer(BrokenStream())
+        buf.lock = NonBlockingLock()
+        buf.write(b'a')
+        handler = BufferHandler()
+        storm.storm_log.addHandler(handler)
+        try:
+            self.assertRaises(storm.StormIPCException, buf.flush)
+        finally:
+            storm.storm_log.removeHandler(handler)
+
+
+class OutputTestCase(unittest.TestCase):
+    """Captures the messages a task sends to Storm."""
+    def setUp(self):
+        self.old_output_buffer = storm.output_buffer
+        self.stream = RecordingStream()
+        storm.output_buffer = storm.OutputBuffer(self.stream, flush_bytes=1 << 20, flush_interval=60)
+        storm.collector = None
+
+    def tearDown(self):
+        storm.output_buffer = self.old_output_buffer
+        storm.collector = None
+        storm.MODE = None
+
+    def sent_messages(self):
+        storm.output_buffer.flush()
+        serializer = storm.JsonSerializer()
+        reader = storm.FrameReader(io.BytesIO(self.stream.getvalue()), serializer)
+        result = []
+        while True:
+            try:
+                result.append(reader.read_message())
+            except storm.StormIPCException:
+                return result
+
+
+class TestEmitMany(OutputTestCase):
+    def test_bolt(self):
+        storm.MODE = storm.Bolt
+        anchor = storm.Tuple('7', 'spout', 'default', 1, ['a'])
+        storm.emitMany([
+            ['a'],
+            {'tuple': ['b'], 'stream': 'other', 'anchors': [anchor]},
+            {'tuple': ['c'], 'directTask': 4},
+        ], anchors=[])
+        self.assertEqual(3, storm.output_buffer.messages)
+        self.assertEqual(0, storm.output_buffer.flushes)
+        self.assertEqual([
+            {'command': 'emit', 'anchors': [], 'tuple': ['a'], 'need_task_ids': False},
+            {'command': 'emit', 'anchors': ['7'], 'tuple': ['b'], 'need_task_ids': False, 'stream': 'other'},
+            {'command': 'emit', 'anchors': [], 'tuple': ['c'], 'need_task_ids': False, 'task': 4},
+        ], self.sent_messages())
+        self.assertEqual(1, len(self.stream.writes))
+
+    def test_spout(self):
+        storm.MODE = storm.Spout
+        storm.emitMany([['a'], {'tuple': ['b'], 'id': 2}], stream='s', id=1)
+        self.assertEqual([
+            {'command': 'emit', 'tuple': ['a'], 'need_task_ids': False, 'stream': 's', 'id': 1},
+            {'command': 'emit', 'tuple': ['b'], 'need_task_ids': False, 'stream': 's', 'id': 2},
+        ], self.sent_messages())
+
+
+class TestOutputCollector(OutputTestCase):
+    def collectors(self, collector_class):
+        result = [collector_class(storm.JsonSerializer(), storm.output_buffer)]
+        if storm.msgpack is not None:
+            result.append(collector_class(storm.MsgPackSerializer(), storm.output_buffer))
+        return result
+
+    def check_frames(self, collector, expected):
+        # Compare the precompiled frames with a full encode of each message.
+        serializer = collector.serializer
+        storm.output_buffer.flush()
+        reader = storm.FrameReader(io.BytesIO(self.stream.getvalue()), serializer)
+        for msg in expected:
+            self.assertEqual(msg, reader.read_message())
+        self.stream.seek(0)
+        self.stream.truncate()
+
+    def test_bolt(self):
+        anchor1 = storm.Tuple('1', 'spout', 'default', 1, ['a'])
+        anchor2 = storm.Tuple('2', 'spout', 'default', 1, ['b'])
+        for collector in self.collectors(storm.OutputCollector):
+            collector.emit(['x', 1])
+            collector.emit(['y'], stream='s', anchors=[anchor1])
+            collector.emitDirect(5, ['z'], anchors=[anchor1, anchor2])
+            collector.ack(anchor1)
+            collector.fail(anchor2)
+            self.check_frames(collector, [
+                {'command': 'emit', 'anchors': [], 'tuple': ['x', 1], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': ['1'], 'tuple': ['y'], 'need_task_ids': False, 'stream': 's'},
+                {'command': 'emit', 'anchors': ['1', '2'], 'tuple': ['z'], 'need_task_ids': False, 'task': 5},
+                {'command': 'ack', 'id': '1'},
+                {'command': 'fail', 'id': '2'},
+            ])
+            self.assertEqual(3, collector.emitted)
+
+    def test_basic_bolt_anchor(self):
+        anchor1 = storm.Tuple('1', 'spout', 'default', 1, ['a'])
+        anchor2 = storm.Tuple('2', 'spout', 'default', 1, ['b'])
+        for collector in self.collectors(storm.OutputCollector):
+            collector.anchors = (anchor1,)
+            collector.emit(['x'])
+            collector.anchors = (anchor2,)
+            collector.emit(['y'], anchors=[anchor1])
+            self.check_frames(collector, [
+                {'command': 'emit', 'anchors': ['1'], 'tuple': ['x'], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': ['2'], 'tuple': ['y'], 'need_task_ids': False},
+            ])
+
+    def test_anchor_list_refilled(self):
+        a, b, c, d = [storm.Tuple(id, 'spout', 'default', 1, [id]) for id in 'abcd']
+        for collector in self.collectors(storm.OutputCollector):
+            anchors = [a, b]
+            collector.emit(['x'], anchors=anchors)
+            anchors[:] = [c, d]
+            collector.emit(['y'], anchors=anchors)
+            self.check_frames(collector, [
+                {'command': 'emit', 'anchors': ['a', 'b'], 'tuple': ['x'], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': ['c', 'd'], 'tuple': ['y'], 'need_task_ids': False},
+            ])
+
+    def test_tuple_collector(self):
+        anchor1 = storm.Tuple('1', 'spout', 'default', 1, ['a'])
+        anchor2 = storm.Tuple('2', 'spout', 'default', 1, ['b'])
+        for collector in self.collectors(storm.OutputCollector):
+            bound1 = collector.bind(anchor1)
+            bound2 = collector.bind(anchor2)
+            bound1.emit(['x'])
+            bound2.emit(['y'], stream='s')
+            bound1.emitMany([['z'], {'tuple': ['w'], 'anchors': [anchor1, anchor2]}])
+            bound2.fail()
+            bound1.ack()
+            self.check_frames(collector, [
+                {'command': 'emit', 'anchors': ['1'], 'tuple': ['x'], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': ['2'], 'tuple': ['y'], 'need_task_ids': False, 'stream': 's'},
+                {'command': 'emit', 'anchors': ['1'], 'tuple': ['z'], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': ['1', '2'], 'tuple': ['w'], 'need_task_ids': False},
+                {'command': 'fail', 'id': '2'},
+                {'command': 'ack', 'id': '1'},
+            ])
+
+    def test_emit_input_tuple(self):
+        for collector in self.collectors(storm.OutputCollector):
+            serializer = collector.serializer
+            frame = bytearray(serializer.encode(
+                {'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 2, 'tuple': ['a', 1]}))
+            start, end, frame_end = serializer.find_frame(frame, 0, 0)
+            tup = serializer.decode_tuple(frame[start:end])
+            collector.emit(tup, anchors=[tup])
+            tup.values.append(2)
+            collector.emit(tup)
+            self.check_frames(collector, [
+                {'command': 'emit', 'anchors': ['1'], 'tuple': ['a', 1], 'need_task_ids': False},
+                {'command': 'emit', 'anchors': [], 'tuple': ['a', 1, 2], 'need_task_ids': False},
+            ])
+
+    def test_spout(self):
+        for collector in self.collectors(storm.SpoutOutputCollector):
+            collector.emit(['x'])
+            collector.emit(['y'], id=7, stream='s')
+            self.check_frames(collector, [
+                {'command': 'emit', 'tuple': ['x'], 'need_task_ids': False},
+                {'command': 'emit', 'tuple': ['y'], 'need_task_ids': False, 'stream': 's', 'id': 7},
+            ])
+
+
+class TestBatchBolt(OutputTestCase):
+    def test_batch(self):
+        batch = storm.Batch([
+            storm.Tuple('1', 'spout', 'default', 1, ['a', 1]),
+            storm.Tuple('2', 'spout', 'default', 1, ['b', 2]),
+        ])
+        self.assertEqual([['a', 1], ['b', 2]], batch.rows)
+        self.assertEqual([['a', 'b'], [1, 2]], batch.columns)
+        self.assertEqual([1, 2], batch.column(1))
+
+    def test_run_batch(self):
+        class CountBolt(storm.BatchBolt):
+            def process_batch(self, batch):
+                self.collector.emit([len(batch)])
+                if len(batch) == 1:
+                    batch.fail()
+
+        bolt = CountBolt()
+        bolt.collector = storm.OutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        tuples = [storm.Tuple(str(i), 'spout', 'default', 1, [i]) for i in range(3)]
+        bolt.run_batch(tuples[:2])
+        bolt.run_batch(tuples[2:])
+        self.assertEqual([
+            {'command': 'emit', 'anchors': ['0', '1'], 'tuple': [2], 'need_task_ids': False},
+            {'command': 'ack', 'id': '0'},
+            {'command': 'ack', 'id': '1'},
+            {'command': 'emit', 'anchors': ['2'], 'tuple': [1], 'need_task_ids': False},
+            {'command': 'fail', 'id': '2'},
+        ], self.sent_messages())
+        self.assertEqual(5, storm.output_buffer.messages)
+
+
+class PausingStream(object):
+    """Stream that returns one chunk per read, sleeping before each for the
+    given number of seconds, like a pipe from a quiet Storm."""
+    def __init__(self, chunks):
+        self.chunks = deque(chunks)
+
+    def read1(self, size=-1):
+        if not self.chunks:
+            return b''
+        delay, data = self.chunks.popleft()
+        time.sleep(delay)
+        return data
+
+    read = read1
+
+
+class TestBatchTimeout(OutputTestCase):
+    def setUp(self):
+        super(TestBatchTimeout, self).setUp()
+        self.old_reader = storm._reader
+
+    def tearDown(self):
+        storm._reader = self.old_reader
+        super(TestBatchTimeout, self).tearDown()
+
+    def test_heartbeat_flushes_partial_batch(self):
+        class LengthBolt(storm.BatchBolt):
+            batch_timeout = 0.05
+
+            def shared_initialize(self):
+                self.collector = storm.OutputCollector(storm.JsonSerializer(), storm.output_buffer)
+                self.conf = {}
+
+            def report_exception(self, base_message, exception):
+                pass
+
+            def process_batch(self, batch):
+                self.collector.emit([len(batch)])
+
+        serializer = storm.JsonSerializer()
+        storm._reader = storm.FrameReader(PausingStream([
+            (0, serializer.encode({'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 1, 'tuple': ['a']})),
+            (0.1, serializer.encode({'id': '2', 'comp': None, 'stream': '__heartbeat', 'task': -1, 'tuple': []})),
+        ]), serializer)
+        LengthBolt().run()
+        self.assertEqual([
+            {'command': 'sync'},
+            {'command': 'emit', 'anchors': ['1'], 'tuple': [1], 'need_task_ids': False},
+            {'command': 'ack', 'id': '1'},
+        ], self.sent_messages())
+
+    def test_tick_frequency(self):
+        from petrel.emitter import BatchBolt
+
+        class Bolt(BatchBolt):
+            batch_timeout = 2.5
+
+            def declareOutputFields(self):
+                return ['n']
+
+        bolt = Bolt('bolt.py')
+        self.assertEqual({'topology.tick.tuple.freq.secs': 3}, bolt.getComponentConfiguration())
+        self.assertEqual(10, bolt.getComponentConfiguration(
+            {'petrel.batch.timeout_ms': 10000})['topology.tick.tuple.freq.secs'])
+        bolt._json['petrel.batch.timeout_ms'] = 500
+        self.assertEqual(1, bolt.getComponentConfiguration(
+            {'petrel.batch.timeout_ms': 10000})['topology.tick.tuple.freq.secs'])
+
+
+class DelayBolt(storm.ThreadPoolBolt):
+    """Sleeps for the number of milliseconds in the tuple's second value."""
+    num_threads = 4
+
+    def __init__(self, ordering):
+        super(DelayBolt, self).__init__()
+        self.ordering = ordering
+        self.errors = []
+
+    def shared_initialize(self):
+        self.collector = storm.OutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        self.conf = {}
+
+    def report_exception(self, base_message, exception):
+        self.errors.append(exception)
+
+    def process(self, tup, collector):
+        time.sleep(max(0, tup.values[1]) / 1000.0)
+        if tup.values[1] < 0:
+            raise storm.FailedException()
+        collector.emit([tup.values[0]])
+
+
+class TestThreadPoolBolt(OutputTestCase):
+    def setUp(self):
+        super(TestThreadPoolBolt, self).setUp()
+        self.old_reader = storm._reader
+
+    def tearDown(self):
+        storm._reader = self.old_reader
+        super(TestThreadPoolBolt, self).tearDown()
+
+    def run_bolt(self, bolt, values):
+        serializer = storm.JsonSerializer()
+        storm._reader = storm.FrameReader(io.BytesIO(b''.join(
+            serializer.encode({'id': str(i), 'comp': 'spout', 'stream': 'default', 'task': 1, 'tuple': v})
+            for i, v in enumerate(values))), serializer)
+        bolt.run()
+        self.assertEqual(1, len(bolt.errors))
+        self.assertTrue(isinstance(bolt.errors[0], storm.StormIPCException))
+        return [(m['command'], m['anchors'][0] if m['command'] == 'emit' else m['id'])
+                for m in self.sent_messages()]
+
+    def test_unordered(self):
+        messages = self.run_bolt(DelayBolt(None), [['a', 100], ['b', 0], ['c', -1]])
+        # The slow first tuple completes last.
+        self.assertEqual([('emit', '0'), ('ack', '0')], messages[-2:])
+        self.assertEqual(
+            [('ack', '1'), ('emit', '1'), ('fail', '2')], sorted(messages[:-2]))
+
+    def test_global_order(self):
+        messages = self.run_bolt(DelayBolt('global'), [['a', 100], ['b', 0], ['c', -1]])
+        self.assertEqual(
+            [('emit', '0'), ('ack', '0'), ('emit', '1'), ('ack', '1'), ('fail', '2')],
+            messages)
+
+    def test_key_order(self):
+        values = [['a', 50], ['b', 0], ['a', 0], ['b', 20], ['a', 0]]
+        messages = self.run_bolt(DelayBolt('key'), values)
+        for key in 'ab':
+            ids = [str(i) for i, v in enumerate(values) if v[0] == key]
+            self.assertEqual(ids, [m[1] for m in messages if m[0] == 'ack' and values[int(m[1])][0] == key])
+
+
+class SlowBolt(storm.Bolt):
+    reader_thread = True
+
+    def __init__(self):
+        super(SlowBolt, self).__init__()
+        self.errors = []
+
+    def shared_initialize(self):
+        self.collector = storm.OutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        self.conf = {}
+
+    def report_exception(self, base_message, exception):
+        self.errors.append(exception)
+
+    def process(self, tup):
+        # Wait until the heartbeat behind this tuple has been answered.
+        deadline = time.time() + 5
+        while storm._reader_thread.heartbeats == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.collector.ack(tup)
+
+
+class TestReaderThread(OutputTestCase):
+    def setUp(self):
+        super(TestReaderThread, self).setUp()
+        self.old_reader = storm._reader
+
+    def tearDown(self):
+        storm._reader = self.old_reader
+        storm._reader_thread = None
+        super(TestReaderThread, self).tearDown()
+
+    def test_heartbeat_during_process(self):
+        serializer = storm.JsonSerializer()
+        storm._reader = storm.FrameReader(io.BytesIO(b''.join(serializer.encode(m) for m in [
+            {'id': '1', 'comp': 'spout', 'stream': 'default', 'task': 1, 'tuple': ['a']},
+            {'id': '2', 'comp': None, 'stream': '__heartbeat', 'task': -1, 'tuple': []},
+        ])), serializer)
+        bolt = SlowBolt()
+        bolt.run()
+        self.assertTrue(isinstance(bolt.errors[0], storm.StormIPCException))
+        self.assertTrue(storm.output_buffer.lock is not None)
+        self.assertEqual(
+            [{'command': 'sync'}, {'command': 'ack', 'id': '1'}],
+            self.sent_messages())
+
+
+class HeadBolt(storm.ProcessPoolBolt):
+    num_processes = 2
+    shared_memory_threshold = 1000
+
+    @staticmethod
+    def compute(data):
+        return [[len(data), data[:2]], [data * 2]]
+
+
+class TestProcessPoolBolt(unittest.TestCase):
+    def check_no_leaks(self, source):
+        # The resource tracker reports leaked or missing shared memory
+        # blocks when the process exits.
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        process = subprocess.Popen([sys.executable, '-c', textwrap.dedent(source)],
+                                   stderr=subprocess.PIPE, env=env)
+        stderr = process.communicate()[1].decode('utf-8', 'replace')
+        self.assertEqual(0, process.returncode, stderr)
+        self.assertFalse('resource_tracker' in stderr, stderr)
+
+    def test_submit(self):
+        bolt = HeadBolt()
+        data = b'ab' * 1000
+        self.assertEqual([[2000, b'ab'], [data * 2]], bolt.submit(data))
+        bolt.conf = {}
+        bolt.start_pool()
+        try:
+            self.assertEqual(2, bolt.num_threads)
+            self.assertEqual([[2000, b'ab'], [data * 2]], bolt.submit(data))
+            self.assertEqual([[1, b'x'], [b'xx']], bolt.submit(b'x'))
+        finally:
+            bolt._pool.terminate()
+
+    @unittest.skipIf(storm.shared_memory is None, 'shared_memory is not available')
+    def test_submit_no_leaks(self):
+        self.check_no_leaks('''
+            from petrel.tests.test_storm import HeadBolt
+            bolt = HeadBolt()
+            bolt.conf = {}
+            bolt.start_pool()
+            for i in range(10):
+                assert bolt.submit(b'ab' * 1000)[1] == [b'ab' * 2000]
+            bolt._pool.close()
+            bolt._pool.join()
+            ''')
+
+    @unittest.skipIf(storm.shared_memory is None, 'shared_memory is not available')
+    def test_share(self):
+        blocks = []
+        shared = storm._share(([b'x' * 10, b'y' * 100], {'z': b'z' * 100}), 100, blocks)
+        self.assertEqual(2, len(blocks))
+        self.assertEqual(b'x' * 10, shared[0][0])
+        self.assertTrue(isinstance(shared[0][1], storm._SharedBytes))
+        self.assertEqual(([b'x' * 10, b'y' * 100], {'z': b'z' * 100}), storm._unshare(shared, True))
+        for block in blocks:
+            block.close()
+        self.check_no_leaks('''
+            from petrel import storm
+            blocks = []
+            shared = storm._share([b'y' * 100], 100, blocks)
+            assert storm._unshare(shared, True) == [b'y' * 100]
+            for block in blocks:
+                block.close()
+            ''')
+
+
+class CountSpout(storm.PrefetchSpout):
+    max_emit = 3
+
+    def fetch(self):
+        for i in range(5):
+            yield [i]
+        yield {'tuple': [5], 'id': 5}
+
+
+class TestPrefetchSpout(OutputTestCase):
+    def test_next_tuple(self):
+        spout = CountSpout()
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.start_fetching()
+        spout._thread.join()
+        self.assertEqual(6, spout.stats()['queue_depth'])
+        spout.nextTuple()
+        spout.nextTuple()
+        spout.nextTuple()
+        self.assertEqual([
+            {'command': 'emit', 'tuple': [0], 'need_task_ids': False},
+            {'command': 'emit', 'tuple': [1], 'need_task_ids': False},
+            {'command': 'emit', 'tuple': [2], 'need_task_ids': False},
+            {'command': 'emit', 'tuple': [3], 'need_task_ids': False},
+            {'command': 'emit', 'tuple': [4], 'need_task_ids': False},
+            {'command': 'emit', 'tuple': [5], 'need_task_ids': False, 'id': 5},
+        ], self.sent_messages())
+        stats = spout.stats()
+        self.assertEqual((0, 6, 6), (stats['queue_depth'], stats['fetched'], stats['emitted']))
+        self.assertTrue(stats['wait_time'] > 0)
+
+    def test_deactivate(self):
+        spout = CountSpout()
+        spout.queue_size = 1
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.start_fetching()
+        spout.deactivate()
+        # An item fetched before deactivate() may still be queued.
+        for i in range(3):
+            spout.nextTuple()
+        time.sleep(0.05)
+        fetched = spout.fetched
+        for i in range(3):
+            spout.nextTuple()
+        time.sleep(0.05)
+        # The thread does not fetch while deactivated, even with room in the
+        # queue.
+        self.assertEqual(fetched, spout.fetched)
+        self.assertTrue(fetched < 6)
+        spout.activate()
+        for i in range(100):
+            if spout.emitted == 6:
+                break
+            spout.nextTuple()
+        self.assertEqual(6, spout.emitted)
+
+
+class WordSpout(storm.ReliableSpout):
+    max_retries = 1
+    retry_delay = 0
+
+    def __init__(self):
+        super(WordSpout, self).__init__()
+        self.words = ['a', 'bb']
+        self.dropped_tuples = []
+
+    def nextTuple(self):
+        if self.words:
+            self.emit([self.words.pop(0)], stream='words')
+
+    def dropped(self, id, values):
+        self.dropped_tuples.append((id, values))
+
+
+class TestReliableSpout(OutputTestCase):
+    def test_replay(self):
+        spout = WordSpout()
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.handle_next()
+        spout.handle_next()
+        self.assertEqual(2, spout.stats()['pending'])
+        self.assertEqual(len(b'["a"]') + len(b'["bb"]'), spout.stats()['pending_bytes'])
+        spout.ack(0)
+        spout.fail(1)
+        self.assertEqual(1, spout.stats()['waiting_replay'])
+        spout.handle_next()
+        spout.fail(1)
+        spout.handle_next()
+        self.assertEqual([
+            {'command': 'emit', 'tuple': ['a'], 'need_task_ids': False, 'stream': 'words', 'id': 0},
+            {'command': 'emit', 'tuple': ['bb'], 'need_task_ids': False, 'stream': 'words', 'id': 1},
+            {'command': 'emit', 'tuple': ['bb'], 'need_task_ids': False, 'stream': 'words', 'id': 1},
+        ], self.sent_messages())
+        self.assertEqual([(1, ['bb'])], spout.dropped_tuples)
+        self.assertEqual({
+            'pending': 0, 'pending_bytes': 0, 'waiting_replay': 0, 'emitted': 2,
+            'replayed': 1, 'dropped': 1, 'replay_rate': 1 / 3.0,
+        }, spout.stats())
+
+    def test_ack_after_fail(self):
+        spout = WordSpout()
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.handle_next()
+        spout.fail(0)
+        spout.ack(0)
+        spout.handle_next()
+        self.assertEqual([['a'], ['bb']], [m['tuple'] for m in self.sent_messages()])
+        self.assertEqual((1, 0, 0), (spout.stats()['pending'], spout.stats()['waiting_replay'], spout.replayed))
+
+    def test_backoff(self):
+        spout = WordSpout()
+        spout.max_retries = None
+        spout.retry_delay = 10
+        spout.max_retry_delay = 30
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.nextTuple()
+        now = time.time()
+        delays = []
+        for i in range(4):
+            spout.fail(0)
+            due = spout._replays[min(30, 10 * 2 ** i)][0][0]
+            delays.append(round(due - now))
+            spout.replay(due - 1)
+            self.assertEqual(i, spout.replayed)
+            spout.replay(due)
+        self.assertEqual([10, 20, 30, 30], delays)
+
+    def test_max_pending_bytes(self):
+        spout = WordSpout()
+        spout.max_pending_bytes = 1
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        spout.handle_next()
+        spout.handle_next()
+        self.assertEqual(1, spout.emitted)
+
+
+class NumberSpout(storm.Spout):
+    def __init__(self, count):
+        super(NumberSpout, self).__init__()
+        self.count = count
+        self.next_number = 0
+
+    def nextTuple(self):
+        if self.next_number < self.count:
+            self.collector.emit([self.next_number], id=self.next_number)
+            self.next_number += 1
+
+
+class TestSpoutBatching(OutputTestCase):
+    def make_spout(self, count, **kwargs):
+        spout = NumberSpout(count)
+        spout.collector = storm.SpoutOutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        for name, value in kwargs.items():
+            setattr(spout, name, value)
+        return spout
+
+    def test_default(self):
+        spout = self.make_spout(10)
+        spout.handle_next()
+        spout.handle_next()
+        self.assertEqual(2, spout.collector.emitted)
+
+    def test_adaptive_batch(self):
+        spout = self.make_spout(100, max_batch=4)
+        batches = []
+        for i in range(5):
+            emitted = spout.collector.emitted
+            spout.handle_next()
+            batches.append(spout.collector.emitted - emitted)
+        self.assertEqual([1, 2, 3, 4, 4], batches)
+        spout.ack_latency = spout.target_latency * 2
+        spout.handle_next()
+        self.assertEqual(2, spout.batch)
+
+    def test_ack_latency(self):
+        spout = self.make_spout(100, max_batch=4)
+        spout.collector.sent_times = {}
+        spout.collector.sample_every = 2
+        spout.handle_next()
+        spout.handle_next()
+        # Three tuples were emitted and the second was sampled.
+        self.assertEqual([1], list(spout.collector.sent_times))
+        spout._completed(0)
+        spout._completed(1)
+        self.assertEqual({}, spout.collector.sent_times)
+        self.assertTrue(spout.ack_latency >= 0)
+
+    def test_idle_backoff(self):
+        spout = self.make_spout(0, idle_sleep=0.001, max_idle_sleep=0.004)
+        sleeps = []
+        for i in range(4):
+            spout.handle_next()
+            sleeps.append(spout.sleep)
+        self.assertEqual([0.001, 0.002, 0.004, 0.004], sleeps)
+        spout.count = 1
+        spout.handle_next()
+        self.assertEqual(0.0, spout.sleep)
+
+
+class TestProfiling(OutputTestCase):
+    def test_histogram(self):
+        h = storm.Histogram()
+        for value in range(1, 1001):
+            h.record(value * 1000)
+        self.assertEqual(1000, h.count)
+        for p, expected in [(50, 500000), (99, 990000), (99.9, 999000)]:
+            # Within a bucket's width above the true value.
+            self.assertTrue(expected <= h.percentile(p) <= expected * 1.125, (p, h.percentile(p)))
+        snapshot = h.snapshot()
+        self.assertEqual(500.5, snapshot['mean_us'])
+        self.assertEqual(1000.0, snapshot['max_us'])
+        h.record(0)
+        h.reset()
+        self.assertEqual(0, h.percentile(50))
+
+    def test_profiler(self):
+        collector = storm.OutputCollector(storm.JsonSerializer(), storm.output_buffer)
+        profiler = storm.TupleProfiler()
+        profiler.attach(collector)
+        tup = storm.Tuple('1', 'spout', 'words', 1, ['a'])
+        collector.emit(['x'])
+        collector.emitDirect(2, ['y'])
+        collector.ack(tup)
+        self.assertTrue(profiler._emit_ns > 0 and profiler._ack_ns > 0)
+        profiler.record('words', 1000, 2000, storm.now_ns())
+        snapshot = profiler.snapshot()
+        self.assertEqual(['words'], list(snapshot))
+        self.assertEqual(sorted(storm.TupleProfiler.KINDS), sorted(snapshot['words']))
+        self.assertEqual(1, snapshot['words']['process']['count'])
+        self.assertEqual(2.0, snapshot['words']['process']['max_us'])
+        self.assertEqual(0, profiler._emit_ns)
+        self.assertEqual(3, len(self.sent_messages()))
+
+
+class TestMetrics(OutputTestCase):
+    def test_values(self):
+        registry = storm.MetricsRegistry()
+        registry.counter('tuples').inc()
+        registry.counter('tuples').inc(2)
+        registry.gauge('queue').set(5)
+        registry.gauge('fn', lambda: 'x')
+        registry.meter('rate').mark(10)
+        for value in (1, 2, 3, 4.0):
+            registry.histogram('sizes').record(value)
+        self.assertRaises(ValueError, registry.meter, 'tuples')
+        values = registry.values(reset=True)
+        self.assertEqual(3, values['tuples'])
+        self.assertEqual((5, 'x'), (values['queue'], values['fn']))
+        self.assertEqual(10, values['rate']['count'])
+        self.assertTrue(values['rate']['rate'] > 0)
+        self.assertEqual({'count': 4, 'mean': 2.5, 'p50': 2, 'p99': 4, 'p999': 4, 'max': 4}, values['sizes'])
+        values = registry.values()
+        self.assertEqual((0, 5, 0, 0), (values['tuples'], values['queue'], values['rate']['count'],
+                                        values['sizes']['count']))
+
+    def test_send(self):
+        registry = storm.metrics = storm.MetricsRegistry()
+        try:
+            registry.configure({'petrel.metrics.interval_secs': 0, 'petrel.metrics.storm': True})
+            registry.counter('tuples').inc()
+            storm.sync()
+            registry.interval = 60
+            registry.counter('tuples').inc()
+            storm.sync()
+        finally:
+            storm.metrics = storm.MetricsRegistry()
+        self.assertEqual([
+            {'command': 'metrics', 'name': 'tuples', 'params': 1},
+            {'command': 'sync'},
+            {'command': 'sync'},
+        ], self.sent_messages())
+        self.assertEqual(1, registry.reports)
+
+    def test_reader_thread_sync(self):
+        registry = storm.metrics = storm.MetricsRegistry(interval=0)
+        old_reader_thread = storm._reader_thread
+        try:
+            registry.counter('tuples').inc()
+            # The main thread reports the metrics for the reader thread.
+            storm._reader_thread = thread = threading.Thread(target=storm.sync)
+            thread.start()
+            thread.join()
+            self.assertEqual((0, 1), (registry.reports, registry.counter('tuples').value))
+            storm.run_main_thread_calls()
+            self.assertEqual((1, 0), (registry.reports, registry.counter('tuples').value))
+        finally:
+            storm._reader_thread = old_reader_thread
+            storm.main_thread_calls.clear()
+            storm.metrics = storm.MetricsRegistry()
+
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('petrel.tests.logging')
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_log_stream(self):
+        stream = storm.LogStream(self.logger)
+        stream.write('a')
+        stream.write('\n')
+        stream.write('b 100%\nc\nd')
+        stream.flush()
+        self.assertEqual(['a', 'b 100%\nc', 'd'], self.handler.messages)
+
+    def test_sampled_logger(self):
+        log = storm.SampledLogger(self.logger, every=3)
+        for i in range(7):
+            log.debug('tuple %d', i)
+        self.assertEqual(
+            ['tuple 2 (2 similar messages skipped)', 'tuple 5 (2 similar messages skipped)'],
+            self.handler.messages)
+        self.logger.setLevel(logging.INFO)
+        log.debug('ignored')
+        self.assertEqual(7, log.seen)
+
+    def test_rate_limit(self):
+        log = storm.SampledLogger(self.logger, every=1, per_second=2)
+        for i in range(5):
+            log.info('tuple %d', i)
+        # The test may cross into the next second once.
+        self.assertTrue(2 <= len(self.handler.messages) <= 4)
+        self.assertEqual(5, len(self.handler.messages) + log.skipped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -125,5 +125,9 @@ setup(name=PACKAGE
         'PyYAML==3.10',
         'six==1.10.0',
     ]
+    ,extras_require={
+        # Needed for the binary multilang serializer (storm.petrel.MsgPackSerializer).
+        'msgpack': ['msgpack>=0.6.1'],
+    }
     # Setting this flag makes Petrel easier to debug within a running topology.
     ,zip_safe=False)
@@ -3,13 +3,13 @@ import random
 import logging
 
 from petrel import storm
-from petrel.emitter import Spout
+from petrel.emitter import PrefetchSpout
 
 log = logging.getLogger('randomsentence')
 
 log.debug('randomsentence loading')
 
-class RandomSentenceSpout(Spout):
+class RandomSentenceSpout(PrefetchSpout):
     def __init__(self):
         super(RandomSentenceSpout, self).__init__(script=__file__)
         #self._index = 0
@@ -26,19 +26,14 @@ class RandomSentenceSpout(Spout):
         "i am at two with nature"
     ]
         
-    def nextTuple(self):
-        #if self._index == len(self.sentences):
-        #    # This is just a demo; keep sleeping and returning None after we run
-        #    # out of data. We can't just sleep forever or Storm will hang.
-        #    time.sleep(1)
-        #    return None
-
-        time.sleep(0.25);
-        sentence = self.sentences[random.randint(0, len(self.sentences) - 1)]
-        #sentence = self.sentences[self._index]
-        #self._index += 1
-        log.debug('randomsentence emitting: %s', sentence)
-        storm.emit([sentence])
+    def fetch(self):
+        # Simulate a slow source. This runs on a background thread, so the
+        # delay doesn't hold up acks or heartbeats.
+        while True:
+            time.sleep(0.25)
+            sentence = self.sentences[random.randint(0, len(self.sentences) - 1)]
+            log.debug('randomsentence fetched: %s', sentence)
+            yield [sentence]
 
 # TODO: Revisit this. Currently the spout runs forever, so it's not suitable
 # for run_simple_topology(). We could modify the spout so it stops after
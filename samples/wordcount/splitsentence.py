@@ -7,6 +7,9 @@ log = logging.getLogger('splitsentence')
 
 log.debug('splitsentence loading')
 
+# Per-tuple messages: log one in every 1000.
+tuple_log = storm.SampledLogger(log, every=1000)
+
 class SplitSentenceBolt(BasicBolt):
     def __init__(self):
         super(SplitSentenceBolt, self).__init__(script=__file__)
@@ -15,10 +18,10 @@ class SplitSentenceBolt(BasicBolt):
         return ['word']
 
     def process(self, tup):
-        log.debug('SplitSentenceBolt.process() called with: %s', tup)
+        tuple_log.debug('SplitSentenceBolt.process() called with: %s', tup)
         words = tup.values[0].split(" ")
         for word in words:
-          log.debug('SplitSentenceBolt.process() emitting: %s', word)
+          tuple_log.debug('SplitSentenceBolt.process() emitting: %s', word)
           storm.emit([word])
 
 def test():
@@ -8,6 +8,9 @@ log = logging.getLogger('wordcount')
 
 log.debug('wordcount loading')
 
+# Per-tuple messages: log one in every 1000.
+tuple_log = storm.SampledLogger(log, every=1000)
+
 class WordCountBolt(BasicBolt):
     def __init__(self):
         super(WordCountBolt, self).__init__(script='wordcount.py')
@@ -18,10 +21,10 @@ class WordCountBolt(BasicBolt):
         return ['word', 'count']
 
     def process(self, tup):
-        log.debug('WordCountBolt.process() called with: %s', tup)
+        tuple_log.debug('WordCountBolt.process() called with: %s', tup)
         word = tup.values[0]
         self._count[word] += 1
-        log.debug('WordCountBolt.process() emitting: %s', [word, self._count[word]])
+        tuple_log.debug('WordCountBolt.process() emitting: %s', [word, self._count[word]])
         storm.emit([word, self._count[word]])
 
 def test():